@@ -0,0 +1,89 @@
+"""
+停止規則つきのモンテカルロと信頼区間
+
+試行をバッチで追加していき、次のいずれかで止める:
+  - 全ての確率の標準誤差が target_se 以下になった
+  - 経過時間が time_budget (秒) を超えた、または残り時間に最小のバッチも収まらない
+  - 試行回数が max_trials に達した
+バッチは倍々に増やすが、time_budget があればここまでの速度で残り時間に収まる試行数までに抑える。
+標準誤差は p = 0, 1 付近でも 0 にならないよう Wilson 区間の半幅 / z で見積もる。
+"""
+import math
+import time
+
+Z_95 = 1.959963984540054 # 95% 信頼区間の z 値
+MIN_BATCH = 256
+
+
+def wilson_interval(count, trials, z=Z_95):
+    """count / trials の Wilson スコア信頼区間 (下限, 上限)"""
+    if trials <= 0:
+        return 0.0, 1.0
+    p = count / trials
+    z2 = z * z
+    denom = 1 + z2 / trials
+    center = (p + z2 / (2 * trials)) / denom
+    half = z * math.sqrt(p * (1 - p) / trials + z2 / (4 * trials * trials)) / denom
+    return max(0.0, center - half), min(1.0, center + half)
+
+def standard_error(count, trials, z=Z_95):
+    """count / trials の標準誤差の見積もり (Wilson 区間の半幅 / z)"""
+    low, high = wilson_interval(count, trials, z)
+    return (high - low) / (2 * z)
+
+def intervals(counts, trials, names):
+    """names[i] -> [下限, 上限] の辞書"""
+    return {name: list(wilson_interval(c, trials)) for name, c in zip(names, counts)}
+
+def equity_interval(wins, ties, trials, z=Z_95):
+    """
+    エクイティ (勝ち + 引き分け / 2) の信頼区間 (下限, 上限)。
+    1 試行の得点 (1, 0.5, 0) の分散から正規近似で求める。
+    """
+    if trials <= 0:
+        return 0.0, 1.0
+    mean = (wins + ties / 2) / trials
+    second_moment = (wins + ties / 4) / trials
+    half = z * math.sqrt(max(second_moment - mean * mean, 0.0) / trials)
+    return max(0.0, mean - half), min(1.0, mean + half)
+
+def exact_intervals(probabilities):
+    """厳密計算の結果用の幅 0 の区間"""
+    return {name: [p, p] for name, p in probabilities.items()}
+
+
+def run_adaptive(batch_fn, max_trials, target_se=None, time_budget=None, min_batch=MIN_BATCH, on_batch=None):
+    """
+    batch_fn(n) は n 試行分の結果別の回数 (シーケンス) を返す関数。
+    停止するまでバッチを倍々で増やしながら呼び出し、(回数のリスト, 試行回数, 停止理由) を返す。
+    time_budget を指定した場合、バッチはここまでの速度 (試行/秒) で残り時間に収まる試行数を超えない。
+    停止理由は 'target_se', 'time_budget', 'max_trials' のいずれか。
+    on_batch を指定すると、バッチごとに on_batch(ここまでの回数のリスト, ここまでの試行回数) を呼ぶ。
+    """
+    start = time.perf_counter()
+    counts = None
+    trials = 0
+    batch = min_batch
+    while True:
+        n = min(batch, max_trials - trials)
+        result = batch_fn(n)
+        if counts is None:
+            counts = [int(c) for c in result]
+        else:
+            counts = [a + int(b) for a, b in zip(counts, result)]
+        trials += n
+        if on_batch is not None:
+            on_batch(counts, trials)
+        if target_se is not None and max(standard_error(c, trials) for c in counts) <= target_se:
+            return counts, trials, 'target_se'
+        if time_budget is not None:
+            elapsed = time.perf_counter() - start
+            # 倍々のバッチで予算を超えないよう、ここまでの速度で残り時間に収まる試行数
+            fits = int(trials * (time_budget - elapsed) / elapsed) if elapsed > 0 else max_trials
+            if elapsed >= time_budget or fits < min_batch:
+                return counts, trials, 'time_budget'
+        if trials >= max_trials:
+            return counts, trials, 'max_trials'
+        batch = max(batch, trials) # 試行回数を倍々に増やす
+        if time_budget is not None:
+            batch = min(batch, fits)
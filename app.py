@@ -1,27 +1,122 @@
-from flask import Flask, jsonify, request, render_template
-from collections import Counter
+from flask import Flask, Response, g, jsonify, request, render_template, url_for
+import atexit
+import contextlib
+import cProfile
+import hashlib
+import json
+import logging
+import os
 import random
-from itertools import combinations # 組み合わせ計算に必要
+import tempfile
+import time
+
+import numpy as np
+
+from adaptive import exact_intervals, intervals, run_adaptive, wilson_interval
+from evaluator import (
+    HAND_CATEGORIES_27SD, CATEGORY_SHIFT, CAT_ONE_PAIR, NUM_CARDS, NUM_CATEGORIES,
+    card_to_id, id_to_card, evaluate_ids, strength_from_eval,
+)
+from category_table import load_table
+from equity import EXACT_COST_LIMIT, estimate_exact_cost, exact_result, exact_spot_counts
+from jobs import FINISHED_STATES, JobCancelled, JobManager
+from metrics import Registry
+from kernel import simulate_multiway as simulate_multiway_python, simulate_spot as simulate_spot_python
+from parallel import new_seed, sharded_multiway_counts, sharded_spot_counts
+from range_equity import parse_range, range_equity
+from solver import solve_draw
+import tables
+from tables import HAND_CATEGORY_ORDER, RANK_MAP, RANK_MAP_REV
+from result_cache import ResultCache, canonicalize, canonicalize_players, invert_permutation, relabel_ids
+from singleflight import SingleFlight
+from vectorized import simulate_spot_counts
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 # --- 定数 ---
-RANKS = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
-SUITS = ['H', 'D', 'S', 'C']
-FULL_DECK = frozenset([r + s for r in RANKS for s in SUITS])
-RANK_MAP = {'2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, '10': 10, 'J': 11, 'Q': 12, 'K': 13, 'A': 14}
-RANK_MAP_REV = {v: k for k, v in RANK_MAP.items()}
-
-# 2-7SD ハンドカテゴリ (確率計算用)
-# 注意: Bad Hand は Straight/Flush を含むため、個別のカテゴリより上に配置
-HAND_CATEGORIES_27SD = [
-    "7-High", "8-High", "9-High", "10-High", "J-High", "Q-High", "K-High", "A-High", # No Pair
-    "One Pair", "Two Pair", "Three of a Kind",
-    "Bad Hand (Straight/Flush)", # ストレートとフラッシュ
-    "Full House", "Four of a Kind"
-]
-# 確率表示順序のためのマップ (カテゴリ名 -> ソート順)
-HAND_CATEGORY_ORDER = {name: i for i, name in enumerate(HAND_CATEGORIES_27SD)}
+# カード・ランク・カテゴリの定数 (FULL_DECK, RANK_MAP, HAND_CATEGORY_ORDER など) は tables を使用
+
+# シミュレーションエンジン: 'python' (1試行ずつ), 'numpy' (配列でまとめて試行)
+ENGINES = ('python', 'numpy')
+MAX_SIMULATIONS = 2000000 # APIで指定できるシミュレーション回数の上限
+MAX_PLAYERS = 6 # /api/calculate/multiway で指定できるプレイヤー数の上限
+MAX_BATCH_ITEMS = 1000 # /api/calculate/batch で 1 リクエストに指定できる局面数の上限
+
+# 保持カードごとのカテゴリ分布テーブル (python category_table.py build で作成、なければ None)
+category_table = load_table()
+
+# 同じ入力・シードに対する結果が変わる変更 (評価器・サンプリングの手順・レスポンスの形式など) をしたら上げる
+# (キャッシュキーと ETag に含めるので、古いキャッシュやブラウザ・CDN の保存した結果は使われなくなる)
+# カテゴリ分布テーブルの有無でサンプリング時の確率の出し方が変わるので、それも含める
+ENGINE_VERSION = f"2.t{tables.TABLES_VERSION}{'.c' if category_table is not None else ''}"
+
+# 結果キャッシュ (POKER_CACHE_DB を指定すると SQLite で全ワーカー共有の永続層を持つ。
+# 永続層は POKER_CACHE_DB_SIZE 件まで、POKER_CACHE_TTL を指定するとその秒数で期限切れ)
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('POKER_CACHE_SIZE', 1024)),
+    db_path=os.environ.get('POKER_CACHE_DB'),
+    max_disk_entries=int(os.environ.get('POKER_CACHE_DB_SIZE', 100000)),
+    ttl=int(os.environ['POKER_CACHE_TTL']) if os.environ.get('POKER_CACHE_TTL') else None,
+)
+# 実行中の同じ計算をまとめる (POKER_CACHE_DB があれば、その隣のロックファイルで他のワーカーとも同時に計算しない)
+# 計算していたジョブがキャンセルされた場合 (JobCancelled) は、待っていた呼び出しが改めて計算する
+inflight = SingleFlight(lock_dir=os.environ['POKER_CACHE_DB'] + '.locks' if os.environ.get('POKER_CACHE_DB') else None,
+                        retry_on=(JobCancelled,))
+
+# 非同期ジョブ (POKER_JOB_WORKERS 件まで同時に実行し、終了後 POKER_JOB_TTL 秒で削除)
+# 状態は SQLite に置いて全ワーカーで共有する (状態の取得・SSE・キャンセルが別のワーカーに届いても扱える)。
+# ファイルは POKER_JOB_DB、なければ POKER_CACHE_DB、どちらもなければ一時ディレクトリに作る
+# (gunicorn の preload_app ではマスターで import するので、一時ファイルの名前は全ワーカーで同じになる)
+def _temporary_job_db():
+    path = os.path.join(tempfile.gettempdir(), f'poker-jobs-{os.getpid()}.db')
+    owner = os.getpid()
+    def remove():
+        if os.getpid() == owner: # fork したワーカーの終了では消さない
+            for suffix in ('', '-wal', '-shm'):
+                with contextlib.suppress(OSError):
+                    os.remove(path + suffix)
+    atexit.register(remove)
+    return path
+
+jobs = JobManager(
+    max_workers=int(os.environ.get('POKER_JOB_WORKERS', 2)),
+    ttl=int(os.environ.get('POKER_JOB_TTL', 600)),
+    db_path=os.environ.get('POKER_JOB_DB') or os.environ.get('POKER_CACHE_DB') or _temporary_job_db(),
+)
+SSE_KEEPALIVE_SECONDS = 15 # 進捗がない間も接続を保つためのコメント送信間隔
+
+# 計測 (POKER_METRICS=0 で無効。GET /metrics で Prometheus のテキスト形式で出力する)
+# POKER_METRICS_DIR を指定すると、各ワーカーが METRICS_FLUSH_SECONDS ごとに値をそこへ書き、/metrics は全ワーカーの合計を返す
+# (gunicorn.conf.py で起動すると一時ディレクトリが指定される。指定しない場合は応答したワーカーの値のみ)
+metrics = Registry(enabled=os.environ.get('POKER_METRICS', '1') != '0', directory=os.environ.get('POKER_METRICS_DIR'))
+METRICS_FLUSH_SECONDS = 1.0
+request_seconds = metrics.histogram('poker_request_seconds', 'エンドポイントごとのリクエストの所要時間 (秒)')
+phase_seconds = metrics.histogram('poker_phase_seconds', '計算のフェーズごとの所要時間 (秒)')
+trial_count = metrics.counter('poker_trials_total', '評価した試行数 (全列挙は組み合わせ数)')
+method_count = metrics.counter('poker_method_total', '計算方法 (全列挙・サンプリングなど) を選んだ回数')
+invalid_count = metrics.counter('poker_invalid_simulations_total', 'デッキ不足などでシミュレーションできなかった局面の数')
+coalesced_count = metrics.counter('poker_coalesced_total', '実行中の同じ計算を待って結果を共有した回数')
+not_modified_count = metrics.counter('poker_not_modified_total', 'If-None-Match が一致して計算せずに 304 を返した回数')
+
+@metrics.collector
+def _cache_metrics():
+    stats = result_cache.stats()
+    return [
+        ('poker_cache_lookups_total', 'counter', '結果キャッシュの参照回数',
+         [({'result': 'memory_hit'}, stats['memory_hits']), ({'result': 'disk_hit'}, stats['disk_hits']),
+          ({'result': 'miss'}, stats['misses'])]),
+        ('poker_cache_entries', 'gauge', 'メモリ上の結果キャッシュの件数', [({}, stats['entries'])]),
+        ('poker_inflight_calculations', 'gauge', '実行中の計算 (重複をまとめた後) の数', [({}, inflight.in_flight())]),
+        ('poker_coalesced_waiting', 'gauge', '実行中の同じ計算の完了を待っている呼び出しの数', [({}, inflight.waiting())]),
+    ]
+
+# 初回使用時に構築するテーブルをここで構築しておく (gunicorn の preload_app ならマスターで済み、ワーカーは共有する)
+tables.warm()
+logger.info("Tables ready in %.3f s", tables.status()['warm_seconds'])
+
+# POKER_PROFILE_DIR を指定すると、X-Profile ヘッダつきのリクエストを cProfile で計測してこのディレクトリに保存する
+PROFILE_DIR = os.environ.get('POKER_PROFILE_DIR')
 
 
 # --- カード検証 ---
@@ -37,80 +132,22 @@ def validate_card(card):
 # evaluate_poker_hand は不要になったので削除 or コメントアウト
 # def evaluate_poker_hand(cards): ...
 
-# --- is_straight (変更なし) ---
-def is_straight(ranks):
-    # 2-7SDではAはハイカードとしてのみ扱うため、A-2-3-4-5はストレートではない
-    # 5-4-3-2-Aのような並びもストレートではない
-    # rank_map = {'2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, '10': 10, 'J': 11, 'Q': 12, 'K': 13, 'A': 14} # グローバル定数を使用
-    numeric_ranks = sorted([RANK_MAP[r] for r in set(ranks)]) # 重複を除いてソート
-
-    if len(numeric_ranks) < 5: # ペアなどがある場合はストレートではない
-        return False
-
-    # A-2-3-4-5 (Aはハイなのでストレートではない) チェックは不要
-
-    # 通常のストレートチェック
-    is_straight_seq = all(numeric_ranks[i] == numeric_ranks[0] + i for i in range(len(numeric_ranks)))
-    return is_straight_seq
-
-# --- evaluate_27sd_hand (変更なし) ---
+# --- evaluate_27sd_hand (evaluator のラッパー) ---
 def evaluate_27sd_hand(cards):
-    """2-7 Single Drawのハンドを評価する関数"""
+    """2-7 Single Drawのハンドを評価する関数 (文字列カード用の互換ラッパー)"""
     # 入力チェック
     if not cards or len(cards) != 5:
         # 評価不能なハンド（エラー処理を呼び出し元で行うか、ここで例外を発生させる）
         # ここでは仮に ('Invalid', []) を返す
         return 'Invalid', []
 
-    ranks = [card[:-1].upper() for card in cards]
-    suits = [card[-1].upper() for card in cards]
-
-    rank_counts = Counter(ranks)
-    suit_counts = Counter(suits)
-
-    is_flush_hand = len(set(suits)) == 1
-    is_straight_hand = is_straight(ranks)
-
-    # ストレートやフラッシュは悪いハンド
-    if is_straight_hand or is_flush_hand:
-        hand_type = "Bad Hand (Straight/Flush)"
-        # ハイカード順にランクを返す (Aが一番高い)
-        # rank_map = {'2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, '10': 10, 'J': 11, 'Q': 12, 'K': 13, 'A': 14} # グローバル定数を使用
-        sorted_numeric_ranks = sorted([RANK_MAP[r] for r in ranks], reverse=True)
-        return hand_type, sorted_numeric_ranks
-
-    # ペア系の判定
-    pairs = [rank for rank, count in rank_counts.items() if count == 2]
-    threes = [rank for rank, count in rank_counts.items() if count == 3]
-    fours = [rank for rank, count in rank_counts.items() if count == 4]
-
-    # rank_map = {'2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, '10': 10, 'J': 11, 'Q': 12, 'K': 13, 'A': 14} # グローバル定数を使用
-    sorted_numeric_ranks = sorted([RANK_MAP[r] for r in ranks], reverse=True) # 降順ソート
-
-    if fours:
-        hand_type = "Four of a Kind"
-    # elif threes and pairs: # フルハウスはストレート/フラッシュより強いので先に判定しない
-    #     hand_type = "Full House"
-    elif threes:
-        hand_type = "Three of a Kind"
-    elif len(pairs) == 2:
-        hand_type = "Two Pair"
-    elif pairs:
-        hand_type = "One Pair"
-    # フルハウスの判定をここで行う (ペア系よりは強い)
-    elif threes and pairs: # この条件は実際には起こらない (threes か pairs で先に判定される)
-         # 正しくは Counter の値で判定
-         if sorted(rank_counts.values()) == [2, 3]:
-              hand_type = "Full House"
-         else: # ペアもストレートもフラッシュもない場合 -> ナンバーハンド
-              hand_type = "No Pair" # または "High Card Hand"
-    else:
-         # ペアもストレートもフラッシュもない場合 -> ナンバーハンド
-         hand_type = "No Pair" # または "High Card Hand"
-
+    card_ids = [card_to_id(card) for card in cards]
+    category = evaluate_ids(card_ids) >> CATEGORY_SHIFT
+    sorted_numeric_ranks = sorted([(cid >> 2) + 2 for cid in card_ids], reverse=True) # 降順ソート
 
     # 2-7SDでは、No Pairハンドが最も良く、その中で数字が小さいほど強い
     # 比較のために、ハンドタイプとソートされたランク（降順）を返す
+    hand_type = "No Pair" if category < CAT_ONE_PAIR else HAND_CATEGORIES_27SD[category]
     return hand_type, sorted_numeric_ranks
 
 
@@ -125,100 +162,24 @@ def get_hand_category(hand_type, sorted_ranks):
     # 他のタイプはそのまま返すか、必要なら詳細化
     return hand_type
 
-def draw_cards(kept_cards, num_to_draw, available_deck):
-    """指定された枚数のカードを利用可能なデッキからランダムに引く"""
-    kept_cards_list = list(kept_cards) # setかもしれないのでリストに変換
-    if num_to_draw <= 0:
-        return kept_cards_list
-    
-    available_deck_list = list(available_deck)
-    if len(available_deck_list) < num_to_draw:
-        # ドローできない場合はエラーを示すか、不完全なハンドを返す
-        # ここでは空リストを追加して返す（呼び出し元でlen==5をチェック）
-        print(f"Warning: Not enough cards in deck to draw {num_to_draw}. Available: {len(available_deck_list)}")
-        # return kept_cards_list # 不完全なハンドを返す
-        # より明確にするため、Noneを返すか例外を投げるべきかもしれない
-        return None # ドロー失敗を示す
-
-    drawn_cards = random.sample(available_deck_list, num_to_draw)
-    return kept_cards_list + drawn_cards
-
-
-# --- 確率計算関数 ---
-def calculate_draw_probabilities(kept_cards, available_deck, num_simulations=5000):
-    """
-    指定されたカードを持ち、残りをドローした場合の最終ハンドカテゴリ確率を計算する。
-    """
-    kept_cards_list = list(kept_cards) # setかもしれないのでリストに変換
-    num_kept = len(kept_cards_list)
-
-    if num_kept > 5: # エラーケース
-         return {'error': 'Kept cards exceed 5'}
-    if num_kept == 5: # すでに5枚持っている場合はドロー不要
-        hand_type, sorted_ranks = evaluate_27sd_hand(kept_cards_list)
-        if hand_type == 'Invalid':
-             return {'error': 'Invalid hand provided'}
-        category = get_hand_category(hand_type, sorted_ranks)
-        # カテゴリが存在するか確認
-        if category not in HAND_CATEGORIES_27SD:
-             print(f"Warning: Unknown category '{category}' generated for hand {kept_cards_list}")
-             # 不明なカテゴリは確率0として扱うか、エラーにするか
-             # ここでは確率0とする
-             probs = {cat: 0.0 for cat in HAND_CATEGORIES_27SD}
-        else:
-             probs = {cat: 1.0 if cat == category else 0.0 for cat in HAND_CATEGORIES_27SD}
-        # 順序通りにソートして返す
-        return dict(sorted(probs.items(), key=lambda item: HAND_CATEGORY_ORDER.get(item[0], float('inf'))))
-
-
-    num_to_draw = 5 - num_kept
-    category_counts = Counter()
-    available_deck_list = list(available_deck)
-
-    if len(available_deck_list) < num_to_draw:
-        return {'error': f'Not enough cards in deck to draw {num_to_draw}'}
-
-    # 全組み合わせを計算
-    possible_draw_combinations = list(combinations(available_deck_list, num_to_draw))
-    total_possible_outcomes = len(possible_draw_combinations)
-
-    # シミュレーション回数を決定 (全組み合わせが少ない場合は全通り計算)
-    actual_simulations = min(num_simulations, total_possible_outcomes)
-
-    if actual_simulations == 0:
-         return {'error': 'No possible draws'} # ドローできる組み合わせがない
-
-    # サンプリングするか全通り計算するか
-    if total_possible_outcomes > num_simulations * 1.5: # 全通りがシミュレーション回数よりかなり多い場合サンプリング
-        simulation_combinations = random.sample(possible_draw_combinations, actual_simulations)
-        total_outcomes_for_prob = actual_simulations # 確率計算の分母
-        print(f"Calculating probabilities via sampling ({actual_simulations} simulations)")
-    else:
-        simulation_combinations = possible_draw_combinations
-        total_outcomes_for_prob = total_possible_outcomes # 確率計算の分母
-        print(f"Calculating probabilities via full enumeration ({total_possible_outcomes} combinations)")
-
-
-    for drawn_cards in simulation_combinations:
-        final_hand = kept_cards_list + list(drawn_cards)
-        if len(final_hand) == 5:
-            hand_type, sorted_ranks = evaluate_27sd_hand(final_hand)
-            if hand_type == 'Invalid': continue # 評価不能なハンドはスキップ
-            category = get_hand_category(hand_type, sorted_ranks)
-            # カテゴリが存在するか確認
-            if category in HAND_CATEGORIES_27SD:
-                 category_counts[category] += 1
-            else:
-                 print(f"Warning: Unknown category '{category}' generated for hand {final_hand}")
-
-
-    # 確率を計算 (カテゴリリストにあるもののみ)
-    probabilities = {cat: category_counts[cat] / total_outcomes_for_prob for cat in HAND_CATEGORIES_27SD}
-    # 順序通りにソートして返す
+# --- 確率 ---
+def _sorted_probabilities(probabilities):
+    """確率の辞書をカテゴリの表示順に並べる"""
     return dict(sorted(probabilities.items(), key=lambda item: HAND_CATEGORY_ORDER.get(item[0], float('inf'))))
 
 
-# --- 2-7SD ハンド比較関数 (変更なし) ---
+# --- 2-7SD ハンド比較関数 (evaluator のラッパー) ---
+def _eval_to_strength(hand_eval):
+    """(hand_type, sorted_numeric_ranks) を evaluator の strength に変換する"""
+    hand_type, ranks = hand_eval
+    if hand_type == "No Pair":
+        category = ranks[0] - 7 # '7' -> 7-High (0)
+    elif hand_type in HAND_CATEGORY_ORDER:
+        category = HAND_CATEGORY_ORDER[hand_type]
+    else:
+        return float('inf') # 評価不能なハンドは最弱
+    return strength_from_eval(category, ranks)
+
 def compare_27sd_hands(hand1_eval, hand2_eval):
     """
     2つの2-7SDハンド評価結果を比較し、hand1が勝てば1、hand2が勝てば-1、引き分けなら0を返す。
@@ -230,237 +191,783 @@ def compare_27sd_hands(hand1_eval, hand2_eval):
 
     # ハンドタイプが存在しない、またはランク情報がない場合は比較不能
     if not type1 or not ranks1 or not type2 or not ranks2:
-        # エラーとして扱うか、特定の値を返す (例: 比較不能を示す None や 例外)
         # ここでは仮に 0 (引き分け扱い) とするが、要検討
-        print(f"Warning: Cannot compare invalid hands: {hand1_eval} vs {hand2_eval}")
+        logger.warning("Cannot compare invalid hands: %s vs %s", hand1_eval, hand2_eval)
         return 0
 
-    # ハンドタイプの強さ順序 (弱い方から強い方へ)
-    # 注意: 2-7SDでは No Pair が最も強く、ペア系やストレート/フラッシュは弱い
-    # HAND_CATEGORIES_27SD を利用 (ただし、これは表示用カテゴリ名)
-    # 比較用の内部的な強さ順序を定義
-    strength_map = {
-        "No Pair": 0,
-        "One Pair": 1,
-        "Two Pair": 2,
-        "Three of a Kind": 3,
-        "Bad Hand (Straight/Flush)": 4, # ストレートとフラッシュは同等
-        "Full House": 5,
-        "Four of a Kind": 6,
-        "Invalid": float('inf') # 評価不能なハンドは最弱
+    # strength は小さい方が強い
+    strength1 = _eval_to_strength(hand1_eval)
+    strength2 = _eval_to_strength(hand2_eval)
+    return (strength1 < strength2) - (strength1 > strength2)
+
+
+# --- 勝率計算関数 (ドロー考慮) ---
+WIN_RATE_KEYS = ('player1_wins', 'player2_wins', 'ties')
+
+def _win_rate_result(p1_wins, p2_wins, ties):
+    """サンプリング結果の勝ち・負け・引き分け回数から勝率の辞書を作る (95%信頼区間つき)"""
+    total_valid_simulations = p1_wins + p2_wins + ties
+    return {
+        'player1_wins': p1_wins / total_valid_simulations,
+        'player2_wins': p2_wins / total_valid_simulations,
+        'ties': ties / total_valid_simulations,
+        'simulations': total_valid_simulations,
+        'method': 'sampling',
+        'confidence_intervals': intervals((p1_wins, p2_wins, ties), total_valid_simulations, WIN_RATE_KEYS),
     }
 
-    strength1 = strength_map.get(type1, float('inf'))
-    strength2 = strength_map.get(type2, float('inf'))
-
-    # ハンドタイプで比較 (数値が小さい方が強い)
-    if strength1 < strength2:
-        return 1 # hand1 の勝ち
-    if strength1 > strength2:
-        return -1 # hand2 の勝ち
-
-    # --- ハンドタイプが同じ場合、ランクで比較 ---
-    # No Pair の場合: 数字が小さい方が強い (例: 7-5-4-3-2 > 8-5-4-3-2)
-    if type1 == "No Pair":
-        # ranks1, ranks2 は数値のリスト (降順ソート済み)
-        for r1, r2 in zip(ranks1, ranks2):
-            if r1 < r2:
-                return 1 # hand1 の勝ち (数字が小さい)
-            if r1 > r2:
-                return -1 # hand2 の勝ち (数字が小さい)
-        return 0 # 引き分け
-
-    # ペア系、ストレート/フラッシュの場合: 数字が大きい方が強い (通常のポーカーと同じ kicker 勝負)
-    # (ただし、これらのハンドはNo Pairより弱い)
+def _category_result(category_counts, total, win_rates):
+    """
+    同じ試行列から数えたカテゴリ別回数を確率と統計情報にする。
+    統計情報は {'method', 'trials', 'confidence_intervals' (カテゴリ -> 95%信頼区間), 'stopped_by' (停止規則つきの場合)}。
+    """
+    probabilities = {cat: int(category_counts[i]) / total for i, cat in enumerate(HAND_CATEGORIES_27SD)}
+    stats = {'method': win_rates['method'], 'trials': total}
+    if win_rates['method'] == 'exact':
+        stats['confidence_intervals'] = exact_intervals(probabilities)
     else:
-        # ranks1, ranks2 は数値のリスト (降順ソート済み)
-        for r1, r2 in zip(ranks1, ranks2):
-            if r1 > r2:
-                return 1 # hand1 の勝ち (数字が大きい)
-            if r1 < r2:
-                return -1 # hand2 の勝ち (数字が大きい)
-        return 0 # 引き分け
+        stats['confidence_intervals'] = intervals(category_counts, total, HAND_CATEGORIES_27SD)
+    if 'stopped_by' in win_rates:
+        stats['stopped_by'] = win_rates['stopped_by']
+    return {'probabilities': _sorted_probabilities(probabilities), 'probability_stats': stats}
 
+def _player_category_result(kept_ids, opponent_ids, category_counts, total, win_rates):
+    """
+    1 人分のカテゴリ確率と統計情報。サンプリングした場合は、カテゴリ分布テーブルがあれば
+    相手の保持カードを除いたデッキからのドローとして厳密な確率を引く (method は 'table')。
+    全列挙した場合と、テーブルがない・引けない (5 枚保持など) 場合は同じ試行列から数えた回数を使う。
+    """
+    if win_rates['method'] != 'exact' and category_table is not None:
+        table_result = category_table.category_counts(kept_ids, opponent_ids)
+        if table_result is not None:
+            table_counts, num_combinations = table_result
+            method_count.inc(calculation='probabilities', method='table')
+            probabilities = {cat: table_counts[i] / num_combinations for i, cat in enumerate(HAND_CATEGORIES_27SD)}
+            stats = {'method': 'table', 'trials': num_combinations, 'confidence_intervals': exact_intervals(probabilities)}
+            return {'probabilities': _sorted_probabilities(probabilities), 'probability_stats': stats}
+    return _category_result(category_counts, total, win_rates)
+
+@phase_seconds.timed(phase='win_rate')
+def calculate_spot_outcomes(p1_kept, p2_kept, num_simulations=10000, method='auto', engine='python',
+                            parallel=False, seed=None, target_se=None, time_budget=None, progress=None):
+    """
+    各プレイヤーが指定カードを持ち、残りをドローした後の勝率・両プレイヤーの最終ハンドのカテゴリ確率・ハンド例を
+    1 つの試行列 (または 1 回の全列挙) からまとめて計算する。
+    確率と勝率は同じ試行 (共通乱数) から得られるので互いに整合し、評価は 1 試行あたり 2 回で済む。
+    ただしサンプリングする場合、各プレイヤーの確率はカテゴリ分布テーブルがあればそこから厳密な値を引く。
+    method: 'exact' (全通り列挙), 'sampling' (モンテカルロ), 'auto' (組み合わせ数の見積もりで選択)
+    engine: サンプリング時のエンジン ('python' または 'numpy')
+    parallel: True ならプロセスプールでシャードごとに並列実行する (numpy エンジンを使用)
+    seed: 乱数のシード (同じシード・エンジンなら同じ結果になる。numpy エンジンはワーカー数にも依存しない)
+    target_se / time_budget (秒): 指定するとどちらかを満たすか num_simulations 回に達するまで
+    バッチでサンプリングを続ける (numpy エンジンを使用)
+    progress: 指定するとサンプリング中に progress(完了した試行数, 全試行数, (P1勝ち, P2勝ち, 引き分け)) を呼ぶ
+    戻り値: {'win_rates': 勝率, 'player1' / 'player2': {'probabilities', 'probability_stats'},
+             'example': (P1 の 5 枚, P2 の 5 枚) の ID リスト} (エラー時は {'error': ...})
+    """
+    if method not in ('auto', 'exact', 'sampling'):
+        return {'error': f'Unknown method: {method}'}
+    if engine not in ENGINES:
+        return {'error': f'Unknown engine: {engine}'}
+
+    # 整数IDで扱う (評価は evaluator のテーブル参照)
+    p1_kept_ids = sorted(card_to_id(card) for card in p1_kept)
+    p2_kept_ids = sorted(card_to_id(card) for card in p2_kept)
+    initial_deck = frozenset(range(52)) - set(p1_kept_ids) - set(p2_kept_ids)
+    num_to_draw_p1 = 5 - len(p1_kept_ids)
+    num_to_draw_p2 = 5 - len(p2_kept_ids)
 
-# --- 勝率計算関数 (ドロー考慮) ---
-def calculate_post_draw_win_rate(p1_kept, p2_kept, num_simulations=10000):
+    if len(initial_deck) < num_to_draw_p1 + num_to_draw_p2:
+        invalid_count.inc()
+        return {'error': 'デッキの残りが少なく、シミュレーションできません'}
+
+    seed = new_seed() if seed is None else seed
+    # 組み合わせ数が少なければ全通り列挙 (結果は毎回同じで、サンプリング誤差もない)
+    if method == 'exact' or (method == 'auto' and estimate_exact_cost(p1_kept_ids, p2_kept_ids) <= EXACT_COST_LIMIT):
+        logger.debug("Calculating win rate via exact enumeration")
+        p1_wins, p2_wins, ties, p1_categories, p2_categories = exact_spot_counts(p1_kept_ids, p2_kept_ids)
+        win_rates = exact_result(p1_wins, p2_wins, ties)
+        # ハンド例だけは 1 試行分引く
+        example = simulate_spot_python(p1_kept_ids, p2_kept_ids, 1, random.Random(seed))[5]
+
+    elif target_se is not None or time_budget is not None:
+        rng = np.random.default_rng(seed)
+        last_example = []
+        def batch(n):
+            result = simulate_spot_counts(p1_kept_ids, p2_kept_ids, n, rng)
+            last_example[:] = [result[5]]
+            return list(result[:3]) + list(result[3]) + list(result[4])
+        counts, trials, stopped_by = run_adaptive(
+            batch, num_simulations, target_se=target_se, time_budget=time_budget,
+            on_batch=(lambda counts, trials: progress(trials, num_simulations, tuple(counts[:3]))) if progress else None)
+        logger.debug("Adaptive win rate simulation finished (%d runs, stopped by %s)", trials, stopped_by)
+        p1_wins, p2_wins, ties = counts[:3]
+        p1_categories = counts[3:3 + NUM_CATEGORIES]
+        p2_categories = counts[3 + NUM_CATEGORIES:]
+        example = last_example[0]
+        win_rates = _win_rate_result(p1_wins, p2_wins, ties)
+        win_rates.update({'method': 'adaptive', 'seed': seed, 'stopped_by': stopped_by})
+
+    elif engine == 'numpy' or parallel:
+        logger.debug("Starting vectorized win rate simulation (%d runs, parallel=%s)", num_simulations, parallel)
+        p1_wins, p2_wins, ties, p1_categories, p2_categories, example, shards = sharded_spot_counts(
+            p1_kept_ids, p2_kept_ids, num_simulations, seed, parallel, progress)
+        win_rates = _win_rate_result(p1_wins, p2_wins, ties)
+        win_rates.update({'seed': seed, 'shards': shards})
+
+    else:
+        logger.debug("Starting win rate simulation (%d runs, P1 draws %d, P2 draws %d, deck %d)",
+                     num_simulations, num_to_draw_p1, num_to_draw_p2, len(initial_deck))
+        # 進捗の通知先がなければ試行ループの中では何も呼ばない
+        report = (lambda done, counts: progress(done, num_simulations, counts)) if progress else None
+        p1_wins, p2_wins, ties, p1_categories, p2_categories, example = simulate_spot_python(
+            p1_kept_ids, p2_kept_ids, num_simulations, random.Random(seed),
+            progress=report, progress_interval=max(1, num_simulations // 20)) # 5%ごとに通知
+        win_rates = _win_rate_result(p1_wins, p2_wins, ties)
+        win_rates['seed'] = seed
+
+    total = p1_wins + p2_wins + ties
+    method_count.inc(calculation='win_rate', method=win_rates['method'])
+    trial_count.inc(total, calculation='win_rate', method=win_rates['method'])
+    return {
+        'win_rates': win_rates,
+        'player1': _player_category_result(p1_kept_ids, p2_kept_ids, p1_categories, total, win_rates),
+        'player2': _player_category_result(p2_kept_ids, p1_kept_ids, p2_categories, total, win_rates),
+        'example': example,
+    }
+
+def calculate_post_draw_win_rate(p1_kept, p2_kept, num_simulations=10000, method='auto', engine='python',
+                                 parallel=False, seed=None, target_se=None, time_budget=None, progress=None):
     """
     各プレイヤーが指定カードを持ち、残りをドローした後の勝率を計算する。
+    引数は calculate_spot_outcomes と同じ。
     """
-    p1_wins = 0
-    p2_wins = 0
-    ties = 0
-    invalid_sims = 0
+    outcomes = calculate_spot_outcomes(p1_kept, p2_kept, num_simulations, method, engine, parallel, seed,
+                                       target_se, time_budget, progress)
+    if 'error' in outcomes:
+        return outcomes
+    return outcomes['win_rates']
 
-    p1_kept_set = set(p1_kept)
-    p2_kept_set = set(p2_kept)
-    initial_deck = FULL_DECK - p1_kept_set - p2_kept_set
-    num_to_draw_p1 = 5 - len(p1_kept_set)
-    num_to_draw_p2 = 5 - len(p2_kept_set)
 
-    if len(initial_deck) < num_to_draw_p1 + num_to_draw_p2:
+# --- 局面の計算 ---
+def calculate_spot(p1_cards, p2_cards, engine='python', num_simulations=10000, parallel=False, seed=None,
+                   target_se=None, time_budget=None, progress=None):
+    """
+    両プレイヤーの保持カード (文字列の frozenset) から確率・勝率・ハンド例をまとめて計算し、
+    /api/calculate のレスポンス形式の辞書を返す。
+    確率・勝率・ハンド例は calculate_spot_outcomes の 1 つの試行列 (または全列挙) から得る。
+    progress は勝率のサンプリングの進捗通知 (calculate_spot_outcomes を参照)。
+    """
+    outcomes = calculate_spot_outcomes(p1_cards, p2_cards, num_simulations=num_simulations, engine=engine,
+                                       parallel=parallel, seed=seed, target_se=target_se,
+                                       time_budget=time_budget, progress=progress)
+    if 'error' in outcomes:
+        return {
+            'player1': {'final_hand': sorted(p1_cards, key=lambda c: RANK_MAP.get(c[:-1], 0)), 'hand_name': 'N/A',
+                        'probabilities': {}, 'probability_stats': {}},
+            'player2': {'final_hand': sorted(p2_cards, key=lambda c: RANK_MAP.get(c[:-1], 0)), 'hand_name': 'N/A',
+                        'probabilities': {}, 'probability_stats': {}},
+            'win_rates': outcomes,
+            'win_rate_error': outcomes['error'],
+        }
+
+    # --- 結果の整形 ---
+    response_data = {'win_rates': outcomes['win_rates']}
+    with phase_seconds.time(phase='example_hands'):
+        for player, example_ids in zip(('player1', 'player2'), outcomes['example']):
+            # 試行列の中のハンド例 (表示用) を評価してハンド名を取得
+            example_hand = [id_to_card(cid) for cid in example_ids]
+            hand_type, sorted_ranks = evaluate_27sd_hand(example_hand)
+            response_data[player] = {
+                # ハンド例をソートして見やすくする
+                'final_hand': sorted(example_hand, key=lambda c: RANK_MAP.get(c[:-1], 0)),
+                'hand_name': get_hand_category(hand_type, sorted_ranks),
+                'probabilities': outcomes[player]['probabilities'],
+                'probability_stats': outcomes[player]['probability_stats'],
+            }
+    return response_data
+
+@phase_seconds.timed(phase='multiway')
+def calculate_multiway_equity(kept_cards_list, num_simulations=10000, engine='python', parallel=False, seed=None):
+    """
+    2〜6 人のプレイヤーがそれぞれ指定カードを持ち、残りをドローした後の勝率をシミュレートする。
+    kept_cards_list はプレイヤーごとの保持カード (文字列) の集まりのリスト。
+    各プレイヤーの win (単独勝ち), split (引き分けでポットを分け合う), equity (獲得ポットの期待値) の割合を返す。
+    """
+    if engine not in ENGINES:
+        return {'error': f'Unknown engine: {engine}'}
+    kept_ids = [sorted(card_to_id(card) for card in kept) for kept in kept_cards_list]
+    num_to_draw = sum(5 - len(kept) for kept in kept_ids)
+    if NUM_CARDS - sum(len(kept) for kept in kept_ids) < num_to_draw:
+        invalid_count.inc()
         return {'error': 'デッキの残りが少なく、シミュレーションできません'}
 
-    print(f"Starting win rate simulation ({num_simulations} runs)...")
-    print(f"P1 keeps: {p1_kept}, needs {num_to_draw_p1}")
-    print(f"P2 keeps: {p2_kept}, needs {num_to_draw_p2}")
-    print(f"Deck size for drawing: {len(initial_deck)}")
-
-
-    for i in range(num_simulations):
-        if i % (num_simulations // 10) == 0 and i > 0: # 進捗表示 (10%ごと)
-             print(f"... {i}/{num_simulations} simulations done")
-
-        available_deck_list = list(initial_deck) # 各シミュレーションでデッキをコピー
-
-        # プレイヤー1のドロー
-        p1_final_hand_list = draw_cards(p1_kept_set, num_to_draw_p1, available_deck_list)
-        if p1_final_hand_list is None: # ドロー失敗
-             invalid_sims += 1
-             continue
-        p1_final_hand = tuple(p1_final_hand_list) # 評価関数はリストを受け取るが、内部で使うためタプルに
-        
-        # P1が引いたカードをデッキから除く
-        drawn_by_p1 = set(p1_final_hand) - p1_kept_set
-        available_deck_after_p1_draw = initial_deck - drawn_by_p1
-
-        # プレイヤー2のドロー
-        p2_final_hand_list = draw_cards(p2_kept_set, num_to_draw_p2, available_deck_after_p1_draw)
-        if p2_final_hand_list is None: # ドロー失敗
-             invalid_sims += 1
-             continue
-        p2_final_hand = tuple(p2_final_hand_list)
-
-        # ハンド評価と勝敗判定
-        p1_eval = evaluate_27sd_hand(list(p1_final_hand)) # 評価関数はリストを期待
-        p2_eval = evaluate_27sd_hand(list(p2_final_hand)) # 評価関数はリストを期待
-
-        # 評価結果が不正でないかチェック
-        if p1_eval[0] == 'Invalid' or p2_eval[0] == 'Invalid':
-             invalid_sims += 1
-             continue
-
-        result = compare_27sd_hands(p1_eval, p2_eval)
-        if result == 1:
-            p1_wins += 1
-        elif result == -1:
-            p2_wins += 1
-        else:
-            ties += 1
+    seed = new_seed() if seed is None else seed
+    logger.debug("Starting %d-player simulation (%d runs, engine=%s)", len(kept_ids), num_simulations, engine)
+    trial_count.inc(num_simulations, calculation='multiway', method='sampling')
+    result = {'simulations': num_simulations, 'method': 'sampling', 'seed': seed}
+    if engine == 'numpy' or parallel:
+        wins, splits, shares, shards = sharded_multiway_counts(kept_ids, num_simulations, seed, parallel)
+        result['shards'] = shards
+    else:
+        wins, splits, shares = simulate_multiway_python(kept_ids, num_simulations, random.Random(seed))
+    result['players'] = [{
+        'win': int(wins[i]) / num_simulations,
+        'split': int(splits[i]) / num_simulations,
+        'equity': float(shares[i]) / num_simulations,
+        'win_confidence_interval': list(wilson_interval(int(wins[i]), num_simulations)),
+    } for i in range(len(kept_ids))]
+    return result
+
+@phase_seconds.timed(phase='range_equity')
+def calculate_range_spot(p1_ids, weights, num_simulations=10000, seed=None):
+    """
+    P1 の保持カード (ID) と相手のレンジ (range_equity.parse_range の結果) の勝率・カテゴリ確率・ハンド例を計算し、
+    calculate_spot と同じ形式の辞書を返す。確率と勝率はレンジの組み合わせ数で重み付けした平均。
+    ハンド例は最も重いバケットの代表の保持カードで 1 試行分引く。
+    """
+    seed = new_seed() if seed is None else seed
+    result = range_equity(p1_ids, weights, num_simulations=num_simulations, seed=seed)
+    logger.debug("Range equity finished (%d combos in %d buckets, %d exact)",
+                 result['combos'], result['buckets'], result['exact_buckets'])
+    method_count.inc(calculation='win_rate', method='range')
+    win_rates = {key: result[key] for key in ('player1_wins', 'player2_wins', 'ties', 'equity', 'equity_interval',
+                                              'combos', 'buckets', 'exact_buckets')}
+    win_rates.update({'method': 'range', 'seed': seed})
+    example = simulate_spot_python(sorted(p1_ids), result['example_keep'], 1, random.Random(seed))[5]
+
+    response_data = {'win_rates': win_rates}
+    for player, example_ids, categories in zip(('player1', 'player2'), example,
+                                               (result['player1_categories'], result['player2_categories'])):
+        example_hand = [id_to_card(cid) for cid in example_ids]
+        hand_type, sorted_ranks = evaluate_27sd_hand(example_hand)
+        response_data[player] = {
+            'final_hand': sorted(example_hand, key=lambda c: RANK_MAP.get(c[:-1], 0)),
+            'hand_name': get_hand_category(hand_type, sorted_ranks),
+            'probabilities': _sorted_probabilities(dict(zip(HAND_CATEGORIES_27SD, categories))),
+            'probability_stats': {'method': 'range'},
+        }
+    return response_data
+
+def relabel_response(response_data, perm):
+    """レスポンス内のハンド例のスートを perm (スート番号の置換) で付け替える"""
+    for player in ('player1', 'player2'):
+        hand = response_data.get(player, {}).get('final_hand')
+        if hand:
+            relabeled = [id_to_card(cid) for cid in relabel_ids([card_to_id(card) for card in hand], perm)]
+            response_data[player]['final_hand'] = sorted(relabeled, key=lambda c: RANK_MAP.get(c[:-1], 0))
+    return response_data
+
+
+# --- リクエストの検証 ---
+def parse_calculation_options(data):
+    """計算オプションを検証し、(オプションの辞書, エラーメッセージ) を返す (正常ならエラーは None)"""
+    engine = data.get('engine', 'python')
+    num_simulations = data.get('num_simulations', 10000)
+    parallel = data.get('parallel', False)
+    seed = data.get('seed')
+    target_se = data.get('target_se')
+    time_budget_ms = data.get('time_budget_ms')
+
+    if engine not in ENGINES:
+        return None, f'無効なエンジン: {engine}'
+    if not isinstance(num_simulations, int) or isinstance(num_simulations, bool) or not 1 <= num_simulations <= MAX_SIMULATIONS:
+        return None, f'シミュレーション回数は1〜{MAX_SIMULATIONS}の整数で指定してください'
+    if not isinstance(parallel, bool):
+        return None, 'parallel は true/false で指定してください'
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool) or seed < 0):
+        return None, 'seed は0以上の整数で指定してください'
+    if target_se is not None and (not isinstance(target_se, (int, float)) or isinstance(target_se, bool) or not 0 < target_se < 0.5):
+        return None, 'target_se は0より大きく0.5未満の数値で指定してください'
+    if time_budget_ms is not None and (not isinstance(time_budget_ms, int) or isinstance(time_budget_ms, bool) or time_budget_ms <= 0):
+        return None, 'time_budget_ms は正の整数で指定してください'
+    return {
+        'engine': engine,
+        'num_simulations': num_simulations,
+        'parallel': parallel,
+        'seed': seed,
+        'target_se': target_se,
+        'time_budget_ms': time_budget_ms,
+    }, None
+
+def parse_players(players_input):
+    """各プレイヤーのカードのリストを検証し、(プレイヤーごとの ID 集合のリスト, エラーメッセージ) を返す"""
+    if not all(isinstance(cards, list) for cards in players_input):
+        return None, '手札はカードのリストで指定してください'
+    if any(len(cards) > 5 for cards in players_input):
+        return None, '各プレイヤーの手札は最大5枚までです'
+    invalid_cards = {str(card) for cards in players_input for card in cards
+                     if not isinstance(card, str) or not validate_card(card)}
+    if invalid_cards:
+        return None, f'無効なカード形式: {", ".join(sorted(invalid_cards))}'
+
+    # 整数IDで重複を確認 (大文字小文字違いの同じカードなども含む)
+    id_sets = [{card_to_id(card) for card in cards} for cards in players_input]
+    seen = set()
+    for ids in id_sets:
+        if seen & ids:
+            return None, 'プレイヤー間で同じカードが選択されています'
+        seen |= ids
+    return id_sets, None
+
+def parse_matchup(p1_cards_input, p2_cards_input):
+    """両プレイヤーのカードを検証し、(P1 の ID 集合, P2 の ID 集合, エラーメッセージ) を返す"""
+    id_sets, error = parse_players([p1_cards_input, p2_cards_input])
+    if error:
+        return None, None, error
+    return id_sets[0], id_sets[1], None
+
+
+# --- キャッシュを通した計算 ---
+def _result_engine(options):
+    """結果を決めるエンジン (parallel なら python を指定しても numpy エンジンで計算する。numpy はワーカー数に依存しない)"""
+    return 'numpy' if options['parallel'] else options['engine']
+
+def spot_cache_key(canonical_p1, canonical_p2, options):
+    return json.dumps([ENGINE_VERSION, canonical_p1, canonical_p2, _result_engine(options), options['num_simulations'],
+                       options['seed'], options['target_se'], options['time_budget_ms']])
+
+def range_cache_key(canonical_p1, range_expression, options):
+    return json.dumps([ENGINE_VERSION, 'range', canonical_p1, range_expression, options['num_simulations'],
+                       options['seed']])
+
+def derive_seed(cache_key):
+    """
+    seed を省略したリクエストのシード。キャッシュキーから決まるので、同じ入力なら常に同じ結果になる
+    (JavaScript の数値で正確に扱えるよう 48 ビット)。
+    """
+    return int.from_bytes(hashlib.sha256(cache_key.encode()).digest()[:6], 'big')
 
-    total_valid_simulations = p1_wins + p2_wins + ties
-    print(f"Simulation finished. Valid runs: {total_valid_simulations}, Invalid runs: {invalid_sims}")
+def response_etag(cache_key, perm, timed=False):
+    """
+    /api/calculate のレスポンスの ETag (timed、つまり結果が時間で変わる計算の場合は None)。
+    キャッシュキー (正規形の入力・オプション・シード・ENGINE_VERSION) と、ハンド例を元のスートに戻す置換から決まる。
+    """
+    if timed:
+        return None
+    return hashlib.sha256(json.dumps([cache_key, list(perm)]).encode()).hexdigest()[:32]
 
-    if total_valid_simulations == 0:
-        # 有効なシミュレーションが0回の場合
-        if invalid_sims > 0:
-             return {'error': f'All simulations resulted in invalid draws ({invalid_sims} attempts). Check deck logic.'}
-        else:
-             return {'player1_wins': 0, 'player2_wins': 0, 'ties': 0, 'simulations': 0}
+def _calculate_coalesced(cache_key, compute):
+    """
+    キャッシュを引き、なければ実行中の同じ計算にまとめて compute() を呼び、(レスポンス, キャッシュの状態) を返す。
+    キャッシュの状態は 'HIT' / 'MISS' / 'COALESCED' (実行中の同じ計算を待って結果を共有した)。
+    エラーを含むレスポンスはキャッシュしない (まとめた呼び出し元には同じレスポンスを返す)。
+    """
+    response_data = result_cache.get(cache_key)
+    if response_data is not None:
+        return response_data, 'HIT'
+
+    def run():
+        if inflight.lock_dir:
+            # 他のワーカーがロックを持って計算していた場合は、その結果が共有キャッシュに入っている
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                return json.dumps(cached), 'HIT'
+        response_data = compute()
+        if 'error' not in response_data and 'win_rate_error' not in response_data:
+            result_cache.put(cache_key, response_data)
+        return json.dumps(response_data), 'MISS'
+
+    (text, cache_status), shared = inflight.do(cache_key, run)
+    if shared:
+        coalesced_count.inc()
+        cache_status = 'COALESCED'
+    # 呼び出し側で relabel_response などで書き換えても互いに影響しないよう、それぞれ別のオブジェクトにする
+    return json.loads(text), cache_status
+
+def calculate_canonical_range_spot(canonical_p1, range_expression, weights, options):
+    """正規形の P1 の保持カードとレンジの局面をキャッシュを通して計算し、(レスポンス, キャッシュの状態) を返す"""
+    cache_key = range_cache_key(canonical_p1, range_expression, options)
+    seed = derive_seed(cache_key) if options['seed'] is None else options['seed']
+    return _calculate_coalesced(cache_key, lambda: calculate_range_spot(
+        canonical_p1, weights, num_simulations=options['num_simulations'], seed=seed))
+
+def calculate_canonical_spot(canonical_p1, canonical_p2, options, progress=None):
+    """
+    正規形 (canonicalize の結果) の局面をキャッシュを通して計算し、(レスポンス, キャッシュの状態) を返す
+    (_calculate_coalesced を参照)。seed を省略した場合は derive_seed のシードを使う。
+    ハンド例のスートは正規形のままなので、呼び出し側で relabel_response する。
+    progress は実際に計算する呼び出しでのみ呼ばれる (実行中の計算を待つ側には進捗は届かない)。
+    """
+    cache_key = spot_cache_key(canonical_p1, canonical_p2, options)
+    seed = derive_seed(cache_key) if options['seed'] is None else options['seed']
+    time_budget_ms = options['time_budget_ms']
+    return _calculate_coalesced(cache_key, lambda: calculate_spot(
+        frozenset(id_to_card(cid) for cid in canonical_p1),
+        frozenset(id_to_card(cid) for cid in canonical_p2),
+        engine=options['engine'], num_simulations=options['num_simulations'], parallel=options['parallel'],
+        seed=seed, target_se=options['target_se'],
+        time_budget=time_budget_ms / 1000 if time_budget_ms is not None else None, progress=progress))
+
+def _not_modified(etag):
+    """If-None-Match が ETag と一致したときの 304 レスポンス"""
+    not_modified_count.inc()
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# --- 計測 ---
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+    if PROFILE_DIR and request.headers.get('X-Profile'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def _record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        # ジョブのスレッドやストリーミング中の計算は含まれない (このリクエストのスレッドの処理のみ)
+        profiler.disable()
+        filename = f"{request.endpoint or 'unmatched'}-{time.time_ns()}.prof"
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+        response.headers['X-Profile-File'] = filename
+    start = g.request_start
+    labels = {'endpoint': endpoint, 'method': request.method, 'status': response.status_code}
+    def record():
+        request_seconds.observe(time.perf_counter() - start, **labels)
+        metrics.flush(min_interval=METRICS_FLUSH_SECONDS)
+    if response.is_streamed:
+        # NDJSON・SSE は本文を返しながら計算するので、ストリームを閉じたときに記録する
+        response.call_on_close(record)
+    else:
+        record()
+    return response
 
+@app.route('/api/ready', methods=['GET'])
+def ready_api():
+    """テーブルの準備ができていれば 200、まだなら 503 を返す (ロードバランサーのヘルスチェック用)"""
+    status = tables.status()
+    status['category_table'] = category_table.path if category_table is not None else None
+    return jsonify(status), 200 if status['ready'] else 503
 
-    return {
-        'player1_wins': p1_wins / total_valid_simulations,
-        'player2_wins': p2_wins / total_valid_simulations,
-        'ties': ties / total_valid_simulations,
-        'simulations': total_valid_simulations
-    }
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    """計測値を Prometheus のテキスト形式で返す"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 # --- 新しいAPIエンドポイント ---
 @app.route('/api/calculate', methods=['POST'])
 def calculate_api():
+    """
+    両プレイヤーの保持カードから確率・勝率・ハンド例を計算する。
+    player2_cards の代わりに player2_range (レンジ表記、range_equity を参照) を指定すると、
+    相手のレンジ全体に対する勝率を計算する (engine / parallel / target_se / time_budget_ms は使わない)。
+    結果は入力とシード (省略時は入力から決まる) で決まるので、レスポンスにその ETag をつけ、
+    If-None-Match が一致すれば計算せずに 304 を返す (time_budget_ms を指定した場合を除く)。
+    同じ局面の計算が実行中なら、それを待って結果を共有する (X-Cache: COALESCED)。
+    """
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': 'リクエストは JSON オブジェクトで指定してください'}), 400
     try:
-        data = request.json
-        p1_cards_input = data.get('player1_cards', [])
-        p2_cards_input = data.get('player2_cards', [])
-
-        # 入力バリデーション
-        if len(p1_cards_input) > 5 or len(p2_cards_input) > 5:
-            return jsonify({'error': '各プレイヤーの手札は最大5枚までです'}), 400
-
-        # frozenset に変換して処理
-        p1_cards = frozenset(p1_cards_input)
-        p2_cards = frozenset(p2_cards_input)
-
-        all_selected_cards = p1_cards.union(p2_cards)
-        invalid_cards = [card for card in all_selected_cards if not validate_card(card)]
-        if invalid_cards:
-            return jsonify({'error': f'無効なカード形式: {", ".join(invalid_cards)}'}), 400
-
-        if len(all_selected_cards) != len(p1_cards) + len(p2_cards):
-             # このチェックは frozenset を使っているので不要 (重複は自動で除去される)
-             # ただし、p1 と p2 で同じカードが選択された場合のチェックは必要
-             if not p1_cards.isdisjoint(p2_cards):
-                  return jsonify({'error': 'プレイヤー間で同じカードが選択されています'}), 400
-
-
-        # デッキ準備 (確率計算用と勝率計算用で共有可能)
-        deck_minus_selection = FULL_DECK - all_selected_cards
-
-        # ハンド確率計算
-        print("Calculating P1 probabilities...")
-        p1_probabilities = calculate_draw_probabilities(p1_cards, deck_minus_selection)
-        print("Calculating P2 probabilities...")
-        p2_probabilities = calculate_draw_probabilities(p2_cards, deck_minus_selection)
-
-        # 勝率計算 (ドロー考慮)
-        print("Calculating win rates...")
-        win_rates = calculate_post_draw_win_rate(p1_cards, p2_cards) # 関数には set を渡す
-
-        # --- 結果の整形 ---
-        # ドロー後のハンド例を一つ生成 (表示用)
-        p1_final_hand_example_list = draw_cards(p1_cards, 5 - len(p1_cards), deck_minus_selection)
-        if p1_final_hand_example_list is None: p1_final_hand_example_list = list(p1_cards) # ドロー失敗時は保持カードのみ
-
-        deck_after_p1_draw = deck_minus_selection - (set(p1_final_hand_example_list) - p1_cards)
-        p2_final_hand_example_list = draw_cards(p2_cards, 5 - len(p2_cards), deck_after_p1_draw)
-        if p2_final_hand_example_list is None: p2_final_hand_example_list = list(p2_cards) # ドロー失敗時は保持カードのみ
-
-        # 評価とハンド名取得 (5枚揃っているか確認)
-        p1_final_eval = evaluate_27sd_hand(p1_final_hand_example_list) if len(p1_final_hand_example_list) == 5 else ('Invalid', [])
-        p2_final_eval = evaluate_27sd_hand(p2_final_hand_example_list) if len(p2_final_hand_example_list) == 5 else ('Invalid', [])
-
-        p1_hand_name = get_hand_category(p1_final_eval[0], p1_final_eval[1]) if p1_final_eval[0] != 'Invalid' else "N/A"
-        p2_hand_name = get_hand_category(p2_final_eval[0], p2_final_eval[1]) if p2_final_eval[0] != 'Invalid' else "N/A"
-
-        # ハンド例をソートして見やすくする
-        p1_final_hand_sorted = sorted(p1_final_hand_example_list, key=lambda c: RANK_MAP.get(c[:-1], 0))
-        p2_final_hand_sorted = sorted(p2_final_hand_example_list, key=lambda c: RANK_MAP.get(c[:-1], 0))
-
-
-        response_data = {
-            'player1': {
-                'final_hand': p1_final_hand_sorted,
-                'hand_name': p1_hand_name,
-                'probabilities': p1_probabilities # エラーが含まれる可能性あり
-            },
-            'player2': {
-                'final_hand': p2_final_hand_sorted,
-                'hand_name': p2_hand_name,
-                'probabilities': p2_probabilities # エラーが含まれる可能性あり
-            },
-            'win_rates': win_rates # エラーが含まれる可能性あり
-        }
-        # エラーがあればトップレベルにも追加 (フロントで扱いやすくするため)
-        if isinstance(p1_probabilities, dict) and 'error' in p1_probabilities:
-             response_data['error'] = response_data.get('error', '') + f" P1 Prob Error: {p1_probabilities['error']}"
-        if isinstance(p2_probabilities, dict) and 'error' in p2_probabilities:
-             response_data['error'] = response_data.get('error', '') + f" P2 Prob Error: {p2_probabilities['error']}"
-        if isinstance(win_rates, dict) and 'error' in win_rates:
-             response_data['win_rate_error'] = win_rates['error'] # これは専用フィールドに
-
-
-        return jsonify(response_data)
+        with phase_seconds.time(phase='validation'):
+            options, error = parse_calculation_options(data)
+            if not error and data.get('player2_range') is None:
+                p1_ids, p2_ids, error = parse_matchup(data.get('player1_cards', []), data.get('player2_cards', []))
+        if error:
+            return jsonify({'error': error}), 400
+        if data.get('player2_range') is not None:
+            return _calculate_range_response(data, options)
+
+        # スートを正規化してキャッシュを引く (スート違いの同一局面は同じ結果)
+        (canonical_p1, canonical_p2), perm = canonicalize(p1_ids, p2_ids)
+        etag = response_etag(spot_cache_key(canonical_p1, canonical_p2, options), perm,
+                             timed=options['time_budget_ms'] is not None)
+        if etag and request.if_none_match.contains_weak(etag):
+            return _not_modified(etag)
+        response_data, cache_status = calculate_canonical_spot(canonical_p1, canonical_p2, options)
+
+        # ハンド例のスートを元に戻す
+        response_data = relabel_response(response_data, invert_permutation(perm))
+        with phase_seconds.time(phase='serialization'):
+            response = jsonify(response_data)
+        response.headers['X-Cache'] = cache_status
+        if etag:
+            response.set_etag(etag)
+        return response
 
     except Exception as e:
         # より詳細なエラーログをサーバー側に出力
-        import traceback
-        print("--- Error in /api/calculate ---")
-        traceback.print_exc()
-        print("--- End Error ---")
+        logger.exception("Error in /api/calculate")
         return jsonify({'error': f'サーバー内部で予期せぬエラーが発生しました: {type(e).__name__}'}), 500
 
+def _calculate_range_response(data, options):
+    """/api/calculate の player2_range を指定した場合の処理"""
+    range_expression = data['player2_range']
+    if data.get('player2_cards'):
+        return jsonify({'error': 'player2_cards と player2_range は同時に指定できません'}), 400
+    if not isinstance(range_expression, str):
+        return jsonify({'error': 'player2_range はレンジ表記の文字列で指定してください'}), 400
+    id_sets, error = parse_players([data.get('player1_cards', [])])
+    if error:
+        return jsonify({'error': error}), 400
+    try:
+        weights = parse_range(range_expression)
+        (canonical_p1,), perm = canonicalize_players(id_sets)
+        # レンジの計算は time_budget_ms を使わないので、指定されていても ETag をつける
+        etag = response_etag(range_cache_key(canonical_p1, range_expression, options), perm)
+        if etag and request.if_none_match.contains_weak(etag):
+            return _not_modified(etag)
+        response_data, cache_status = calculate_canonical_range_spot(canonical_p1, range_expression, weights, options)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    response_data = relabel_response(response_data, invert_permutation(perm))
+    response_data['player2']['range'] = range_expression
+    with phase_seconds.time(phase='serialization'):
+        response = jsonify(response_data)
+    response.headers['X-Cache'] = cache_status
+    if etag:
+        response.set_etag(etag)
+    return response
+
+@app.route('/api/calculate/batch', methods=['POST'])
+def calculate_batch_api():
+    """
+    複数の局面をまとめて計算し、終わったものから 1 行 1 件の JSON (NDJSON) で返す。
+    リクエスト: {"items": [{"player1_cards": [...], "player2_cards": [...]}, ...], その他のオプションは全件共通}
+    各行: {"index": 入力での位置, "cache": "HIT"/"MISS"/"COALESCED", "result": /api/calculate と同じ形式}
+    同一またはスート違いで同型の局面は 1 回だけ計算し、該当する全ての index の行を続けて返す。
+    """
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': 'リクエストは JSON オブジェクトで指定してください'}), 400
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items は1件以上のリストで指定してください'}), 400
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({'error': f'items は最大{MAX_BATCH_ITEMS}件までです'}), 400
+    options, error = parse_calculation_options(data)
+    if error:
+        return jsonify({'error': error}), 400
+
+    # 計算を始める前に全件を検証し、正規形ごとにまとめる
+    groups = {} # 正規形 -> [(index, 置換), ...] (挿入順 = 最初に現れた順)
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            return jsonify({'error': f'items[{index}]: 局面はオブジェクトで指定してください'}), 400
+        p1_ids, p2_ids, error = parse_matchup(item.get('player1_cards', []), item.get('player2_cards', []))
+        if error:
+            return jsonify({'error': f'items[{index}]: {error}'}), 400
+        canonical, perm = canonicalize(p1_ids, p2_ids)
+        groups.setdefault(canonical, []).append((index, perm))
+    logger.debug("Batch: %d items, %d unique spots", len(items), len(groups))
+
+    def generate():
+        for (canonical_p1, canonical_p2), members in groups.items():
+            try:
+                response_data, cache_status = calculate_canonical_spot(canonical_p1, canonical_p2, options)
+            except Exception as e:
+                logger.exception("Error in /api/calculate/batch")
+                error_line = {'error': f'サーバー内部で予期せぬエラーが発生しました: {type(e).__name__}'}
+                for index, _ in members:
+                    yield json.dumps({'index': index, **error_line}, ensure_ascii=False) + '\n'
+                continue
+            # 同型の局面はそれぞれ元のスートに戻す (結果はこのグループの分しか保持しない)
+            text = json.dumps(response_data)
+            for index, perm in members:
+                result = relabel_response(json.loads(text), invert_permutation(perm))
+                yield json.dumps({'index': index, 'cache': cache_status, 'result': result}, ensure_ascii=False) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def _run_spot_job(job, canonical_p1, canonical_p2, perm, options):
+    """ジョブとして局面を計算する (勝率の途中経過を job に報告する)"""
+    def progress(done, total, counts):
+        partial = {'win_rates': _win_rate_result(*counts)} if sum(counts) else None
+        job.report(done / total, partial)
+    response_data, _ = calculate_canonical_spot(canonical_p1, canonical_p2, options, progress=progress)
+    return relabel_response(response_data, invert_permutation(perm))
+
+def _job_links(job):
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('job_status_api', job_id=job.id),
+        'events_url': url_for('job_events_api', job_id=job.id),
+    }
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job_api():
+    """
+    /api/calculate と同じ入力で計算をジョブとして登録し、ジョブ ID をすぐに返す。
+    進捗は GET /api/jobs/<id> または SSE の GET /api/jobs/<id>/events で取得する。
+    """
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': 'リクエストは JSON オブジェクトで指定してください'}), 400
+    options, error = parse_calculation_options(data)
+    if error:
+        return jsonify({'error': error}), 400
+    p1_ids, p2_ids, error = parse_matchup(data.get('player1_cards', []), data.get('player2_cards', []))
+    if error:
+        return jsonify({'error': error}), 400
+
+    (canonical_p1, canonical_p2), perm = canonicalize(p1_ids, p2_ids)
+    cached = result_cache.get(spot_cache_key(canonical_p1, canonical_p2, options))
+    if cached is not None:
+        job = jobs.completed(relabel_response(cached, invert_permutation(perm)))
+    else:
+        job = jobs.submit(lambda job: _run_spot_job(job, canonical_p1, canonical_p2, perm, options))
+    return jsonify(_job_links(job)), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status_api(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません (期限切れの可能性があります)'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job_api(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません (期限切れの可能性があります)'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events_api(job_id):
+    """
+    ジョブの進捗を server-sent events で配信する。
+    途中経過は 'progress' イベント、終了時は状態名 ('done', 'cancelled', 'error') のイベントを送って閉じる。
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません (期限切れの可能性があります)'}), 404
+
+    def generate():
+        version = None
+        while True:
+            new_version = job.wait_for_update(version, timeout=SSE_KEEPALIVE_SECONDS)
+            state = job.snapshot()
+            finished = state['status'] in FINISHED_STATES
+            if new_version == version and not finished:
+                yield ': keepalive\n\n'
+                continue
+            version = new_version
+            event = state['status'] if finished else 'progress'
+            yield f"event: {event}\ndata: {json.dumps(state, ensure_ascii=False)}\n\n"
+            if finished:
+                return
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/calculate/multiway', methods=['POST'])
+def calculate_multiway_api():
+    """
+    3〜6 人 (2 人も可) の勝率を計算する。
+    リクエスト: {"players": [[カード...], ...], "engine", "num_simulations", "parallel", "seed"}
+    """
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': 'リクエストは JSON オブジェクトで指定してください'}), 400
+    options, error = parse_calculation_options(data)
+    if error:
+        return jsonify({'error': error}), 400
+    players_input = data.get('players')
+    if not isinstance(players_input, list) or not 2 <= len(players_input) <= MAX_PLAYERS:
+        return jsonify({'error': f'players は2〜{MAX_PLAYERS}人分のカードのリストで指定してください'}), 400
+    id_sets, error = parse_players(players_input)
+    if error:
+        return jsonify({'error': error}), 400
+
+    # 結果はスートに依存しないので正規形でキャッシュする (プレイヤーの順序は保つ)
+    canonical, _ = canonicalize_players(id_sets)
+    cache_key = json.dumps([ENGINE_VERSION, 'multiway', canonical, _result_engine(options), options['num_simulations'],
+                            options['seed']])
+    response_data = result_cache.get(cache_key)
+    cache_status = 'HIT'
+    if response_data is None:
+        cache_status = 'MISS'
+        response_data = calculate_multiway_equity(
+            [[id_to_card(cid) for cid in ids] for ids in canonical], num_simulations=options['num_simulations'],
+            engine=options['engine'], parallel=options['parallel'], seed=options['seed'])
+        if 'error' in response_data:
+            return jsonify(response_data), 400
+        result_cache.put(cache_key, response_data)
+    for player, cards in zip(response_data['players'], players_input):
+        player['cards'] = cards
+    response = jsonify(response_data)
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+# --- ドロー選択のソルバー ---
+def _solve_draw_cached(canonical_hand, canonical_opponent, num_simulations, seed, progress=None):
+    """
+    正規形の手札・相手の保持カードで solve_draw をキャッシュを通して実行する (カードは整数 ID のまま)。
+    seed を省略した場合は derive_seed のシードを使う (キャッシュした結果と同じ入力の計算結果が一致する)。
+    """
+    cache_key = json.dumps([ENGINE_VERSION, 'solve-draw', canonical_hand, canonical_opponent, num_simulations, seed])
+    options = result_cache.get(cache_key)
+    if options is None:
+        options = solve_draw(canonical_hand, canonical_opponent, max_trials=num_simulations,
+                             seed=derive_seed(cache_key) if seed is None else seed, progress=progress)
+        result_cache.put(cache_key, options)
+    return options
+
+def _solution_response(options, perm):
+    """solve_draw の結果のカードを perm でスートを戻してカード文字列にし、レスポンスの辞書にする"""
+    def to_cards(card_ids):
+        return sorted((id_to_card(cid) for cid in relabel_ids(card_ids, perm)), key=lambda c: RANK_MAP.get(c[:-1], 0))
+    ranked = []
+    for option in options:
+        option = dict(option)
+        option['keep'] = to_cards(option['keep'])
+        option['discard'] = to_cards(option['discard'])
+        ranked.append(option)
+    return {'options': ranked, 'best': ranked[0]}
+
+@app.route('/api/solve-draw', methods=['POST'])
+def solve_draw_api():
+    """
+    配られた 5 枚 (hand) の残し方 32 通りを、相手の保持カード (opponent_cards) に対するエクイティ順に返す。
+    相手はレンジでは指定できない (/api/calculate の player2_range は 1 つの残し方に対する計算)。
+    num_simulations はサンプリングする選択肢 1 つあたりの試行数の上限。
+    async が true ならジョブとして登録し、/api/jobs と同じ形式でジョブ ID を返す。
+    """
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': 'リクエストは JSON オブジェクトで指定してください'}), 400
+    num_simulations = data.get('num_simulations', 20000)
+    seed = data.get('seed')
+    run_async = data.get('async', False)
+    if not isinstance(num_simulations, int) or isinstance(num_simulations, bool) or not 1 <= num_simulations <= MAX_SIMULATIONS:
+        return jsonify({'error': f'シミュレーション回数は1〜{MAX_SIMULATIONS}の整数で指定してください'}), 400
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool) or seed < 0):
+        return jsonify({'error': 'seed は0以上の整数で指定してください'}), 400
+    if not isinstance(run_async, bool):
+        return jsonify({'error': 'async は true/false で指定してください'}), 400
+    hand_ids, opponent_ids, error = parse_matchup(data.get('hand', []), data.get('opponent_cards', []))
+    if error:
+        return jsonify({'error': error}), 400
+    if len(hand_ids) != 5:
+        return jsonify({'error': '手札 (hand) は異なる5枚のカードで指定してください'}), 400
+
+    (canonical_hand, canonical_opponent), perm = canonicalize(hand_ids, opponent_ids)
+    inverse = invert_permutation(perm)
+    if run_async:
+        def run(job):
+            options = _solve_draw_cached(canonical_hand, canonical_opponent, num_simulations, seed,
+                                         progress=lambda fraction: job.report(fraction))
+            return _solution_response(options, inverse)
+        return jsonify(_job_links(jobs.submit(run))), 202
+    options = _solve_draw_cached(canonical_hand, canonical_opponent, num_simulations, seed)
+    return jsonify(_solution_response(options, inverse))
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats_api():
+    return jsonify(result_cache.stats())
+
 
 # --- index ルート (変更なし) ---
 @app.route('/')
@@ -474,4 +981,6 @@ def index():
 if __name__ == '__main__':
     # 本番環境では gunicorn を使うため、app.run は開発時のみ
     # Render などでは Start Command で gunicorn を指定する
+    # 計算方法の選択などの詳細は POKER_LOG_LEVEL=DEBUG で表示する
+    logging.basicConfig(level=os.environ.get('POKER_LOG_LEVEL', 'INFO'))
     app.run(debug=True) # 開発時は True のまま
@@ -0,0 +1,109 @@
+"""
+API の振る舞いの回帰チェック (Flask のテストクライアント経由)
+
+python benchmarks/api_checks.py
+
+- time_budget_ms を指定したレンジのリクエストが 200 と ETag を返し、If-None-Match で 304 になるか
+- 実行中のジョブと同じ局面の計算にまとめられた呼び出しが、そのジョブのキャンセルで失敗しないか
+不一致があれば内容を表示して終了コード 1 で終わる。
+golden.py と違い、計算結果の正しさではなくエンドポイントの応答を確かめる (bench_suite.py の計測の前には実行しない)。
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from evaluator import card_to_id
+from golden import run_checks
+
+# レンジのリクエスト (レンジの計算は time_budget_ms を使わないので ETag をつける)
+RANGE_REQUEST = {'player1_cards': ['2H', '3D', '7S'], 'player2_range': 'draw3-8', 'time_budget_ms': 100,
+                 'num_simulations': 2000, 'seed': 1}
+# キャンセルのチェックの局面 (P1 の保持カード, P2 の保持カード) とオプション
+CANCEL_SPOT = (['2H'], ['3D'])
+CANCEL_OPTIONS = {'num_simulations': 2000, 'seed': 1}
+# スレッドの待ち合わせの上限 (秒)。通常はすぐに揃うので、超えた場合はチェックの失敗として報告する
+WAIT_SECONDS = 10
+
+
+# --- チェック ---
+def check_range_etag():
+    client = app.app.test_client()
+    response = client.post('/api/calculate', json=RANGE_REQUEST)
+    if response.status_code != 200:
+        return [f"レンジのリクエストが {response.status_code} を返しました (正解 200): {response.get_json()}"]
+    etag = response.headers.get('ETag')
+    if not etag:
+        return ["レンジのリクエストのレスポンスに ETag がありません"]
+    response = client.post('/api/calculate', json=RANGE_REQUEST, headers={'If-None-Match': etag})
+    if response.status_code != 304:
+        return [f"If-None-Match が一致したレンジのリクエストが {response.status_code} を返しました (正解 304)"]
+    return []
+
+def check_coalesced_cancellation():
+    """
+    ジョブの計算を待っている /api/calculate 相当の呼び出しが、ジョブをキャンセルしても結果を受け取れるか。
+    ジョブの計算は release が立つまで止めておき、呼び出しがその完了を待ち始めてからキャンセルする (時間に依存しない)。
+    """
+    options, _ = app.parse_calculation_options(CANCEL_OPTIONS)
+    p1, p2 = ({card_to_id(card) for card in cards} for cards in CANCEL_SPOT)
+    (canonical_p1, canonical_p2), _ = app.canonicalize(p1, p2)
+    key = app.spot_cache_key(canonical_p1, canonical_p2, options)
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_job(job):
+        def compute():
+            started.set()
+            release.wait(WAIT_SECONDS)
+            job.report(0.5) # キャンセル要求があればここで JobCancelled
+        return app.inflight.do(key, compute)
+    job = app.jobs.submit(run_job)
+    if not started.wait(WAIT_SECONDS):
+        return ["ジョブの計算が始まりません"]
+
+    follower = {}
+    def calculate():
+        try:
+            follower['result'] = app.calculate_canonical_spot(canonical_p1, canonical_p2, options)
+        except Exception as e:
+            follower['error'] = e
+    thread = threading.Thread(target=calculate)
+    thread.start()
+    deadline = time.monotonic() + WAIT_SECONDS
+    while app.inflight.waiting(key) < 1 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    coalesced = app.inflight.waiting(key) == 1
+    app.jobs.cancel(job.id)
+    release.set()
+    thread.join()
+    deadline = time.monotonic() + WAIT_SECONDS
+    while not job.finished and time.monotonic() < deadline:
+        job.wait_for_update(job.version, timeout=0.1)
+
+    failures = []
+    if not coalesced:
+        failures.append("呼び出しが実行中のジョブの計算にまとめられませんでした")
+    if job.snapshot()['status'] != 'cancelled':
+        failures.append(f"ジョブの状態が {job.snapshot()['status']} です (正解 cancelled)")
+    if 'error' in follower:
+        failures.append(f"まとめられた呼び出しがジョブのキャンセルで失敗しました: {type(follower['error']).__name__}")
+    else:
+        response_data, cache_status = follower['result']
+        if 'error' in response_data or 'win_rate_error' in response_data:
+            failures.append(f"まとめられた呼び出しの結果がエラーです: {response_data}")
+        if cache_status != 'MISS':
+            failures.append(f"キャンセル後に計算し直した呼び出しのキャッシュの状態が {cache_status} です (正解 MISS)")
+    return failures
+
+CHECKS = {
+    'range_etag': check_range_etag,
+    'coalesced_cancellation': check_coalesced_cancellation,
+}
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run_checks(CHECKS) else 1)
@@ -0,0 +1,52 @@
+"""
+N 人 (2〜6 人) のドロー後勝率シミュレーションのスループット計測
+
+python benchmarks/bench_multiway.py [試行数]
+
+プレイヤー数ごとに python / numpy エンジンの 1 秒あたりの試行数と、
+1 試行 1 プレイヤーあたりの時間 (プレイヤー数に対してほぼ一定なら線形) を表示する。
+"""
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kernel import simulate_multiway
+from vectorized import simulate_multiway_counts
+
+# 各プレイヤーの保持カード (ID)。先頭から必要な人数分を使う
+KEPT = [
+    [0, 5, 10],        # 2H 3D 4S
+    [44, 45],          # KH KD
+    [12, 17, 22, 27],  # 5H 6D 7S 8C
+    [],                # 全部引く
+    [1, 6],            # 2D 3S
+    [30, 35, 40],      # 9S 10C JH
+]
+
+
+def bench(fn, num_trials):
+    start = time.perf_counter()
+    fn(num_trials)
+    return num_trials / (time.perf_counter() - start)
+
+def main(num_trials=200000):
+    print(f"{'players':>7} {'engine':>7} {'trials/s':>12} {'us/trial/player':>16}")
+    for num_players in range(2, len(KEPT) + 1):
+        kept = KEPT[:num_players]
+        engines = {
+            'python': lambda n: simulate_multiway(kept, n, random.Random(1)),
+            'numpy': lambda n: simulate_multiway_counts(kept, n, np.random.default_rng(1)),
+        }
+        for name, fn in engines.items():
+            trials = num_trials if name == 'numpy' else num_trials // 4
+            rate = bench(fn, trials)
+            print(f"{num_players:>7} {name:>7} {rate:>12,.0f} {1e6 / rate / num_players:>16.3f}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
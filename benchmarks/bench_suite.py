@@ -0,0 +1,257 @@
+"""
+評価器・確率計算・勝率計算・/api/calculate の性能計測と回帰チェック
+
+python benchmarks/bench_suite.py [--output 結果.json] [--compare 基準.json] [--threshold 0.25] [--skip-golden]
+                                 [--ignore-environment]
+
+計測項目 (いずれも固定のシード・局面で計測する):
+  evaluate_27sd_hand       1 秒あたりの評価ハンド数
+  compare_27sd_hands       1 秒あたりの比較回数
+  draw_probabilities_keepK calculate_spot_outcomes (確率・勝率の 1 パス) の所要時間 (保持枚数 K = 0〜4、ms)
+  draw_probabilities_live_keepK  同じ局面をカテゴリ分布テーブルを使わずに計算した所要時間 (ms)
+  win_rate_ENGINE          calculate_post_draw_win_rate のサンプリングの 1 秒あたりの試行数
+  multiway_ENGINE          calculate_multiway_equity (MULTIWAY_KEEPS の 4 人) の 1 秒あたりの試行数
+  api_calculate            Flask のテストクライアント経由の /api/calculate の所要時間 (キャッシュなし、ms)
+  api_calculate_cached     同じリクエストを繰り返したとき (キャッシュあり) の所要時間 (ms)
+  startup                  新しいプロセスで app を import してテーブルの準備ができるまでの時間 (ms)
+
+計測の前に golden.py の正解チェックを実行する (--skip-golden で省略)。
+結果は JSON で表示し、--output で保存する (benchmarks/baseline.json が基準値)。
+--compare を指定すると基準より threshold (割合) 以上悪化した項目を表示し、あれば終了コード 1 で終わる。
+値は絶対的な速度なので、基準を計測した環境 (Python のバージョン・アーキテクチャ・CPU・カテゴリ分布テーブルの有無) が
+今回と違う場合は差を表示するだけで回帰の判定はしない (--ignore-environment で判定する)。同じ環境で --output した結果を基準にする。
+基準に記録がない環境の項目 (古い基準) は不明として比較しない。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from evaluator import RANKS, SUITS
+from golden import run_checks
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DEFAULT_THRESHOLD = 0.25
+# 結果に記録する環境 (基準とこれらが違うと速度を比較できない)
+ENVIRONMENT_KEYS = ('python', 'machine', 'cpu', 'category_table')
+
+NUM_HANDS = 20000
+# 確率計算の局面 (保持枚数 -> 保持カード)。相手は OPPONENT_CARDS を保持する
+DRAW_KEEPS = {
+    0: [],
+    1: ['2H'],
+    2: ['2H', '3D'],
+    3: ['2H', '3D', '7S'],
+    4: ['2H', '3D', '4S', '7C'],
+}
+# 確率・勝率・API の計測の相手の保持カード
+OPPONENT_CARDS = ['5H', '6D', '8S']
+DRAW_SIMULATIONS = 5000
+WIN_RATE_TRIALS = {'python': 20000, 'numpy': 200000}
+# N 人の勝率の計測の各プレイヤーの保持カード
+MULTIWAY_KEEPS = [['2H', '3D', '7S'], ['5H', '6D', '8S'], ['2D', '4C'], []]
+MULTIWAY_TRIALS = {'python': 10000, 'numpy': 100000}
+API_REQUESTS = 5
+API_SIMULATIONS = 10000
+# API の計測の局面 (全列挙の見積もりが EXACT_COST_LIMIT を超え、numpy エンジンでサンプリングする)
+API_SPOT = {'player1_cards': ['2H'], 'player2_cards': ['5H', '6D']}
+
+
+def _best_seconds(fn, repeat):
+    """fn を repeat 回実行した所要時間の最小値 (秒)。他のプロセスの影響などの雑音を除くため最小値を使う"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def _metric(value, unit, higher_is_better):
+    return {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+# --- 計測 ---
+def bench_evaluator(repeat):
+    rng = random.Random(0)
+    deck = [r + s for r in RANKS for s in SUITS]
+    hands = [rng.sample(deck, 5) for _ in range(NUM_HANDS)]
+    evaluations = [app.evaluate_27sd_hand(hand) for hand in hands]
+    pairs = list(zip(evaluations, evaluations[1:]))
+
+    def evaluate():
+        for hand in hands:
+            app.evaluate_27sd_hand(hand)
+    def compare():
+        for a, b in pairs:
+            app.compare_27sd_hands(a, b)
+    return {
+        'evaluate_27sd_hand': _metric(len(hands) / _best_seconds(evaluate, repeat), 'hands/s', True),
+        'compare_27sd_hands': _metric(len(pairs) / _best_seconds(compare, repeat), 'comparisons/s', True),
+    }
+
+def bench_draw_probabilities(repeat):
+    results = {}
+    table = app.category_table
+    for label, use_table in (('', True), ('live_', False)):
+        app.category_table = table if use_table else None
+        try:
+            for num_kept, kept in DRAW_KEEPS.items():
+                seconds = _best_seconds(
+                    lambda: app.calculate_spot_outcomes(kept, OPPONENT_CARDS, num_simulations=DRAW_SIMULATIONS, seed=1),
+                    repeat)
+                results[f'draw_probabilities_{label}keep{num_kept}'] = _metric(seconds * 1000, 'ms', False)
+        finally:
+            app.category_table = table
+    return results
+
+def bench_win_rate(repeat):
+    results = {}
+    for engine, trials in WIN_RATE_TRIALS.items():
+        seconds = _best_seconds(
+            lambda: app.calculate_post_draw_win_rate(['2H', '3D', '7S'], OPPONENT_CARDS, num_simulations=trials,
+                                                     method='sampling', engine=engine, seed=1), repeat)
+        results[f'win_rate_{engine}'] = _metric(trials / seconds, 'simulations/s', True)
+    return results
+
+def bench_multiway(repeat):
+    results = {}
+    for engine, trials in MULTIWAY_TRIALS.items():
+        seconds = _best_seconds(
+            lambda: app.calculate_multiway_equity(MULTIWAY_KEEPS, num_simulations=trials, engine=engine, seed=1), repeat)
+        results[f'multiway_{engine}'] = _metric(trials / seconds, 'simulations/s', True)
+    return results
+
+def bench_api(repeat):
+    client = app.app.test_client()
+    body = dict(API_SPOT, num_simulations=API_SIMULATIONS, engine='numpy')
+    seeds = iter(range(1, repeat * API_REQUESTS + 1))
+
+    def uncached():
+        # シードを変えて毎回キャッシュを外す
+        for _ in range(API_REQUESTS):
+            response = client.post('/api/calculate', json=dict(body, seed=next(seeds)))
+            assert response.status_code == 200, response.get_json()
+            # 全列挙に切り替わると engine・num_simulations を使わず、別の経路を計測することになる
+            assert response.get_json()['win_rates']['method'] == 'sampling', "API_SPOT が全列挙になりました"
+    def cached():
+        for _ in range(API_REQUESTS):
+            response = client.post('/api/calculate', json=dict(body, seed=0))
+            assert response.status_code == 200, response.get_json()
+    cached() # キャッシュに載せる
+    return {
+        'api_calculate': _metric(_best_seconds(uncached, repeat) / API_REQUESTS * 1000, 'ms', False),
+        'api_calculate_cached': _metric(_best_seconds(cached, repeat) / API_REQUESTS * 1000, 'ms', False),
+    }
+
+def bench_startup(repeat):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    seconds = _best_seconds(lambda: subprocess.run([sys.executable, '-c', 'import app'], cwd=root, check=True,
+                                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), repeat)
+    return {'startup': _metric(seconds * 1000, 'ms', False)}
+
+BENCHMARKS = (bench_evaluator, bench_draw_probabilities, bench_win_rate, bench_multiway, bench_api, bench_startup)
+
+def _cpu_model():
+    """CPU の機種名 (/proc/cpuinfo がなければ platform.processor())"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or None
+
+def run_benchmarks(repeat=5):
+    metrics = {}
+    for bench in BENCHMARKS:
+        metrics.update(bench(repeat))
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu': _cpu_model(),
+        'category_table': app.category_table is not None,
+        'metrics': metrics,
+    }
+
+
+# --- 基準との比較 ---
+def environment_differences(result, baseline):
+    """基準と今回で違う環境の (項目名, 基準, 今回) のリスト (基準に記録がない項目は不明として含めない)"""
+    return [(key, baseline[key], result.get(key)) for key in ENVIRONMENT_KEYS
+            if key in baseline and baseline[key] != result.get(key)]
+
+def compare(result, baseline, threshold):
+    """
+    基準値と比較して (項目名, 基準値, 今回の値, 悪化した割合) のリストと、悪化が threshold を超えた項目名のリストを返す。
+    悪化した割合は、大きいほど良い項目なら 基準/今回 - 1、小さいほど良い項目なら 今回/基準 - 1。
+    """
+    rows = []
+    regressions = []
+    for name, metric in result['metrics'].items():
+        base = baseline['metrics'].get(name)
+        if base is None or not base['value'] or not metric['value']:
+            continue
+        if metric['higher_is_better']:
+            change = base['value'] / metric['value'] - 1
+        else:
+            change = metric['value'] / base['value'] - 1
+        rows.append((name, base['value'], metric['value'], change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='結果の JSON を保存するパス')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH, help='比較する基準の JSON (省略時 baseline.json)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='回帰とみなす悪化の割合')
+    parser.add_argument('--repeat', type=int, default=5, help='各計測の繰り返し回数 (最小値を使う)')
+    parser.add_argument('--skip-golden', action='store_true', help='正解チェックを省略する')
+    parser.add_argument('--ignore-environment', action='store_true', help='基準と環境が違っても回帰を判定する')
+    args = parser.parse_args()
+
+    if not args.skip_golden and not run_checks():
+        print("正解チェックに失敗したため計測しません")
+        return 1
+
+    result = run_benchmarks(args.repeat)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(result, baseline, args.threshold)
+        differences = environment_differences(result, baseline)
+        unknown = [key for key in ENVIRONMENT_KEYS if key not in baseline]
+        if unknown:
+            print(f"\n注意: 基準に {', '.join(unknown)} の記録がないため、これらは比較しません")
+        if differences and not args.ignore_environment:
+            print("\n警告: 基準と環境が違うため、差は表示するだけで回帰の判定はしません (--ignore-environment で判定する)")
+            for key, base, current in differences:
+                print(f"  {key}: 基準 {base} / 今回 {current}")
+            regressions = []
+        print(f"\n{'metric':<28} {'baseline':>14} {'current':>14} {'change':>8}")
+        for name, base, current, change in rows:
+            flag = '  REGRESSION' if name in regressions else ''
+            print(f"{name:<28} {base:>14,.2f} {current:>14,.2f} {change:>+8.1%}{flag}")
+        if regressions:
+            print(f"\n{len(regressions)} 項目が基準より {args.threshold:.0%} 以上悪化しました")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+評価器・確率計算・勝率計算の正解チェック (全通り列挙の結果と照合する)
+
+python benchmarks/golden.py
+
+- 事前ビルドしたテーブル (python tables.py build) が現在の評価器で構築したものと一致するか
+- 全 2,598,960 ハンドのカテゴリ別の数が組み合わせ論で求めた値と一致するか
+- evaluate_27sd_hand / compare_27sd_hands が既知のハンドの組を正しく判定するか
+- calculate_spot_outcomes のカテゴリ確率 (全列挙・カテゴリ分布テーブル) が itertools による総当たりと一致するか
+- calculate_post_draw_win_rate の全列挙が総当たりと一致し、サンプリングが誤差の範囲に収まるか
+不一致があれば内容を表示して終了コード 1 で終わる。
+"""
+import os
+import sys
+from itertools import combinations
+from math import sqrt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+import evaluator
+import vectorized
+from evaluator import CATEGORY_SHIFT, HAND_CATEGORIES_27SD, NUM_CARDS, card_to_id, evaluate5, evaluate_ids
+
+# 全 5 枚ハンドのカテゴリ別の数 (2-7SD: A はハイのみなので A-2-3-4-5 はストレートではない)
+# ノーペア: ハイカードのランク以下から 4 枚選ぶランクの組 (ストレートを除く) x 1020 (フラッシュ以外のスート)
+# Bad Hand: フラッシュ 4 x 1287 + フラッシュ以外のストレート 9 x 1020
+CATEGORY_COUNTS = {
+    '7-High': 4080, '8-High': 14280, '9-High': 34680, '10-High': 70380,
+    'J-High': 127500, 'Q-High': 213180, 'K-High': 335580, 'A-High': 503880,
+    'One Pair': 1098240, 'Two Pair': 123552, 'Three of a Kind': 54912,
+    'Bad Hand (Straight/Flush)': 14328, 'Full House': 3744, 'Four of a Kind': 624,
+}
+
+# (ハンド1, ハンド2, 期待値: 1 ならハンド1の勝ち, -1 ならハンド2の勝ち, 0 なら引き分け)
+COMPARISONS = [
+    (['7H', '5D', '4S', '3C', '2H'], ['7D', '6S', '4C', '3H', '2D'], 1),  # 75432 は最強のノーペア
+    (['8H', '6D', '4S', '3C', '2H'], ['8D', '6S', '5C', '3H', '2D'], 1),  # 2 枚目で比較
+    (['7H', '5D', '4S', '3C', '2H'], ['7D', '5S', '4C', '3H', '2D'], 0),  # スート違いは引き分け
+    (['KH', 'QD', 'JS', '9C', '8H'], ['2H', '2D', '3S', '4C', '5H'], 1),  # ノーペアはワンペアに勝つ
+    (['AH', '5D', '4S', '3C', '2H'], ['9H', '9D', '3S', '4C', '5H'], 1),  # A-5-4-3-2 はストレートではない
+    (['6H', '5D', '4S', '3C', '2H'], ['KH', 'KD', '3S', '4C', '5H'], -1), # ストレートはワンペアに負ける
+    (['9H', '7H', '5H', '4H', '2H'], ['QS', 'QD', 'QC', '4C', '5H'], -1), # フラッシュはスリーカードに負ける
+    (['3H', '3D', '3S', '2C', '2H'], ['9H', '7H', '5H', '4H', '2H'], -1), # フルハウスはフラッシュに負ける
+    (['3H', '3D', '3S', '2C', '2H'], ['AH', 'AD', 'AS', '4C', '5H'], -1), # フルハウスはスリーカードに負ける
+    (['5H', '5D', '5S', '5C', '2H'], ['3H', '3D', '3S', '2C', '2D'], -1), # フォーカードはフルハウスに負ける
+]
+
+# (保持カード, 相手の保持カード) の確率チェックの局面 (相手の保持カードはデッキから除かれる)
+DRAW_SPOTS = [
+    (['2H', '3D', '4S', '7C'], ['8H', '9D']),
+    (['2H', '3H', '5H'], ['KH', 'KD', 'KS']),
+    (['7D', '7S'], []),
+    (['AH'], ['2H', '3D', '4S', '5C']),
+]
+
+# (P1 の保持カード, P2 の保持カード) の勝率チェックの局面 (総当たりで求めるので組み合わせの少ないもの)
+WIN_RATE_SPOTS = [
+    (['2H', '3D', '4S', '7C'], ['2D', '3S', '5C', '8H']),
+    (['2H', '3H', '4H', '7H'], ['5D', '6S', '8C']),
+    (['2H', '3D', '5S', '6C', '8H'], ['2D', '4C', '7S']),
+]
+SAMPLING_TRIALS = 20000
+# サンプリング結果と全列挙の差の許容幅 (標準誤差の倍数)
+SAMPLING_TOLERANCE_SE = 5
+
+
+def _ids(cards):
+    return [card_to_id(card) for card in cards]
+
+
+# --- チェック ---
+def check_tables():
+    rank_table, flush_table = evaluator._build_tables()
+    rank_dense, flush_dense = vectorized._build_dense_tables(rank_table, flush_table)
+    failures = []
+    if evaluator.RANK_TABLE != rank_table or evaluator.FLUSH_TABLE != flush_table:
+        failures.append("evaluator のテーブルが構築結果と一致しません (python tables.py build で作り直してください)")
+    if not (vectorized.RANK_DENSE == rank_dense).all() or not (vectorized.FLUSH_DENSE == flush_dense).all():
+        failures.append("vectorized のテーブルが構築結果と一致しません (python tables.py build で作り直してください)")
+    return failures
+
+def check_category_counts():
+    counts = [0] * len(HAND_CATEGORIES_27SD)
+    for a, b, c, d, e in combinations(range(NUM_CARDS), 5):
+        counts[evaluate5(a, b, c, d, e) >> CATEGORY_SHIFT] += 1
+    return [f"{cat}: {counts[i]} (正解 {CATEGORY_COUNTS[cat]})"
+            for i, cat in enumerate(HAND_CATEGORIES_27SD) if counts[i] != CATEGORY_COUNTS[cat]]
+
+def check_comparisons():
+    failures = []
+    for hand1, hand2, expected in COMPARISONS:
+        result = app.compare_27sd_hands(app.evaluate_27sd_hand(hand1), app.evaluate_27sd_hand(hand2))
+        if result != expected:
+            failures.append(f"{hand1} vs {hand2}: {result} (正解 {expected})")
+    hand_names = {
+        ('3H', '3D', '3S', '2C', '2H'): 'Full House',
+        ('QS', 'QD', 'QC', '4C', '5H'): 'Three of a Kind',
+        ('9H', '7H', '5H', '4H', '2H'): 'Bad Hand (Straight/Flush)',
+        ('8H', '6D', '4S', '3C', '2H'): '8-High',
+    }
+    for hand, expected in hand_names.items():
+        name = app.get_hand_category(*app.evaluate_27sd_hand(list(hand)))
+        if name != expected:
+            failures.append(f"{list(hand)}: {name} (正解 {expected})")
+    return failures
+
+def _brute_force_probabilities(kept_ids, deck_ids):
+    counts = [0] * len(HAND_CATEGORIES_27SD)
+    for drawn in combinations(deck_ids, 5 - len(kept_ids)):
+        counts[evaluate_ids(kept_ids + list(drawn)) >> CATEGORY_SHIFT] += 1
+    total = sum(counts)
+    return {cat: counts[i] / total for i, cat in enumerate(HAND_CATEGORIES_27SD)}
+
+def check_draw_probabilities():
+    failures = []
+    # 全列挙: 両プレイヤーのドローの全列挙で数えた P1 のカテゴリ確率は、相手の保持カードを除いたデッキからのドローの確率と同じ
+    # サンプリング: カテゴリ分布テーブルから同じ確率を引く (テーブルがなければ試行から数えるので照合しない)
+    methods = ['exact'] + (['sampling'] if app.category_table is not None else [])
+    for kept, opponent in DRAW_SPOTS:
+        kept_ids = _ids(kept)
+        deck_ids = [cid for cid in range(NUM_CARDS) if cid not in set(kept_ids) | set(_ids(opponent))]
+        expected = _brute_force_probabilities(kept_ids, deck_ids)
+        for method in methods:
+            outcomes = app.calculate_spot_outcomes(kept, opponent, num_simulations=1000, method=method, seed=1)
+            probabilities = outcomes['player1']['probabilities']
+            wrong = [cat for cat in HAND_CATEGORIES_27SD if abs(probabilities[cat] - expected[cat]) > 1e-12]
+            if wrong:
+                failures.append(f"{kept} (相手 {opponent}, {method}): {', '.join(wrong)} が一致しません")
+    return failures
+
+def _brute_force_win_rate(p1_ids, p2_ids):
+    deck_ids = [cid for cid in range(NUM_CARDS) if cid not in set(p1_ids) | set(p2_ids)]
+    wins = losses = ties = 0
+    for drawn1 in combinations(deck_ids, 5 - len(p1_ids)):
+        s1 = evaluate_ids(p1_ids + list(drawn1))
+        rest = [cid for cid in deck_ids if cid not in drawn1]
+        for drawn2 in combinations(rest, 5 - len(p2_ids)):
+            s2 = evaluate_ids(p2_ids + list(drawn2))
+            if s1 < s2:
+                wins += 1
+            elif s2 < s1:
+                losses += 1
+            else:
+                ties += 1
+    total = wins + losses + ties
+    return wins / total, losses / total, ties / total
+
+def check_win_rates():
+    failures = []
+    keys = ('player1_wins', 'player2_wins', 'ties')
+    for p1, p2 in WIN_RATE_SPOTS:
+        expected = _brute_force_win_rate(_ids(p1), _ids(p2))
+        exact = app.calculate_post_draw_win_rate(p1, p2, method='exact')
+        if any(abs(exact[key] - value) > 1e-12 for key, value in zip(keys, expected)):
+            failures.append(f"{p1} vs {p2} (exact): {[exact[key] for key in keys]} (正解 {list(expected)})")
+        for engine in app.ENGINES:
+            sampled = app.calculate_post_draw_win_rate(p1, p2, num_simulations=SAMPLING_TRIALS,
+                                                       method='sampling', engine=engine, seed=1)
+            for key, value in zip(keys, expected):
+                tolerance = SAMPLING_TOLERANCE_SE * max(sqrt(value * (1 - value) / SAMPLING_TRIALS), 1 / SAMPLING_TRIALS)
+                if abs(sampled[key] - value) > tolerance:
+                    failures.append(f"{p1} vs {p2} ({engine}): {key} {sampled[key]:.4f} (正解 {value:.4f})")
+    return failures
+
+CHECKS = {
+    'tables': check_tables,
+    'category_counts': check_category_counts,
+    'comparisons': check_comparisons,
+    'draw_probabilities': check_draw_probabilities,
+    'win_rates': check_win_rates,
+}
+
+def run_checks(checks=None):
+    """checks (名前 -> チェック関数、省略時は CHECKS) を全て実行して結果を表示し、全て通れば True を返す"""
+    ok = True
+    for name, check in (checks or CHECKS).items():
+        failures = check()
+        print(f"{'OK' if not failures else 'NG'} {name}")
+        for failure in failures:
+            print(f"   {failure}")
+        ok = ok and not failures
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run_checks() else 1)
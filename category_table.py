@@ -0,0 +1,157 @@
+"""
+保持カードごとの最終ハンドカテゴリ分布の事前計算テーブル
+
+0〜4 枚の保持カードそれぞれについて、残り全デッキからドローしたときの
+HAND_CATEGORIES_27SD 別の組み合わせ数をスート同型で正規化して保存する。
+5 枚保持はドロー不要 (評価 1 回) なのでテーブルには含めない。
+
+ビルド:  python category_table.py build [出力パス]
+サーバーは起動時にファイルを mmap し、保持カードの colex 順位 -> 行番号 の索引で O(1) で引く。
+
+相手の保持カードなどデッキから除かれたカード R がある場合は、包除原理で厳密に補正する:
+  count(K, R) = Σ_{S ⊆ R, |S| <= ドロー枚数} (-1)^|S| * count(K ∪ S)
+count(K ∪ S) も同じテーブル (5 枚になる場合は評価 1 回) で引ける。
+
+ファイル形式 (リトルエンディアン):
+  ヘッダ 16 バイト: マジック b'P27CAT02', 行数 (uint32), カテゴリ数 (uint32)
+  索引: 保持枚数 k = 0..4 ごとに C(52, k) 個の int32 (保持カードの colex 順位 -> 行番号)
+  行: (行数, カテゴリ数) の uint32
+"""
+import logging
+import os
+import struct
+import sys
+from itertools import combinations
+
+import numpy as np
+
+from equity import rank_avail_of, suit_bits_of, kept_key_of, draw_distribution, flush_suits
+from evaluator import CATEGORY_SHIFT, NUM_CARDS, NUM_CATEGORIES, evaluate_ids
+from result_cache import SUIT_PERMUTATIONS, relabel_ids
+from sampling import count_combinations
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'P27CAT02' # 02: フルハウスを Three of a Kind に含めていた 01 のテーブルは読み込まない
+MAX_KEPT = 4
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'category_table.bin')
+# 除外カードがこれより多い場合は包除原理の項数が増えるので使わない
+MAX_REMOVED = 8
+
+_HEADER = struct.Struct('<8sII')
+
+
+def colex_rank(sorted_ids):
+    """昇順のカード ID 列の colex 順位 (0 <= 順位 < C(52, k))"""
+    return sum(count_combinations(cid, i) for i, cid in enumerate(sorted_ids, start=1))
+
+def _canonical_keep(card_ids):
+    return min(tuple(sorted(relabel_ids(card_ids, perm))) for perm in SUIT_PERMUTATIONS)
+
+def _keep_category_counts(kept_ids):
+    """保持カードに残り全デッキからドローしたときのカテゴリ別組み合わせ数"""
+    kept = set(kept_ids)
+    deck_ids = [cid for cid in range(NUM_CARDS) if cid not in kept]
+    dist = draw_distribution(kept_key_of(kept_ids), flush_suits(kept_ids),
+                             rank_avail_of(deck_ids), suit_bits_of(deck_ids), 5 - len(kept_ids))
+    counts = [0] * NUM_CATEGORIES
+    for strength, count in dist.items():
+        counts[strength >> CATEGORY_SHIFT] += count
+    return counts
+
+
+# --- ビルド ---
+def build_table(path=DEFAULT_PATH):
+    """全ての保持カード (0〜4 枚) のカテゴリ分布を計算してファイルに書き出す"""
+    rows = []
+    row_of_canonical = {}
+    indexes = []
+    for k in range(MAX_KEPT + 1):
+        index = np.empty(count_combinations(NUM_CARDS, k), dtype='<i4')
+        # combinations は colex 順ではないので順位は個別に計算する
+        for keep in combinations(range(NUM_CARDS), k):
+            canonical = _canonical_keep(keep)
+            row = row_of_canonical.get(canonical)
+            if row is None:
+                row = len(rows)
+                rows.append(_keep_category_counts(canonical))
+                row_of_canonical[canonical] = row
+            index[colex_rank(keep)] = row
+        indexes.append(index)
+        print(f"k={k}: {len(index)} keeps, {len(rows)} canonical rows so far")
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, len(rows), NUM_CATEGORIES))
+        for index in indexes:
+            f.write(index.tobytes())
+        f.write(np.asarray(rows, dtype='<u4').tobytes())
+    os.replace(tmp_path, path) # 読み込み中のワーカーが壊れたファイルを見ないように置き換える
+    return path
+
+
+# --- 読み込み ---
+class CategoryTable:
+    """mmap したカテゴリ分布テーブル"""
+
+    def __init__(self, path):
+        self.path = path
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, num_rows, num_categories = _HEADER.unpack(data[:_HEADER.size].tobytes())
+        if magic != MAGIC or num_categories != NUM_CATEGORIES:
+            raise ValueError(f"Invalid category table: {path}")
+        offset = _HEADER.size
+        self.indexes = []
+        for k in range(MAX_KEPT + 1):
+            size = count_combinations(NUM_CARDS, k)
+            self.indexes.append(np.frombuffer(data, dtype='<i4', count=size, offset=offset))
+            offset += size * 4
+        self.rows = np.frombuffer(data, dtype='<u4', count=num_rows * num_categories,
+                                  offset=offset).reshape(num_rows, num_categories)
+
+    def full_deck_counts(self, kept_ids):
+        """保持カード (4 枚以下) に残り全デッキからドローしたときのカテゴリ別組み合わせ数"""
+        kept = sorted(kept_ids)
+        return self.rows[self.indexes[len(kept)][colex_rank(kept)]]
+
+    def category_counts(self, kept_ids, removed_ids):
+        """
+        removed_ids をデッキから除いたときのカテゴリ別組み合わせ数 (int のリスト) と総数を返す。
+        除外カードが多すぎる場合は None を返す (呼び出し元でライブ計算する)。
+        """
+        kept = sorted(kept_ids)
+        removed = sorted(set(removed_ids) - set(kept))
+        num_to_draw = 5 - len(kept)
+        if len(removed) > MAX_REMOVED or not 0 < num_to_draw <= 5:
+            return None
+        counts = [0] * NUM_CATEGORIES
+        for size in range(min(len(removed), num_to_draw) + 1):
+            sign = -1 if size % 2 else 1
+            for subset in combinations(removed, size):
+                cards = kept + list(subset)
+                if len(cards) == 5:
+                    counts[evaluate_ids(cards) >> CATEGORY_SHIFT] += sign
+                else:
+                    for i, c in enumerate(self.full_deck_counts(cards).tolist()):
+                        counts[i] += sign * c
+        total = count_combinations(NUM_CARDS - len(kept) - len(removed), num_to_draw)
+        return counts, total
+
+def load_table(path=None):
+    """テーブルを mmap で読み込む (ファイルがなければ None)"""
+    path = path or os.environ.get('POKER_CATEGORY_TABLE', DEFAULT_PATH)
+    if not os.path.exists(path):
+        return None
+    try:
+        return CategoryTable(path)
+    except (ValueError, OSError) as e:
+        logger.warning("Could not load category table %s: %s", path, e)
+        return None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'build':
+        print("usage: python category_table.py build [output path]")
+        sys.exit(1)
+    print(f"Wrote {build_table(sys.argv[2] if len(sys.argv) > 2 else DEFAULT_PATH)}")
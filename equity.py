@@ -0,0 +1,290 @@
+"""
+ドロー後の勝率を全通り列挙で厳密に計算するモジュール
+
+2-7SD ではフラッシュ以外はランクの多重集合だけで役が決まるため、
+ドローをカード単位ではなく「ランクの多重集合 x スートの組み合わせ数」で数える。
+フラッシュになる組み合わせ数だけは各スートの残りカードから別途数える。
+"""
+from bisect import bisect_right
+from collections import Counter
+from fractions import Fraction
+from itertools import combinations, combinations_with_replacement
+from math import comb
+
+from evaluator import CARD_PRIME, CARD_SUIT, CATEGORY_SHIFT, RANK_TABLE, FLUSH_TABLE, NUM_CARDS, NUM_CATEGORIES, evaluate_ids
+from tables import lazy_table
+
+_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41]
+
+# この組み合わせ数 (内部ループ回数の見積もり) 以下なら auto で厳密計算を選ぶ
+EXACT_COST_LIMIT = 500000
+
+
+@lazy_table
+def _rank_multisets():
+    """ドロー枚数ごとのランク多重集合 ((ランク, 枚数)..., 素数積, ランクビット) のリスト (初回使用時に構築)"""
+    table = []
+    for n in range(6):
+        entries = []
+        for multiset in combinations_with_replacement(range(13), n):
+            counts = tuple(Counter(multiset).items())
+            key = 1
+            for r in multiset:
+                key *= _PRIMES[r]
+            # ランクが全て異なる場合のみフラッシュの可能性がある (-1 はフラッシュ不可)
+            rank_bits = sum(1 << r for r in multiset) if len(counts) == n else -1
+            entries.append((counts, key, rank_bits))
+        table.append(entries)
+    return table
+
+# ドロー枚数ごとのランク多重集合の数 (列挙の見積もりはテーブルを構築せずに済ませる)
+_NUM_RANK_MULTISETS = [comb(12 + n, n) for n in range(6)]
+
+
+# --- デッキ情報 ---
+def rank_avail_of(deck_ids):
+    """デッキ内のランクごとの残り枚数"""
+    avail = [0] * 13
+    for cid in deck_ids:
+        avail[cid >> 2] += 1
+    return avail
+
+def suit_bits_of(deck_ids):
+    """デッキ内のスートごとの残りランク (ビットマスク)"""
+    bits = [0, 0, 0, 0]
+    for cid in deck_ids:
+        bits[cid & 3] |= 1 << (cid >> 2)
+    return bits
+
+def flush_suits(kept_ids):
+    """ドロー後にフラッシュになりうるスートのリスト"""
+    suits = {CARD_SUIT[cid] for cid in kept_ids}
+    if not suits:
+        return [0, 1, 2, 3]
+    if len(suits) == 1:
+        return list(suits)
+    return []
+
+def kept_key_of(kept_ids):
+    key = 1
+    for cid in kept_ids:
+        key *= CARD_PRIME[cid]
+    return key
+
+
+# --- ドロー結果の分布 ---
+def draw_distribution(kept_key, suits, rank_avail, suit_bits, num_to_draw):
+    """
+    保持カード (素数積 kept_key) に num_to_draw 枚ドローしたときの
+    strength -> 組み合わせ数 の辞書を返す。
+    suits はフラッシュになりうるスート、suit_bits はスートごとの残りランク。
+    """
+    dist = {}
+    for counts, key, rank_bits in _rank_multisets()[num_to_draw]:
+        weight = 1
+        for r, c in counts:
+            weight *= comb(rank_avail[r], c)
+            if not weight:
+                break
+        if not weight:
+            continue
+        total_key = kept_key * key
+        flushes = 0
+        if rank_bits >= 0:
+            for s in suits:
+                if suit_bits[s] & rank_bits == rank_bits:
+                    flushes += 1
+        if flushes:
+            strength = FLUSH_TABLE[total_key]
+            dist[strength] = dist.get(strength, 0) + flushes
+            weight -= flushes
+            if not weight:
+                continue
+        strength = RANK_TABLE[total_key]
+        dist[strength] = dist.get(strength, 0) + weight
+    return dist
+
+def _tally(dist_a, dist_b):
+    """A, B の strength 分布から (A勝ち, B勝ち, 引き分け) の組み合わせ数を返す"""
+    strengths = sorted(dist_b)
+    # suffix[i] = strengths[i:] の組み合わせ数合計
+    suffix = [0] * (len(strengths) + 1)
+    for i in range(len(strengths) - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + dist_b[strengths[i]]
+    total_b = suffix[0]
+    a_wins = b_wins = ties = 0
+    for s, w in dist_a.items():
+        i = bisect_right(strengths, s)
+        tie = dist_b.get(s, 0)
+        a_wins += w * suffix[i] # B の strength が大きい (弱い)
+        ties += w * tie
+        b_wins += w * (total_b - suffix[i] - tie)
+    return a_wins, b_wins, ties
+
+def category_vector(dist):
+    """strength 分布をカテゴリ別の組み合わせ数のリストにまとめる"""
+    counts = [0] * NUM_CATEGORIES
+    for s, w in dist.items():
+        counts[s >> CATEGORY_SHIFT] += w
+    return counts
+
+
+# --- 厳密計算 ---
+def _exact_counts(a_ids, b_ids, deck_ids, memo=None):
+    """
+    A, B の保持カードから (A勝ち, B勝ち, 引き分け, A のカテゴリ別, B のカテゴリ別) の組み合わせ数を返す。
+    カテゴリ別の数は勝敗と同じ (A のドロー, B のドロー) の組全体での数。
+    memo は A のドロー (除かれるカード) -> B の分布 のメモ。同じ b_ids, deck_ids の呼び出し間で共有できる。
+    B がフラッシュになりえない場合、B の分布は A のドローのランクだけで決まるので
+    A もランク多重集合単位で列挙する。そうでなければ A はカード単位で列挙し、
+    B の分布は (A のランク, A が B のフラッシュスートから引いたカード) ごとにメモ化する。
+    """
+    n_a = 5 - len(a_ids)
+    n_b = 5 - len(b_ids)
+    key_a = kept_key_of(a_ids)
+    key_b = kept_key_of(b_ids)
+    suits_a = flush_suits(a_ids)
+    suits_b = flush_suits(b_ids)
+    avail = rank_avail_of(deck_ids)
+    bits = suit_bits_of(deck_ids)
+    a_wins = b_wins = ties = 0
+    cat_a = [0] * NUM_CATEGORIES
+    cat_b = [0] * NUM_CATEGORIES
+    if memo is None:
+        memo = {}
+
+    if not suits_b:
+        for counts, key, rank_bits in _rank_multisets()[n_a]:
+            weight = 1
+            for r, c in counts:
+                weight *= comb(avail[r], c)
+            if not weight:
+                continue
+            # A のこのランク多重集合のうちフラッシュになる組み合わせ数
+            total_key = key_a * key
+            flushes = 0
+            if rank_bits >= 0:
+                for s in suits_a:
+                    if bits[s] & rank_bits == rank_bits:
+                        flushes += 1
+            dist_a = {}
+            if flushes:
+                dist_a[FLUSH_TABLE[total_key]] = flushes
+            if weight > flushes:
+                strength = RANK_TABLE[total_key]
+                dist_a[strength] = dist_a.get(strength, 0) + weight - flushes
+            dist_b = memo.get(key)
+            if dist_b is None:
+                avail_b = list(avail)
+                for r, c in counts:
+                    avail_b[r] -= c
+                dist_b = draw_distribution(key_b, (), avail_b, bits, n_b)
+                memo[key] = dist_b
+            w_a, w_b, t = _tally(dist_a, dist_b)
+            a_wins += w_a
+            b_wins += w_b
+            ties += t
+            total_b = sum(dist_b.values())
+            for s, w in dist_a.items():
+                cat_a[s >> CATEGORY_SHIFT] += w * total_b
+            for i, c in enumerate(category_vector(dist_b)):
+                cat_b[i] += weight * c
+        return a_wins, b_wins, ties, cat_a, cat_b
+
+    # B のフラッシュ判定に関係するカード (B のフラッシュスート) のマスク
+    relevant_suits = set(suits_b)
+    uses = Counter() # memo_key ごとの A のドロー数 (B のカテゴリ集計を最後にまとめて行う)
+    kept_a = list(a_ids)
+    for drawn in combinations(deck_ids, n_a):
+        strength_a = evaluate_ids(kept_a + list(drawn))
+        drawn_key = 1
+        relevant = 0
+        for cid in drawn:
+            drawn_key *= CARD_PRIME[cid]
+            if CARD_SUIT[cid] in relevant_suits:
+                relevant |= 1 << cid
+        memo_key = (drawn_key, relevant)
+        dist_b = memo.get(memo_key)
+        if dist_b is None:
+            avail_b = list(avail)
+            bits_b = list(bits)
+            for cid in drawn:
+                avail_b[cid >> 2] -= 1
+                bits_b[cid & 3] &= ~(1 << (cid >> 2))
+            dist_b = draw_distribution(key_b, suits_b, avail_b, bits_b, n_b)
+            memo[memo_key] = dist_b
+        uses[memo_key] += 1
+        w_a, w_b, t = _tally({strength_a: 1}, dist_b)
+        a_wins += w_a
+        b_wins += w_b
+        ties += t
+        cat_a[strength_a >> CATEGORY_SHIFT] += w_a + w_b + t
+    for memo_key, n in uses.items():
+        for i, c in enumerate(category_vector(memo[memo_key])):
+            cat_b[i] += n * c
+    return a_wins, b_wins, ties, cat_a, cat_b
+
+def _plan(p1_ids, p2_ids, deck_size):
+    """列挙の仕方を決める: (A側がP1か, ランク単位で列挙するか, 内部ループ回数の見積もり)"""
+    n1 = 5 - len(p1_ids)
+    n2 = 5 - len(p2_ids)
+    suits1 = flush_suits(p1_ids)
+    suits2 = flush_suits(p2_ids)
+    if not suits2:
+        return True, True, _NUM_RANK_MULTISETS[n1] * _NUM_RANK_MULTISETS[n2]
+    if not suits1:
+        return False, True, _NUM_RANK_MULTISETS[n1] * _NUM_RANK_MULTISETS[n2]
+    # 両者ともフラッシュの可能性がある: 組み合わせ数が少ない方をカード単位で列挙する
+    cost1 = comb(deck_size, n1) * _NUM_RANK_MULTISETS[n2]
+    cost2 = comb(deck_size, n2) * _NUM_RANK_MULTISETS[n1]
+    if cost1 <= cost2:
+        return True, False, cost1
+    return False, False, cost2
+
+def estimate_exact_cost(p1_ids, p2_ids, dead_ids=()):
+    """厳密計算の内部ループ回数の見積もり"""
+    deck_size = NUM_CARDS - len(set(p1_ids) | set(p2_ids) | set(dead_ids))
+    return _plan(p1_ids, p2_ids, deck_size)[2]
+
+def exact_spot_counts(p1_ids, p2_ids, dead_ids=(), memos=None):
+    """
+    全てのドローの組み合わせを列挙し、
+    (P1勝ち, P2勝ち, 引き分け, P1 のカテゴリ別, P2 のカテゴリ別) の組み合わせ数を返す。
+    dead_ids はどちらも引けないカード (捨てたカードなど)。デッキが足りない場合は None を返す。
+    memos に辞書を渡すと、後手側の分布のメモを (デッキ, 後手の保持カード) ごとにそこへ保存し、
+    同じデッキ・同じ相手の呼び出し (ドロー選択の比較など) で再利用する。
+    """
+    p1_ids = sorted(p1_ids)
+    p2_ids = sorted(p2_ids)
+    kept = set(p1_ids) | set(p2_ids) | set(dead_ids)
+    deck_ids = [cid for cid in range(NUM_CARDS) if cid not in kept]
+    n1 = 5 - len(p1_ids)
+    n2 = 5 - len(p2_ids)
+    if len(deck_ids) < n1 + n2:
+        return None
+
+    p1_first = _plan(p1_ids, p2_ids, len(deck_ids))[0]
+    a_ids, b_ids = (p1_ids, p2_ids) if p1_first else (p2_ids, p1_ids)
+    memo = memos.setdefault((tuple(deck_ids), tuple(b_ids)), {}) if memos is not None else None
+    if p1_first:
+        return _exact_counts(a_ids, b_ids, deck_ids, memo)
+    p2_wins, p1_wins, ties, cat2, cat1 = _exact_counts(a_ids, b_ids, deck_ids, memo)
+    return p1_wins, p2_wins, ties, cat1, cat2
+
+def exact_result(p1_wins, p2_wins, ties):
+    """厳密な組み合わせ数から calculate_post_draw_win_rate と同じ形式の辞書を作る ('exact' に分数表記を含む)"""
+    total = p1_wins + p2_wins + ties
+    fractions = {
+        'player1_wins': Fraction(p1_wins, total),
+        'player2_wins': Fraction(p2_wins, total),
+        'ties': Fraction(ties, total),
+    }
+    return {
+        'player1_wins': float(fractions['player1_wins']),
+        'player2_wins': float(fractions['player2_wins']),
+        'ties': float(fractions['ties']),
+        'simulations': total, # 列挙した組み合わせの総数
+        'method': 'exact',
+        'exact': {name: f"{f.numerator}/{f.denominator}" for name, f in fractions.items()},
+        'confidence_intervals': {name: [float(f), float(f)] for name, f in fractions.items()},
+    }
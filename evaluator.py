@@ -0,0 +1,162 @@
+"""
+2-7 Single Draw 用の高速ハンド評価器
+
+カードは整数 ID (0..51) で表す: ``id = ランク番号 * 4 + スート番号``
+  ランク番号: '2' -> 0, '3' -> 1, ..., 'A' -> 12
+  スート番号: 'H' -> 0, 'D' -> 1, 'S' -> 2, 'C' -> 3
+
+評価結果は 1 つの整数 (strength) で、値が小さいほど強い。
+2 つのハンドの比較は ``s1 < s2`` だけで済む。
+strength の上位ビットは HAND_CATEGORIES_27SD のインデックスなので、
+カテゴリは ``strength >> CATEGORY_SHIFT`` で取り出せる。
+
+テーブルはランクの多重集合 (素数の積で一意に表す) とフラッシュかどうかをキーにする。
+事前ビルドしたファイル (python tables.py build) があれば読み込み、なければ import 時に一度だけ構築する。
+"""
+from itertools import combinations_with_replacement
+
+from tables import HAND_CATEGORIES_27SD, RANKS, SUITS, load_arrays, mark_built
+
+# --- 定数 ---
+NUM_CARDS = 52
+NUM_CATEGORIES = len(HAND_CATEGORIES_27SD)
+
+# カテゴリ番号 (HAND_CATEGORIES_27SD のインデックス)
+CAT_ONE_PAIR = 8
+CAT_TWO_PAIR = 9
+CAT_THREE_OF_A_KIND = 10
+CAT_BAD_HAND = 11
+CAT_FULL_HOUSE = 12
+CAT_FOUR_OF_A_KIND = 13
+
+# strength = (カテゴリ番号 << CATEGORY_SHIFT) | カテゴリ内の順位
+# カテゴリ内の順位は 13 進 5 桁 (13**5 = 371293 < 2**19) に収まる
+CATEGORY_SHIFT = 19
+_TIEBREAK_SPAN = 13 ** 5
+
+# ランクごとの素数 (積がランク多重集合の一意なキーになる)
+_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41]
+
+CARD_TO_ID = {r + s: ri * 4 + si for ri, r in enumerate(RANKS) for si, s in enumerate(SUITS)}
+ID_TO_CARD = [None] * NUM_CARDS
+for _card, _cid in CARD_TO_ID.items():
+    ID_TO_CARD[_cid] = _card
+
+# カード ID -> 素数 / スート番号 (評価ループ内で使うのでリストで保持)
+CARD_PRIME = [_PRIMES[cid >> 2] for cid in range(NUM_CARDS)]
+CARD_SUIT = [cid & 3 for cid in range(NUM_CARDS)]
+
+
+# --- カード変換 ---
+def card_to_id(card):
+    """'10H' などの文字列カードを整数 ID に変換する (大文字小文字は区別しない)"""
+    return CARD_TO_ID[card[:-1].upper() + card[-1].upper()]
+
+def id_to_card(card_id):
+    """整数 ID を文字列カードに変換する"""
+    return ID_TO_CARD[card_id]
+
+def cards_to_mask(card_ids):
+    """カード ID の集まりを 52 ビットのマスクに変換する"""
+    mask = 0
+    for cid in card_ids:
+        mask |= 1 << cid
+    return mask
+
+def mask_to_ids(mask):
+    """52 ビットのマスクをカード ID のリスト (昇順) に変換する"""
+    ids = []
+    while mask:
+        low = mask & -mask
+        ids.append(low.bit_length() - 1)
+        mask ^= low
+    return ids
+
+
+# --- テーブル構築 ---
+def _classify(desc_ranks, is_flush):
+    """
+    ランク番号 (降順) とフラッシュ有無からカテゴリ番号を返す。
+    判定順序: ストレート/フラッシュ -> フォーカード -> フルハウス -> スリーカード -> ツーペア -> ワンペア -> ノーペア
+    """
+    counts = sorted((desc_ranks.count(r) for r in set(desc_ranks)), reverse=True)
+    is_straight = len(counts) == 5 and desc_ranks[0] - desc_ranks[4] == 4
+    if is_straight or is_flush:
+        return CAT_BAD_HAND
+    if counts[0] == 4:
+        return CAT_FOUR_OF_A_KIND
+    if counts[0] == 3:
+        return CAT_FULL_HOUSE if counts[1] == 2 else CAT_THREE_OF_A_KIND
+    if counts[0] == 2:
+        return CAT_TWO_PAIR if counts[1] == 2 else CAT_ONE_PAIR
+    # ノーペア: ハイカードでカテゴリを分ける ('7' のランク番号は 5)
+    return desc_ranks[0] - 5
+
+def _strength(category, desc_ranks):
+    """カテゴリとランク (降順) から strength を計算する"""
+    lex = 0
+    for r in desc_ranks:
+        lex = lex * 13 + r
+    if category < CAT_ONE_PAIR:
+        # ノーペアは数字が小さい方が強い
+        tiebreak = lex
+    else:
+        # ペア系・ストレート/フラッシュは数字が大きい方が強い (既存の比較ロジックと同じ)
+        tiebreak = _TIEBREAK_SPAN - 1 - lex
+    return (category << CATEGORY_SHIFT) | tiebreak
+
+def _build_tables():
+    table = {}
+    flush_table = {}
+    for multiset in combinations_with_replacement(range(13), 5):
+        desc_ranks = sorted(multiset, reverse=True)
+        if max(desc_ranks.count(r) for r in multiset) > 4:
+            continue # 同じランクは 4 枚まで
+        key = 1
+        for r in multiset:
+            key *= _PRIMES[r]
+        table[key] = _strength(_classify(desc_ranks, False), desc_ranks)
+        if len(set(multiset)) == 5: # フラッシュはランクが全て異なる場合のみ
+            flush_table[key] = _strength(_classify(desc_ranks, True), desc_ranks)
+    return table, flush_table
+
+def _load_tables():
+    arrays = load_arrays(('rank_keys', 'rank_strengths', 'flush_keys', 'flush_strengths'))
+    if arrays is None:
+        mark_built('rank_keys', 'rank_strengths', 'flush_keys', 'flush_strengths')
+        return _build_tables()
+    # 評価ループでは辞書を引くので、読み込んだ配列から辞書を作る (構築より 1 桁以上速い)
+    return (dict(zip(arrays['rank_keys'].tolist(), arrays['rank_strengths'].tolist())),
+            dict(zip(arrays['flush_keys'].tolist(), arrays['flush_strengths'].tolist())))
+
+RANK_TABLE, FLUSH_TABLE = _load_tables()
+
+
+# --- 評価 ---
+def evaluate5(a, b, c, d, e):
+    """5 枚のカード ID を評価して strength を返す (小さいほど強い)"""
+    key = CARD_PRIME[a] * CARD_PRIME[b] * CARD_PRIME[c] * CARD_PRIME[d] * CARD_PRIME[e]
+    s = CARD_SUIT
+    if s[a] == s[b] == s[c] == s[d] == s[e]:
+        return FLUSH_TABLE[key]
+    return RANK_TABLE[key]
+
+def evaluate_ids(card_ids):
+    """カード ID 5 枚のシーケンスを評価して strength を返す"""
+    a, b, c, d, e = card_ids
+    return evaluate5(a, b, c, d, e)
+
+def category_index(strength):
+    """strength から HAND_CATEGORIES_27SD のインデックスを返す"""
+    return strength >> CATEGORY_SHIFT
+
+def category_name(strength):
+    """strength から HAND_CATEGORIES_27SD のカテゴリ名を返す"""
+    return HAND_CATEGORIES_27SD[strength >> CATEGORY_SHIFT]
+
+def strength_from_eval(category, desc_rank_values):
+    """
+    (カテゴリ番号, 降順の数値ランク 2..14) から strength を計算する。
+    文字列 API の評価結果タプルを整数比較に載せるために使う。
+    """
+    return _strength(category, [v - 2 for v in desc_rank_values])
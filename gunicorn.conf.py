@@ -0,0 +1,52 @@
+"""
+gunicorn の設定 (gunicorn app:app をこのディレクトリで起動すると自動的に読み込まれる)
+
+マスターで app を import してテーブルを warm してから fork するので、ワーカーは起動時に何も構築せず、
+構築済みのテーブルはコピーオンライトで、事前ビルドしたテーブル (python tables.py build) は mmap で共有する。
+ワーカー数は WEB_CONCURRENCY (gunicorn の既定) で指定する。
+parallel=true のプロセスプールはワーカーごとに作られるので、fork 前にそのサイズを CPU 数 / ワーカー数にする
+(POKER_POOL_SIZE を指定した場合はワーカーごとにその数)。
+
+/metrics の計測値はワーカーごとに持つので、POKER_METRICS_DIR (省略時は起動ごとの一時ディレクトリ) に
+各ワーカーが書き出し、どのワーカーが応答しても全ワーカーの合計を返す。終了したワーカーのカウンタも合計に残す。
+
+ワーカーはスレッド (gthread) で動かす。SSE (/api/jobs/<id>/events) の接続や長い計算が
+ワーカー全体を占有せず、タイムアウト (timeout はワーカーの応答確認で、リクエストの長さではない) で
+ワーカーごとジョブが打ち切られることもない。スレッド数は POKER_THREADS で指定する。
+"""
+import gc
+import os
+import shutil
+import tempfile
+
+import parallel
+from metrics import mark_process_dead
+
+# app を import する (preload_app) 前に計測値の置き場所を決める
+if not os.environ.get('POKER_METRICS_DIR'):
+    os.environ['POKER_METRICS_DIR'] = tempfile.mkdtemp(prefix='poker-metrics-')
+    _temporary_metrics_dir = os.environ['POKER_METRICS_DIR']
+else:
+    _temporary_metrics_dir = None
+
+preload_app = True
+worker_class = 'gthread'
+threads = int(os.environ.get('POKER_THREADS', 8))
+
+
+def pre_fork(server, worker):
+    # マスターで構築したオブジェクトを GC の対象から外す
+    # (ワーカーの GC が参照カウントなどを書き換えて共有ページがコピーされるのを防ぐ)
+    gc.freeze()
+    # ワーカー数 x CPU 数のプロセスを起動しないよう、プールサイズをワーカーあたりの CPU 数にする
+    parallel.set_workers(server.cfg.workers)
+
+
+def child_exit(server, worker):
+    # 終了したワーカーのカウンタを合計に残す (ゲージは除く)
+    mark_process_dead(os.environ['POKER_METRICS_DIR'], worker.pid)
+
+
+def on_exit(server):
+    if _temporary_metrics_dir:
+        shutil.rmtree(_temporary_metrics_dir, ignore_errors=True)
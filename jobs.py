@@ -0,0 +1,285 @@
+"""
+重い計算をバックグラウンドで実行するジョブ管理
+
+submit はジョブ ID をすぐに返し、計算はスレッドプールで行う。
+計算関数は job.report(進捗, 途中結果) で進捗を知らせ、状態の取得や SSE での配信はそれを読む。
+report はキャンセル要求があれば JobCancelled を送出するので、計算はその時点で打ち切られる。
+終了したジョブは ttl 秒後に削除される。
+
+計算は登録を受けたプロセスで行うが、db_path を指定すると状態を SQLite (JobStore) にも書き込むので、
+gunicorn の他のワーカーに届いた状態の取得・SSE・キャンセルもそのジョブを扱える
+(他のワーカーは状態を POLL_INTERVAL 秒ごとに読み直し、キャンセル要求は計算中のワーカーが次の report で読む)。
+db_path を指定しない場合はプロセス内でのみ管理する。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'error'
+FINISHED_STATES = (DONE, CANCELLED, FAILED)
+POLL_INTERVAL = 0.25 # 他のプロセスのジョブの状態を読み直す間隔 (秒)
+
+
+class JobCancelled(Exception):
+    """キャンセルされたジョブの計算を打ち切るための例外"""
+
+
+class JobStore:
+    """
+    ジョブの状態を置く SQLite ファイル (gunicorn の全ワーカーで共有)。
+    状態は snapshot の辞書をそのまま JSON で持ち、キャンセル要求は別の列に置く (計算中のワーカーの書き込みで消えない)。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _db(self):
+        """スレッド (とプロセス) ごとの SQLite 接続"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, '
+                         'version INTEGER NOT NULL, state TEXT NOT NULL, finished_at REAL, '
+                         'cancel_requested INTEGER NOT NULL DEFAULT 0)')
+            conn.commit()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def save(self, state, finished_at):
+        """ジョブの状態 (snapshot の辞書) を書き込む"""
+        conn = self._db()
+        with conn:
+            conn.execute('INSERT INTO jobs (id, status, version, state, finished_at) VALUES (?, ?, ?, ?, ?) '
+                         'ON CONFLICT(id) DO UPDATE SET status = excluded.status, version = excluded.version, '
+                         'state = excluded.state, finished_at = excluded.finished_at',
+                         (state['job_id'], state['status'], state['version'], json.dumps(state), finished_at))
+
+    def load(self, job_id):
+        """ジョブの状態を返す (なければ None)"""
+        row = self._db().execute('SELECT status, version, state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        state = json.loads(row[2])
+        state.update(status=row[0], version=row[1])
+        return state
+
+    def request_cancel(self, job_id):
+        """キャンセル要求を書き込む (実行待ちならその場でキャンセル済みにする)。ジョブがなければ False"""
+        conn = self._db()
+        with conn:
+            found = conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,)).rowcount
+            conn.execute('UPDATE jobs SET status = ?, version = version + 1, finished_at = ? '
+                         'WHERE id = ? AND status = ?', (CANCELLED, time.time(), job_id, QUEUED))
+        return bool(found)
+
+    def cancel_requested(self, job_id):
+        row = self._db().execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def purge(self, ttl):
+        """終了から ttl 秒以上経ったジョブを削除する"""
+        conn = self._db()
+        with conn:
+            return conn.execute('DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at <= ?',
+                                (time.time() - ttl,)).rowcount
+
+
+class Job:
+    def __init__(self, job_id, store=None):
+        self.id = job_id
+        self.store = store
+        self.status = QUEUED
+        self.progress = 0.0
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.version = 0 # 状態が変わるたびに増える (SSE の差分検出用)
+        self._cancel_requested = threading.Event()
+        self._changed = threading.Condition()
+
+    def _update(self, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            if self.store is not None: # ロックの中で書くので、書き込みの順序が更新の順序と一致する
+                self.store.save(self._state_dict(), self.finished_at)
+            self._changed.notify_all()
+
+    def report(self, progress, partial=None):
+        """進捗 (0〜1) と途中結果を記録する。キャンセルされていれば JobCancelled を送出する"""
+        if self.cancel_requested():
+            raise JobCancelled()
+        self._update(progress=min(max(progress, 0.0), 1.0), partial=partial)
+
+    def cancel_requested(self):
+        """このプロセスか (JobStore を通して) 他のプロセスでキャンセルが要求されたか"""
+        if not self._cancel_requested.is_set() and self.store is not None and self.store.cancel_requested(self.id):
+            self._cancel_requested.set()
+        return self._cancel_requested.is_set()
+
+    def wait_for_update(self, version, timeout=None):
+        """version より新しい状態になるか終了するまで待ち、現在の version を返す"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version or self.finished, timeout=timeout)
+            return self.version
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def snapshot(self):
+        """API で返す状態の辞書"""
+        with self._changed:
+            return self._state_dict()
+
+    def _state_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'partial': self.partial,
+            'result': self.result,
+            'error': self.error,
+            'version': self.version,
+        }
+
+
+class StoredJob:
+    """
+    他のプロセスが計算しているジョブ (JobStore の状態を読む)。Job と同じように状態の取得・更新待ちができる。
+    """
+
+    def __init__(self, store, state):
+        self.store = store
+        self.id = state['job_id']
+        self._state = state
+
+    @property
+    def status(self):
+        return self._state['status']
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def _reload(self):
+        state = self.store.load(self.id)
+        if state is None: # 期限切れで削除された
+            state = dict(self._state, status=CANCELLED, version=self._state['version'] + 1)
+        self._state = state
+
+    def wait_for_update(self, version, timeout=None):
+        """version より新しい状態になるか終了するまで POLL_INTERVAL ごとに読み直して待ち、現在の version を返す"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._reload()
+            if self._state['version'] != version or self.finished:
+                return self._state['version']
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return self._state['version']
+            time.sleep(POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining))
+
+    def snapshot(self):
+        """API で返す状態の辞書 (JobStore から読み直す)"""
+        self._reload()
+        return dict(self._state)
+
+
+class JobManager:
+    """ジョブの登録・実行・キャンセル・期限切れ削除 (db_path を指定すると状態を全プロセスで共有する)"""
+
+    def __init__(self, max_workers=2, ttl=600, db_path=None):
+        self.ttl = ttl
+        self.store = JobStore(db_path) if db_path else None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='poker-job')
+
+    def submit(self, fn):
+        """fn(job) をバックグラウンドで実行するジョブを登録し、Job を返す (fn の戻り値が結果になる)"""
+        self.purge_expired()
+        job = Job(uuid.uuid4().hex, self.store)
+        with self._lock:
+            self._jobs[job.id] = job
+        job._update() # 他のプロセスからも見えるようにする
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def completed(self, result):
+        """計算済みの結果 (キャッシュヒットなど) をそのまま完了済みジョブとして登録する"""
+        self.purge_expired()
+        job = Job(uuid.uuid4().hex, self.store)
+        job._update(status=DONE, progress=1.0, result=result, finished_at=time.time())
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def _run(self, job, fn):
+        if job.cancel_requested():
+            job._update(status=CANCELLED, finished_at=time.time())
+            return
+        job._update(status=RUNNING)
+        try:
+            result = fn(job)
+        except JobCancelled:
+            job._update(status=CANCELLED, finished_at=time.time())
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            job._update(status=FAILED, error=f'{type(e).__name__}: {e}', finished_at=time.time())
+        else:
+            job._update(status=DONE, progress=1.0, result=result, finished_at=time.time())
+
+    def get(self, job_id):
+        """ジョブを返す (他のプロセスのジョブは StoredJob。存在しないか期限切れなら None)"""
+        self.purge_expired()
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            state = self.store.load(job_id)
+            if state is not None:
+                job = StoredJob(self.store, state)
+        return job
+
+    def cancel(self, job_id):
+        """キャンセルを要求する。実行待ちなら即座に、実行中なら次の report で打ち切られる"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if isinstance(job, StoredJob):
+            if not job.finished:
+                self.store.request_cancel(job_id)
+        elif not job.finished:
+            job._cancel_requested.set()
+            if job.status == QUEUED:
+                job._update(status=CANCELLED, finished_at=time.time())
+        return job
+
+    def purge_expired(self):
+        """終了から ttl 秒以上経ったジョブを削除する"""
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at is not None and now - job.finished_at >= self.ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
+        if self.store is not None:
+            self.store.purge(self.ttl)
+        return len(expired)
@@ -0,0 +1,166 @@
+"""
+python エンジンの勝率シミュレーションのカーネル
+
+デッキは整数 ID のリストを 1 つだけ作って使い回し、試行ごとに両プレイヤーが引く枚数分だけ
+部分 Fisher–Yates シャッフルでその場で並べ替える (前の試行の並びから続けても一様になる)。
+先頭 k1 枚が P1、続く k2 枚が P2 のドロー。評価は保持カードの素数積とスートのビットを
+事前に計算しておき、引いたカードの分だけ掛け合わせて evaluator のテーブルを引く。
+試行ごとに set / list / tuple を作らない。
+勝敗と同時に両プレイヤーの最終ハンドのカテゴリも数える (確率と勝率が同じ試行から得られる)。
+
+乱数はリクエストごとの random.Random を使い、同じシードなら同じ結果になる。
+"""
+import random
+
+from evaluator import CARD_PRIME, CARD_SUIT, CATEGORY_SHIFT, FLUSH_TABLE, NUM_CARDS, NUM_CATEGORIES, RANK_TABLE
+
+_SUIT_BIT = [1 << suit for suit in CARD_SUIT]
+
+
+def _kept_state(kept_ids):
+    """保持カードの (素数積, スートのビット和)"""
+    key = 1
+    suit_bits = 0
+    for cid in kept_ids:
+        key *= CARD_PRIME[cid]
+        suit_bits |= _SUIT_BIT[cid]
+    return key, suit_bits
+
+def simulate_spot(p1_ids, p2_ids, num_trials, rng=None, progress=None, progress_interval=0):
+    """
+    両プレイヤーのドローを num_trials 回シミュレートし、
+    (P1勝ち, P2勝ち, 引き分け, P1 のカテゴリ別回数, P2 のカテゴリ別回数, ハンド例) を返す。
+    ハンド例は最後の試行の (P1 の 5 枚, P2 の 5 枚) の ID リスト。
+    rng は random.Random (省略時は新しく作る)。
+    progress を指定すると progress_interval 試行ごとに progress(完了した試行数, ここまでの (P1勝ち, P2勝ち, 引き分け)) を呼ぶ。
+    """
+    rng = rng or random.Random()
+    excluded = set(p1_ids) | set(p2_ids)
+    deck = [cid for cid in range(NUM_CARDS) if cid not in excluded]
+    n = len(deck)
+    k1 = 5 - len(p1_ids)
+    need = k1 + 5 - len(p2_ids)
+    if need > n:
+        raise ValueError('Not enough cards in deck to draw')
+    key1_kept, bits1_kept = _kept_state(p1_ids)
+    key2_kept, bits2_kept = _kept_state(p2_ids)
+    p1_shuffle = [(j, n - j) for j in range(k1)]
+    p2_shuffle = [(j, n - j) for j in range(k1, need)]
+
+    # ループ内で参照するものはローカル変数に (属性・グローバル参照を避ける)
+    rand = rng.random
+    prime = CARD_PRIME
+    suit_bit = _SUIT_BIT
+    rank_table = RANK_TABLE
+    flush_table = FLUSH_TABLE
+    shift = CATEGORY_SHIFT
+    p1_categories = [0] * NUM_CATEGORIES
+    p2_categories = [0] * NUM_CATEGORIES
+    p1_wins = p2_wins = ties = 0
+    interval = progress_interval if progress and progress_interval > 0 else num_trials + 1
+
+    for trial in range(1, num_trials + 1):
+        # 部分 Fisher–Yates: j 番目に残り (j 番目以降) から選んだカードを置き、そのまま手札に加える
+        key = key1_kept
+        bits = bits1_kept
+        for j, remaining in p1_shuffle:
+            r = j + int(rand() * remaining)
+            c = deck[r]
+            deck[r] = deck[j]
+            deck[j] = c
+            key *= prime[c]
+            bits |= suit_bit[c]
+        # スートのビットが 1 つだけならフラッシュ
+        s1 = flush_table[key] if bits & (bits - 1) == 0 else rank_table[key]
+
+        key = key2_kept
+        bits = bits2_kept
+        for j, remaining in p2_shuffle:
+            r = j + int(rand() * remaining)
+            c = deck[r]
+            deck[r] = deck[j]
+            deck[j] = c
+            key *= prime[c]
+            bits |= suit_bit[c]
+        s2 = flush_table[key] if bits & (bits - 1) == 0 else rank_table[key]
+
+        p1_categories[s1 >> shift] += 1
+        p2_categories[s2 >> shift] += 1
+        if s1 < s2:
+            p1_wins += 1
+        elif s2 < s1:
+            p2_wins += 1
+        else:
+            ties += 1
+        if trial % interval == 0:
+            progress(trial, (p1_wins, p2_wins, ties))
+    example = (list(p1_ids) + deck[:k1], list(p2_ids) + deck[k1:need])
+    return p1_wins, p2_wins, ties, p1_categories, p2_categories, example
+
+def simulate_multiway(kept_id_lists, num_trials, rng=None):
+    """
+    3 人以上 (2 人でも可) のドローを num_trials 回シミュレートし、プレイヤーごとの
+    (単独勝ちの回数のリスト, 引き分けで分け合った回数のリスト, 獲得したポットの合計のリスト) を返す。
+    全員のドローを 1 つのデッキの先頭から順に割り当て、最小の strength を持つプレイヤーが勝つ。
+    1 試行あたりの手数はプレイヤー数に比例する。
+    """
+    rng = rng or random.Random()
+    excluded = set()
+    for kept in kept_id_lists:
+        excluded.update(kept)
+    deck = [cid for cid in range(NUM_CARDS) if cid not in excluded]
+    n = len(deck)
+    # プレイヤーごとの (保持カードの素数積, スートのビット, 引くカードの位置)
+    players = []
+    position = 0
+    for kept in kept_id_lists:
+        key, bits = _kept_state(kept)
+        num_to_draw = 5 - len(kept)
+        players.append((key, bits, [(j, n - j) for j in range(position, position + num_to_draw)]))
+        position += num_to_draw
+    if position > n:
+        raise ValueError('Not enough cards in deck to draw')
+
+    num_players = len(players)
+    rand = rng.random
+    prime = CARD_PRIME
+    suit_bit = _SUIT_BIT
+    rank_table = RANK_TABLE
+    flush_table = FLUSH_TABLE
+    strengths = [0] * num_players
+    wins = [0] * num_players
+    splits = [0] * num_players
+    shares = [0.0] * num_players
+
+    for _ in range(num_trials):
+        best = -1
+        best_count = 0
+        i = 0
+        for key, bits, shuffle in players:
+            # 部分 Fisher–Yates で自分の分だけ引く (前のプレイヤーが引いたカードは先頭側に確定済み)
+            for j, remaining in shuffle:
+                r = j + int(rand() * remaining)
+                c = deck[r]
+                deck[r] = deck[j]
+                deck[j] = c
+                key *= prime[c]
+                bits |= suit_bit[c]
+            s = flush_table[key] if bits & (bits - 1) == 0 else rank_table[key]
+            strengths[i] = s
+            if best < 0 or s < best:
+                best = s
+                best_count = 1
+            elif s == best:
+                best_count += 1
+            i += 1
+        if best_count == 1:
+            winner = strengths.index(best)
+            wins[winner] += 1
+            shares[winner] += 1
+        else:
+            share = 1 / best_count
+            for i in range(num_players):
+                if strengths[i] == best:
+                    splits[i] += 1
+                    shares[i] += share
+    return wins, splits, shares
@@ -0,0 +1,331 @@
+"""
+計測 (カウンタ・ヒストグラム・フェーズごとのタイマー) と Prometheus テキスト形式での出力
+
+    registry = Registry(enabled=True)
+    trials = registry.counter('poker_trials_total', '試行数')
+    trials.inc(10000, engine='numpy')
+    phase = registry.histogram('poker_phase_seconds', 'フェーズごとの所要時間')
+    with phase.time(phase='win_rate'):
+        ...
+    @phase.timed(phase='probabilities')
+    def calculate(...): ...
+    registry.render()  # /metrics のレスポンス本文
+
+計測はリクエストやフェーズの単位でのみ行い、試行ごとのループの中には入れない。
+無効 (enabled=False) のときは inc / observe は属性を 1 つ見て戻り、time は何もしないコンテキストを返す。
+
+計測値はプロセスごとに持つ。gunicorn の複数ワーカーでまとめるには directory を指定する
+(prometheus_client のマルチプロセスモードと同様)。各プロセスは flush で自分の値を directory/<pid>.json に書き、
+render は全ファイルを読んで合計する (どのワーカーがスクレイプに応えても同じ合計になる)。
+終了したワーカーのファイルは mark_process_dead で残し、カウンタ・ヒストグラムは引き続き合計に含める
+(合計が減らないように)。collector のゲージは生きているプロセスの分だけを合計する。
+"""
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+# Prometheus クライアントの既定値に長い計算用の 30 秒・60 秒を加えたもの
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_NULL_TIMER = nullcontext()
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _dump_key(key):
+    return [list(pair) for pair in key]
+
+def _load_key(key):
+    return tuple(tuple(pair) for pair in key)
+
+
+class Counter:
+    """ラベルの組ごとに単調増加する値"""
+
+    def __init__(self, registry, name, help_text):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def dump(self):
+        """flush でファイルに書く形式の値"""
+        with self._lock:
+            return [[_dump_key(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(dumps):
+        """複数プロセスの dump を合計する"""
+        values = {}
+        for dump in dumps:
+            for key, value in dump:
+                key = _load_key(key)
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def render(self, values=None):
+        """values (merge の結果) を省略するとこのプロセスの値を出力する"""
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(key)} {_format_value(value)}')
+        return lines
+
+
+class _Timer:
+    """with ブロックの所要時間 (秒) をヒストグラムに記録する"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram:
+    """ラベルの組ごとの観測値の分布 (累積バケット・合計・件数)"""
+
+    def __init__(self, registry, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # ラベル -> [バケットごとの件数 (累積でない), 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """with で使うと、ブロックの所要時間を記録する (無効なら何もしない)"""
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def timed(self, **labels):
+        """関数の所要時間を記録するデコレータ (有効かどうかは呼び出しのたびに見る)"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.registry.enabled:
+                    return fn(*args, **kwargs)
+                with _Timer(self, labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(_label_key(labels))
+            return series[2] if series else 0
+
+    def dump(self):
+        """flush でファイルに書く形式の値"""
+        with self._lock:
+            return [[_dump_key(key), list(counts), total, count] for key, (counts, total, count) in self._series.items()]
+
+    @staticmethod
+    def merge(dumps):
+        """複数プロセスの dump を合計する (バケットは全プロセスで同じ)"""
+        series = {}
+        for dump in dumps:
+            for key, counts, total, count in dump:
+                key = _load_key(key)
+                merged = series.get(key)
+                if merged is None:
+                    series[key] = [list(counts), total, count]
+                else:
+                    merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                    merged[1] += total
+                    merged[2] += count
+        return series
+
+    def render(self, series=None):
+        """series (merge の結果) を省略するとこのプロセスの値を出力する"""
+        if series is None:
+            with self._lock:
+                series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(key, [("le", le)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+class Registry:
+    """
+    計測値の集まり。enabled を False にすると記録しない (登録済みの値は render で出力される)。
+    directory を指定すると、render は directory にある全プロセスの値を合計して出力する。
+    """
+
+    def __init__(self, enabled=True, directory=None):
+        self.enabled = enabled
+        self.directory = directory
+        self._metrics = []
+        self._collectors = []
+        self._last_flush = 0.0
+        self._pending_flush = None # 間引いた書き出しを後で行うタイマー
+        self._flush_lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help_text):
+        metric = Counter(self, name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self, name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """
+        render のたびに呼ばれる関数を登録する (デコレータとしても使える)。
+        fn は (名前, 種類, 説明, [(ラベルの辞書, 値), ...]) のリストを返す。キャッシュの件数など、他で数えている値の出力用。
+        """
+        self._collectors.append(fn)
+        return fn
+
+    def _collect(self):
+        """collector の値を (名前, 種類, 説明, [(ラベルのキー, 値), ...]) のリストで返す"""
+        return [(name, kind, help_text, [(_label_key(labels), value) for labels, value in samples])
+                for fn in self._collectors for name, kind, help_text, samples in fn()]
+
+    def flush(self, min_interval=0.0):
+        """
+        このプロセスの値を directory/<pid>.json に書き出す (directory がなければ何もしない)。
+        前回から min_interval 秒以内ならその場では書かず、間隔が空いたときに書く
+        (リクエストごとに呼ぶ場合の間引き。その後リクエストが来なくても最後の値が書き出される)。
+        """
+        if not self.directory:
+            return
+        with self._flush_lock:
+            wait = self._last_flush + min_interval - time.monotonic()
+            if wait > 0:
+                if self._pending_flush is None:
+                    self._pending_flush = threading.Timer(wait, self.flush)
+                    self._pending_flush.daemon = True
+                    self._pending_flush.start()
+                return
+            self._last_flush = time.monotonic()
+            self._pending_flush = None
+            # ロックの中で書くので、後から書いた値が先に書いた値で上書きされない
+            state = {
+                'metrics': {metric.name: metric.dump() for metric in self._metrics},
+                'collected': [[name, kind, help_text, [[_dump_key(key), value] for key, value in samples]]
+                              for name, kind, help_text, samples in self._collect()],
+            }
+            path = os.path.join(self.directory, f'{os.getpid()}.json')
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(state, f)
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                logger.warning("Could not write metrics to %s: %s", path, e)
+
+    def _load_states(self):
+        """directory の全プロセスの (値, 生きているか) のリスト"""
+        states = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    states.append((json.load(f), not filename.endswith('.dead.json')))
+            except (OSError, ValueError) as e:
+                logger.warning("Could not read metrics file %s: %s", filename, e)
+        return states
+
+    def render(self):
+        """全ての計測値を Prometheus のテキスト形式 (version 0.0.4) で返す (directory があれば全プロセスの合計)"""
+        if not self.directory:
+            metric_lines = [metric.render() for metric in self._metrics]
+            collected = self._collect()
+        else:
+            self.flush()
+            states = self._load_states()
+            metric_lines = [metric.render(metric.merge(state['metrics'].get(metric.name, []) for state, _ in states))
+                            for metric in self._metrics]
+            merged = {} # 名前 -> (種類, 説明, {ラベルのキー: 合計})
+            for state, alive in states:
+                for name, kind, help_text, samples in state['collected']:
+                    if kind == 'gauge' and not alive:
+                        continue
+                    values = merged.setdefault(name, (kind, help_text, {}))[2]
+                    for key, value in samples:
+                        key = _load_key(key)
+                        values[key] = values.get(key, 0) + value
+            collected = [(name, kind, help_text, sorted(values.items()))
+                         for name, (kind, help_text, values) in merged.items()]
+        lines = []
+        for metric in metric_lines:
+            lines.extend(metric)
+        for name, kind, help_text, samples in collected:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in samples:
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def mark_process_dead(directory, pid):
+    """
+    終了したプロセス pid のファイルを残したまま終了済みにする (gunicorn の child_exit から呼ぶ)。
+    カウンタ・ヒストグラムは合計に残り、ゲージは除かれる。
+    """
+    path = os.path.join(directory, f'{pid}.json')
+    if os.path.exists(path):
+        os.replace(path, os.path.join(directory, f'{pid}-{time.time_ns()}.dead.json'))
@@ -0,0 +1,163 @@
+"""
+シミュレーションをプロセスプールで並列実行するモジュール
+
+試行はワーカー数に関係なく SHARD_TRIALS ごとのシャードに分割し、
+各シャードにはリクエスト単位のシードから SeedSequence.spawn で導いたシードを渡す。
+シャードの結果は足し合わせるだけなので、ワーカー数を変えても結果はビット単位で同じになる。
+
+プールはプロセスごとに 1 つだけ遅延生成して使い回す。gunicorn の pre-fork で
+親プロセスのプールを子が引き継がないよう、fork 後の子プロセスでは参照を破棄する。
+
+プールは gunicorn のワーカーごとに作られるので、既定のプールサイズは CPU 数をワーカー数で割った値にする
+(ワーカー数は WEB_CONCURRENCY、gunicorn.conf.py で起動した場合は実際の設定値を set_workers で反映する)。
+ワーカーあたり 1 以下になる場合は並列化しない。POKER_POOL_SIZE を指定した場合はワーカーごとにその数を使う
+(全体のプロセス数は ワーカー数 x POKER_POOL_SIZE になる)。
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from vectorized import simulate_multiway_counts, simulate_spot_counts
+
+def default_pool_size(workers=1):
+    """プロセス (gunicorn のワーカー) workers 個で CPU を分け合う場合の 1 プロセスあたりのプールサイズ"""
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+# プールのワーカー数 (環境変数 POKER_POOL_SIZE で指定、0 または 1 なら並列化しない)
+POOL_SIZE = int(os.environ.get('POKER_POOL_SIZE', default_pool_size(int(os.environ.get('WEB_CONCURRENCY', 1)))))
+# 1 シャードあたりの試行数 (ワーカー数ではなくこの値で分割するので結果が再現できる)
+SHARD_TRIALS = 1 << 17
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+# --- プール管理 ---
+def get_pool():
+    """このプロセス用のプールを返す (初回呼び出し時に生成)"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # spawn で起動する (スレッドを持つ gunicorn ワーカーからの fork を避ける)
+            _pool = ProcessPoolExecutor(max_workers=POOL_SIZE, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        return _pool
+
+def set_workers(workers):
+    """
+    プールを持つプロセスの数 (gunicorn のワーカー数) に合わせて既定のプールサイズを決め直す
+    (POKER_POOL_SIZE を指定している場合は何もしない)。プールを作る前 (fork 前) に呼ぶ。
+    """
+    global POOL_SIZE
+    if 'POKER_POOL_SIZE' not in os.environ:
+        POOL_SIZE = default_pool_size(workers)
+
+def shutdown_pool():
+    """プールを停止する (次回の get_pool で作り直される)"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _pool_pid = None
+
+def _forget_pool_after_fork():
+    # 子プロセスは親のプールを使えないので参照だけ捨てる (shutdown は親に任せる)
+    global _pool, _pool_pid, _pool_lock
+    _pool = None
+    _pool_pid = None
+    _pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_pool_after_fork)
+atexit.register(shutdown_pool)
+
+
+# --- シャード ---
+def new_seed():
+    """リクエスト用のシードを新しく生成する"""
+    return int(np.random.SeedSequence().entropy)
+
+def shard_plan(num_trials, seed):
+    """(試行数, SeedSequence) のシャードのリストを返す"""
+    num_shards = max(1, -(-num_trials // SHARD_TRIALS))
+    seeds = np.random.SeedSequence(seed).spawn(num_shards)
+    sizes = [SHARD_TRIALS] * (num_shards - 1) + [num_trials - SHARD_TRIALS * (num_shards - 1)]
+    return list(zip(sizes, seeds))
+
+def _spot_shard(p1_ids, p2_ids, num_trials, seed_seq):
+    return simulate_spot_counts(p1_ids, p2_ids, num_trials, np.random.default_rng(seed_seq))
+
+def _multiway_shard(kept_id_lists, num_trials, seed_seq):
+    return simulate_multiway_counts(kept_id_lists, num_trials, np.random.default_rng(seed_seq))
+
+def _collect(results_iter, plan, on_result):
+    results = []
+    for (size, _), result in zip(plan, results_iter):
+        results.append(result)
+        if on_result is not None:
+            on_result(size, result)
+    return results
+
+def _collect_futures(futures, plan, on_result):
+    try:
+        return _collect((f.result() for f in futures), plan, on_result)
+    except BaseException:
+        # 途中で打ち切られた場合 (キャンセルなど) は残りのシャードを取り消す
+        for f in futures:
+            f.cancel()
+        raise
+
+def run_sharded(shard_fn, args, num_trials, seed, parallel=True, on_result=None):
+    """
+    shard_fn(*args, シャードの試行数, SeedSequence) を各シャードで実行し、結果のリストを返す。
+    parallel=False またはプールサイズが 1 以下ならこのプロセス内で順に実行する (結果は同じ)。
+    on_result を指定すると、シャードの結果が揃うたびに順番に on_result(シャードの試行数, 結果) を呼ぶ。
+    """
+    plan = shard_plan(num_trials, seed)
+    if not parallel or POOL_SIZE <= 1 or len(plan) == 1:
+        return _collect((shard_fn(*args, size, seed_seq) for size, seed_seq in plan), plan, on_result)
+    try:
+        futures = [get_pool().submit(shard_fn, *args, size, seed_seq) for size, seed_seq in plan]
+        return _collect_futures(futures, plan, on_result)
+    except BrokenProcessPool:
+        # ワーカーが落ちた場合はプールを作り直して一度だけやり直す
+        shutdown_pool()
+        futures = [get_pool().submit(shard_fn, *args, size, seed_seq) for size, seed_seq in plan]
+        return _collect_futures(futures, plan, on_result)
+
+
+# --- シミュレーション ---
+def sharded_spot_counts(p1_ids, p2_ids, num_trials, seed, parallel=True, progress=None):
+    """
+    シャードに分けて勝敗と両プレイヤーのカテゴリをシミュレートし、
+    (P1勝ち, P2勝ち, 引き分け, P1 のカテゴリ別回数, P2 のカテゴリ別回数, ハンド例, シャード数) を返す。
+    progress を指定すると、シャードごとに progress(完了した試行数, 全試行数, ここまでの (P1勝ち, P2勝ち, 引き分け)) を呼ぶ。
+    """
+    done = [0, 0, 0, 0]
+    def report(size, result):
+        done[0] += size
+        for i in range(3):
+            done[i + 1] += result[i]
+        progress(done[0], num_trials, tuple(done[1:]))
+    on_result = report if progress is not None else None
+    results = run_sharded(_spot_shard, (sorted(p1_ids), sorted(p2_ids)), num_trials, seed, parallel, on_result)
+    p1_wins = sum(r[0] for r in results)
+    p2_wins = sum(r[1] for r in results)
+    ties = sum(r[2] for r in results)
+    p1_categories = np.sum([r[3] for r in results], axis=0)
+    p2_categories = np.sum([r[4] for r in results], axis=0)
+    return p1_wins, p2_wins, ties, p1_categories, p2_categories, results[-1][5], len(results)
+
+def sharded_multiway_counts(kept_id_lists, num_trials, seed, parallel=True):
+    """シャードに分けて複数プレイヤーの勝敗をシミュレートし、(単独勝ち, 分け合い, 獲得ポット, シャード数) の配列を返す"""
+    results = run_sharded(_multiway_shard, ([sorted(kept) for kept in kept_id_lists],), num_trials, seed, parallel)
+    wins = np.sum([r[0] for r in results], axis=0)
+    splits = np.sum([r[1] for r in results], axis=0)
+    shares = np.sum([r[2] for r in results], axis=0)
+    return wins, splits, shares, len(results)
@@ -0,0 +1,243 @@
+"""
+相手の保持カードをレンジ (重み付きの候補の集まり) で指定したときの勝率
+
+レンジ表記はカンマ区切りの項で、各項に @重み を付けられる (省略時は 1)。
+  7432, KK, T98     ランクを指定した保持カード (スートは全通り)。末尾 s で同スートのみ、o で同スート以外
+  draw3-8           異なるランク 3 枚で最高ランクが 8 以下の保持カード全て (draw0 は 5 枚全部引く)
+  pat-9             ストレート・フラッシュでない 5 枚 (役なし) で最高ランクが 9 以下のパット全て
+例: "pat-9, draw4-8@0.5, draw3-7@0.25"
+同じ組み合わせが複数の項に含まれる場合は大きい方の重みを使う。
+
+組み合わせごとにシミュレーションはせず、P1 から見て勝率が必ず同じになる組み合わせをバケットにまとめ、
+バケットごとに代表の組み合わせを 1 回だけ計算して (生きている組み合わせ数 x 重み) で加重平均する。
+  - どちらもフラッシュになりえない場合、勝率はランクだけで決まる (バケット = 相手のランク多重集合。
+    数は組み合わせを列挙せずに数える)
+  - P1 だけがスート f でフラッシュになりうる場合、相手のランクと相手のスート f のカードだけで決まる
+  - それ以外はスートの付け替えで同じになる局面 (result_cache.canonicalize) ごと
+P1 のカードと重なる組み合わせは除く (カードの除去効果)。
+"""
+import re
+from collections import Counter
+from itertools import combinations, product
+from math import comb, sqrt
+
+import numpy as np
+
+from adaptive import Z_95, equity_interval
+from equity import EXACT_COST_LIMIT, estimate_exact_cost, exact_spot_counts, flush_suits
+from evaluator import NUM_CATEGORIES
+from result_cache import canonicalize
+from vectorized import simulate_spot_counts
+
+RANK_CHARS = '23456789TJQKA'
+# 全列挙するバケットの内部ループ回数の合計の上限 (超える分はサンプリング)
+EXACT_BUDGET = EXACT_COST_LIMIT
+# サンプリングで求めるバケット 1 つあたりの最小試行数
+MIN_BUCKET_TRIALS = 2000
+# 組み合わせを列挙してバケットに分ける場合の上限 (これを超えるレンジはエラー)
+MAX_ENUMERATED_COMBOS = 300000
+
+_TERM = re.compile(
+    r'^(?:PAT-(?P<pat>[2-9TJQKA])'
+    r'|DRAW(?P<draw>[0-4])(?:-(?P<high>[2-9TJQKA]))?'
+    r'|(?P<ranks>[2-9TJQKA]{1,5})(?P<suit>[SO]?))$'
+)
+
+_FLUSH = 'flush' # 同スート (フラッシュの可能性あり。0〜1 枚の保持も含む)
+_PLAIN = 'plain' # 複数のスート (フラッシュにならない)
+
+
+# --- レンジ表記の解析 ---
+def _is_straight(ranks):
+    return len(set(ranks)) == 5 and max(ranks) - min(ranks) == 4
+
+def parse_range(expression):
+    """
+    レンジ表記を解析し、(ランク多重集合, スートの種類) -> 重み の辞書を返す。
+    ランク多重集合はランク番号 (0='2' .. 12='A') の昇順タプル、スートの種類は 'flush' か 'plain'。
+    表記が不正な場合は ValueError を送出する。
+    """
+    if not isinstance(expression, str) or not expression.strip():
+        raise ValueError('レンジが空です')
+    weights = {}
+
+    def add(ranks, classes, weight):
+        for cls in classes:
+            # 2 枚以上の同スートは異なるランクのみ、2 枚以上でないと複数スートにならない
+            if cls == _FLUSH and len(ranks) >= 2 and len(set(ranks)) != len(ranks):
+                continue
+            if cls == _PLAIN and len(ranks) < 2:
+                continue
+            key = (ranks, cls)
+            weights[key] = max(weights.get(key, 0), weight)
+
+    for term in expression.upper().replace('10', 'T').split(','):
+        term = term.strip()
+        weight = 1.0
+        if '@' in term:
+            term, weight_text = term.split('@', 1)
+            term = term.strip()
+            try:
+                weight = float(weight_text)
+            except ValueError:
+                raise ValueError(f'無効な重み: {weight_text.strip()}') from None
+            if not weight > 0:
+                raise ValueError(f'重みは正の数で指定してください: {weight_text.strip()}')
+        match = _TERM.match(term)
+        if not match:
+            raise ValueError(f'無効なレンジの項: {term}')
+        if match.group('pat'):
+            high = RANK_CHARS.index(match.group('pat'))
+            for ranks in combinations(range(high + 1), 5):
+                if not _is_straight(ranks):
+                    add(ranks, (_PLAIN,), weight)
+        elif match.group('draw'):
+            num_cards = int(match.group('draw'))
+            high = RANK_CHARS.index(match.group('high')) if match.group('high') else len(RANK_CHARS) - 1
+            for ranks in combinations(range(high + 1), num_cards):
+                add(ranks, (_FLUSH, _PLAIN), weight)
+        else:
+            ranks = tuple(sorted(RANK_CHARS.index(c) for c in match.group('ranks')))
+            if max(Counter(ranks).values()) > 4:
+                raise ValueError(f'同じランクは4枚までです: {term}')
+            suit = match.group('suit')
+            if suit and len(ranks) < 2:
+                raise ValueError(f's / o は2枚以上の保持カードにのみ指定できます: {term}')
+            if suit == 'S' and len(set(ranks)) != len(ranks):
+                raise ValueError(f'同じランクを含む保持カードは同スートにできません: {term}')
+            classes = {'S': (_FLUSH,), 'O': (_PLAIN,)}.get(suit, (_FLUSH, _PLAIN))
+            add(ranks, classes, weight)
+    return weights
+
+
+# --- バケット分け ---
+def _suit_combos(ranks, p1_cards):
+    """ランク多重集合の全スート割り当て (P1 のカードを含まないもの) を ID タプルで列挙する"""
+    per_rank = []
+    for rank, count in sorted(Counter(ranks).items()):
+        choices = [tuple(rank * 4 + s for s in suits) for suits in combinations(range(4), count)]
+        per_rank.append([cards for cards in choices if not p1_cards.intersection(cards)])
+    for parts in product(*per_rank):
+        yield tuple(cid for part in parts for cid in part)
+
+def _is_flush_class(combo):
+    return len({cid & 3 for cid in combo}) <= 1
+
+def _bucket_key(p1_ids, p1_suits, combo):
+    """P1 から見て勝率が同じになる組み合わせに共通のキー"""
+    ranks = tuple(sorted(cid >> 2 for cid in combo))
+    if not _is_flush_class(combo):
+        if not p1_suits:
+            return ('ranks', ranks)
+        if len(p1_suits) == 1:
+            # P1 はスート f でのみフラッシュになりうる: 相手の f のカードだけが関係する
+            f = p1_suits[0]
+            return ('ranks-suit', ranks, tuple(sorted(cid >> 2 for cid in combo if cid & 3 == f)))
+        # P1 が 5 枚引く (全スートでフラッシュになりうる): スートごとの相手のランクの集まり
+        per_suit = sorted(tuple(sorted(cid >> 2 for cid in combo if cid & 3 == s)) for s in range(4))
+        return ('ranks-suits', ranks, tuple(per_suit))
+    return ('canonical', canonicalize(p1_ids, combo)[0])
+
+def range_buckets(p1_ids, weights):
+    """
+    P1 の保持カードに対してレンジをバケットに分け、
+    キー -> [代表の組み合わせ, 重み付き組み合わせ数の合計, 組み合わせ数] の辞書を返す。
+    """
+    p1_cards = set(p1_ids)
+    p1_suits = flush_suits(p1_ids) if len(p1_ids) < 5 else []
+    buckets = {}
+    enumerated = 0
+    for (ranks, cls), weight in weights.items():
+        if cls == _PLAIN and not p1_suits:
+            # どちらもフラッシュにならない: 勝率はランクだけで決まるので数えるだけ
+            total = 1
+            for rank, count in Counter(ranks).items():
+                total *= comb(sum(1 for s in range(4) if rank * 4 + s not in p1_cards), count)
+            suited = 0
+            if len(set(ranks)) == len(ranks):
+                suited = sum(1 for s in range(4) if all(r * 4 + s not in p1_cards for r in ranks))
+            count = total - suited
+            if not count:
+                continue
+            representative = next(c for c in _suit_combos(ranks, p1_cards) if not _is_flush_class(c))
+            key = ('ranks', ranks)
+            bucket = buckets.setdefault(key, [representative, 0.0, 0])
+            bucket[1] += weight * count
+            bucket[2] += count
+            continue
+        for combo in _suit_combos(ranks, p1_cards):
+            if (cls == _FLUSH) != _is_flush_class(combo):
+                continue
+            enumerated += 1
+            if enumerated > MAX_ENUMERATED_COMBOS:
+                raise ValueError('レンジが大きすぎます (この手札に対しては組み合わせを絞ってください)')
+            bucket = buckets.setdefault(_bucket_key(p1_ids, p1_suits, combo), [combo, 0.0, 0])
+            bucket[1] += weight
+            bucket[2] += 1
+    return buckets
+
+
+# --- 勝率 ---
+def range_equity(p1_ids, weights, num_simulations=10000, seed=None):
+    """
+    P1 の保持カード p1_ids とレンジ (parse_range の結果) の勝率を計算する。
+    バケットごとに全列挙 (軽いものから EXACT_BUDGET まで、残りはサンプリング) し、
+    重み付き組み合わせ数で加重平均する。
+    戻り値: {'player1_wins', 'player2_wins', 'ties', 'equity', 'equity_interval', 'combos', 'buckets',
+             'exact_buckets', 'player1_categories', 'player2_categories', 'example_keep'}
+    カテゴリは長さ NUM_CATEGORIES の確率のリスト、example_keep は最も重いバケットの代表の組み合わせ。
+    """
+    p1_ids = sorted(p1_ids)
+    buckets = range_buckets(p1_ids, weights)
+    if not buckets:
+        raise ValueError('P1 のカードと重ならない組み合わせがレンジにありません')
+    total_weight = sum(bucket[1] for bucket in buckets.values())
+    seeds = np.random.SeedSequence(seed).spawn(len(buckets))
+
+    win = lose = tie = 0.0
+    variance = 0.0
+    cat1 = [0.0] * NUM_CATEGORIES
+    cat2 = [0.0] * NUM_CATEGORIES
+    exact_buckets = 0
+    budget = EXACT_BUDGET
+    costs = [estimate_exact_cost(p1_ids, bucket[0]) for bucket in buckets.values()]
+    exact = set() # 全列挙するバケットの番号
+    for i in sorted(range(len(costs)), key=costs.__getitem__):
+        if costs[i] > budget:
+            break
+        budget -= costs[i]
+        exact.add(i)
+    for i, ((representative, weight, _), seed_seq) in enumerate(zip(buckets.values(), seeds)):
+        share = weight / total_weight
+        if i in exact:
+            w, l, t, c1, c2 = exact_spot_counts(p1_ids, representative)
+            exact_buckets += 1
+        else:
+            trials = max(MIN_BUCKET_TRIALS, round(num_simulations * share))
+            w, l, t, c1, c2, _ = simulate_spot_counts(p1_ids, representative, trials, np.random.default_rng(seed_seq))
+            low, high = equity_interval(w, t, trials)
+            variance += (share * (high - low) / (2 * Z_95)) ** 2
+        n = w + l + t
+        win += share * w / n
+        lose += share * l / n
+        tie += share * t / n
+        for c in range(NUM_CATEGORIES):
+            cat1[c] += share * int(c1[c]) / n
+            cat2[c] += share * int(c2[c]) / n
+
+    equity = win + tie / 2
+    half = Z_95 * sqrt(variance)
+    heaviest = max(buckets.values(), key=lambda bucket: bucket[1])
+    return {
+        'player1_wins': win,
+        'player2_wins': lose,
+        'ties': tie,
+        'equity': equity,
+        'equity_interval': [max(0.0, equity - half), min(1.0, equity + half)],
+        'combos': sum(bucket[2] for bucket in buckets.values()),
+        'buckets': len(buckets),
+        'exact_buckets': exact_buckets,
+        'player1_categories': cat1,
+        'player2_categories': cat2,
+        'example_keep': list(heaviest[0]),
+    }
@@ -0,0 +1,184 @@
+"""
+/api/calculate の結果キャッシュ
+
+スートを入れ替えただけの局面は同じ結果になるので、
+両プレイヤーのカードを 24 通りのスート置換のうち辞書順最小になる形 (正規形) に変換してキーにする。
+計算は正規形のカードで行い、スートに依存する出力 (ハンド例) は逆置換で元のスートに戻す。
+
+キャッシュはプロセス内の LRU と、任意で SQLite ファイル (gunicorn の全ワーカーで共有) の 2 段。
+SQLite の層はシードやバージョンごとに行が増えるので、件数の上限 (古い順に削除) と任意の有効期限を持つ。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from itertools import permutations
+
+logger = logging.getLogger(__name__)
+
+SUIT_PERMUTATIONS = list(permutations(range(4)))
+# この回数の書き込みごとに SQLite の層の期限切れ・上限超過の行を削除する
+PRUNE_INTERVAL = 100
+
+
+# --- スートの正規化 ---
+def relabel_ids(card_ids, perm):
+    """カード ID のスートを perm (元のスート番号 -> 新しいスート番号) で付け替える"""
+    return [(cid & ~3) | perm[cid & 3] for cid in card_ids]
+
+def invert_permutation(perm):
+    inverse = [0] * len(perm)
+    for src, dst in enumerate(perm):
+        inverse[dst] = src
+    return tuple(inverse)
+
+def canonicalize_players(id_groups):
+    """
+    プレイヤーごとのカード ID の集まりのリストについて、(ID タプルのタプル) の正規形と
+    元のスートから正規形への置換を返す。プレイヤーの順序は保つ。
+    """
+    best_key = None
+    best_perm = None
+    for perm in SUIT_PERMUTATIONS:
+        key = tuple(tuple(sorted(relabel_ids(ids, perm))) for ids in id_groups)
+        if best_key is None or key < best_key:
+            best_key = key
+            best_perm = perm
+    return best_key, best_perm
+
+def canonicalize(p1_ids, p2_ids):
+    """
+    (P1 の ID タプル, P2 の ID タプル) の正規形と、元のスートから正規形への置換を返す。
+    同じ正規形になる局面は、スートの付け替えを除いて同一の局面。
+    """
+    return canonicalize_players((p1_ids, p2_ids))
+
+
+# --- キャッシュ本体 ---
+class ResultCache:
+    """
+    文字列キー -> JSON 化できる値 のキャッシュ。
+    メモリ上の LRU (max_entries 件まで) と、db_path を指定した場合は SQLite の永続層を持つ。
+    永続層は max_disk_entries 件を超えた分を書き込みの古い順に削除し、ttl (秒) を指定すると
+    それより古い行を読まずに削除する (削除は PRUNE_INTERVAL 回の書き込みごとにまとめて行う)。
+    値は JSON 文字列で保持するので、get のたびに新しいオブジェクトが返る。
+    """
+
+    def __init__(self, max_entries=1024, db_path=None, max_disk_entries=100000, ttl=None):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _db(self):
+        """スレッド (とプロセス) ごとの SQLite 接続"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL DEFAULT 0)')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(results)')}
+            if 'stored_at' not in columns: # 書き込み時刻を持たない古いファイル (既存の行は最も古い扱い)
+                conn.execute('ALTER TABLE results ADD COLUMN stored_at REAL NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS results_stored_at ON results (stored_at)')
+            conn.commit()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """キャッシュされた値を返す (なければ None)"""
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(text)
+        if self.db_path:
+            try:
+                row = self._db().execute('SELECT value FROM results WHERE key = ? AND stored_at >= ?',
+                                         (key, self._expiry())).fetchone()
+            except sqlite3.Error as e:
+                logger.warning("Result cache read failed: %s", e)
+                row = None
+            if row is not None:
+                self._remember(key, row[0])
+                with self._lock:
+                    self.disk_hits += 1
+                return json.loads(row[0])
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """値を保存する"""
+        text = json.dumps(value, sort_keys=True)
+        self._remember(key, text)
+        if self.db_path:
+            try:
+                conn = self._db()
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO results (key, value, stored_at) VALUES (?, ?, ?)',
+                                 (key, text, time.time()))
+                with self._lock:
+                    self._writes += 1
+                    prune = self._writes % PRUNE_INTERVAL == 0
+                if prune:
+                    self.prune()
+            except sqlite3.Error as e:
+                logger.warning("Result cache write failed: %s", e)
+
+    def _expiry(self):
+        """これより前に書き込まれた行は期限切れ (ttl がなければ 0)"""
+        return time.time() - self.ttl if self.ttl else 0
+
+    def prune(self):
+        """永続層の期限切れの行と、max_disk_entries 件を超えた古い行を削除し、削除した件数を返す"""
+        if not self.db_path:
+            return 0
+        conn = self._db()
+        with conn:
+            deleted = conn.execute('DELETE FROM results WHERE stored_at < ?', (self._expiry(),)).rowcount
+            deleted += conn.execute(
+                'DELETE FROM results WHERE key IN '
+                '(SELECT key FROM results ORDER BY stored_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_disk_entries,)).rowcount
+        return deleted
+
+    def clear(self):
+        """メモリ上のエントリとカウンタを消す (永続層はそのまま)"""
+        with self._lock:
+            self._entries.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        """ヒット/ミスのカウンタ"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'persistent': bool(self.db_path),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,54 @@
+"""
+ドローの組み合わせを列挙・サンプリングするヘルパー
+
+組み合わせ全体を list にせず、組み合わせ番号 (combinadic) を引いてから
+その番号の組み合わせを復元する。使用メモリはサンプル数とドロー枚数にのみ比例する。
+"""
+import random
+from bisect import bisect_right
+from itertools import combinations
+from math import comb
+
+# 二項係数表 _BINOM[n][k] (デッキは最大 52 枚、ドローは最大 5 枚)
+_MAX_N = 52
+_MAX_K = 5
+_BINOM = [[comb(n, k) for k in range(_MAX_K + 1)] for n in range(_MAX_N + 1)]
+# 列ごとの表 _BINOM_COLUMNS[k][n] = C(n, k) (n について単調非減少なので二分探索できる)
+_BINOM_COLUMNS = [[_BINOM[n][k] for n in range(_MAX_N + 1)] for k in range(_MAX_K + 1)]
+
+
+def count_combinations(n, k):
+    """n 枚から k 枚選ぶ組み合わせ数"""
+    if n <= _MAX_N and k <= _MAX_K:
+        return _BINOM[n][k]
+    return comb(n, k)
+
+def unrank_combination(index, n, k):
+    """
+    0 <= index < C(n, k) の組み合わせ番号 (colex 順) から
+    k 個の位置 (降順のタプル) を復元する。
+    """
+    positions = []
+    upper = n # 次の位置は upper 未満
+    for i in range(k, 0, -1):
+        # C(c, i) <= index となる最大の c (< upper) を二分探索で求める
+        column = _BINOM_COLUMNS[i]
+        c = bisect_right(column, index, 0, upper) - 1
+        positions.append(c)
+        index -= column[c]
+        upper = c
+    return tuple(positions)
+
+def sample_combinations(pool, k, num_samples, rng=random):
+    """
+    pool から k 枚の組み合わせを重複なしで num_samples 通りランダムに生成するジェネレータ。
+    組み合わせ空間そのものは作らず、組み合わせ番号だけを抽出する。
+    """
+    pool = list(pool)
+    total = count_combinations(len(pool), k)
+    for index in rng.sample(range(total), min(num_samples, total)):
+        yield tuple(pool[p] for p in unrank_combination(index, len(pool), k))
+
+def enumerate_combinations(pool, k):
+    """pool から k 枚の組み合わせを全て順に生成する (遅延評価のジェネレータ)"""
+    return combinations(pool, k)
@@ -0,0 +1,125 @@
+"""
+実行中の同じ計算の重複をまとめる (singleflight)
+
+    inflight = SingleFlight(lock_dir=...)
+    result, shared = inflight.do(key, compute)
+
+同じ key の計算が実行中なら、後から来た呼び出しは compute を呼ばずにその完了を待ち、同じ結果 (または例外) を受け取る。
+結果は全ての呼び出し元で同じオブジェクトなので、書き換える場合は呼び出し元で複製する。
+ただし retry_on に指定した例外 (計算した呼び出し元の事情による中断。ジョブのキャンセルなど) は待っていた側には渡さず、
+待っていた側が改めて計算する (そのうち 1 つが先頭になり、残りはそれを待つ)。
+
+lock_dir を指定すると、key ごとのファイルロック (fcntl.flock) で別プロセス (gunicorn の他のワーカー) とも
+同時に計算しないようにする。ロックを待った側は compute を呼ぶので、compute の最初で共有キャッシュを
+引き直せば、先に計算したプロセスの結果を使える。ロックファイルは key のハッシュで LOCK_STRIPES 個に振り分ける
+(ファイルは増え続けないが、同じファイルになった別の key 同士も待ち合わせる)。
+fcntl のない環境ではプロセス内のまとめのみ行う。
+"""
+import hashlib
+import os
+import threading
+from contextlib import nullcontext
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+LOCK_STRIPES = 1024
+
+_NO_LOCK = nullcontext()
+
+
+class _Call:
+    """実行中の 1 つの計算 (完了すると done が立ち、result か error が入る。waiters は完了を待っている呼び出しの数)"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """key ごとに実行中の計算を 1 つにまとめる"""
+
+    def __init__(self, lock_dir=None, retry_on=()):
+        self.lock_dir = lock_dir
+        self.retry_on = tuple(retry_on)
+        self._calls = {} # key -> _Call
+        self._lock = threading.Lock()
+        if lock_dir and fcntl is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key, compute):
+        """
+        key の計算を 1 度だけ実行して (結果, 他の呼び出しの計算を待って共有したか) を返す。
+        compute が例外を投げた場合は、待っていた全ての呼び出し元に同じ例外を投げる (結果は残さない)。
+        例外が retry_on のものなら、待っていた呼び出し元は compute を呼び直す (計算した呼び出し元にだけ例外が届く)。
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                else:
+                    call.waiters += 1
+            if leader:
+                break
+            call.done.wait()
+            with self._lock:
+                call.waiters -= 1
+            if call.error is None:
+                return call.result, True
+            if not isinstance(call.error, self.retry_on):
+                raise call.error
+
+        try:
+            with self._process_lock(key):
+                call.result = compute()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        """実行中の計算の数"""
+        with self._lock:
+            return len(self._calls)
+
+    def waiting(self, key=None):
+        """実行中の key の計算 (省略時は全ての計算) の完了を待っている呼び出しの数"""
+        with self._lock:
+            if key is not None:
+                call = self._calls.get(key)
+                return call.waiters if call is not None else 0
+            return sum(call.waiters for call in self._calls.values())
+
+    def _process_lock(self, key):
+        if not self.lock_dir or fcntl is None:
+            return _NO_LOCK
+        stripe = int.from_bytes(hashlib.sha256(key.encode()).digest()[:4], 'big') % LOCK_STRIPES
+        return _FileLock(os.path.join(self.lock_dir, f'{stripe:04d}.lock'))
+
+
+class _FileLock:
+    """ファイルの排他ロック (with ブロックの間だけ保持する)"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        finally:
+            self.file.close()
@@ -0,0 +1,148 @@
+"""
+ドローの選択 (配られた 5 枚のうちどれを残すか) のソルバー
+
+32 通りの残し方それぞれについて、相手の保持カードに対するエクイティ (勝ち + 引き分け / 2) を求めて順位を付ける。
+相手はレンジではなく 1 つの保持カードで指定する (レンジに対する 1 つの残し方の勝率は range_equity を使う)。
+捨てたカードはどちらのプレイヤーも引けない (デッキは 52 枚 - 自分の 5 枚 - 相手の保持カード で全選択肢共通)。
+
+- 自分の残し方ごとの strength 分布 (カテゴリ確率にも使う) はメモ化する。
+- デッキが全選択肢で共通なので、相手の分布は「自分が引いたカード」だけで決まる。
+  equity.exact_spot_counts のメモを全選択肢で共有し、同じカードを引いた場合の相手の分布は一度だけ計算する。
+- 全列挙が重い選択肢はサンプリングで求め、ラウンドごとに試行を倍に増やしながら、
+  信頼区間の上限が最良の選択肢の下限を下回ったもの (明らかに劣るもの) をその時点で打ち切る。
+"""
+import numpy as np
+
+from adaptive import equity_interval
+from equity import (
+    EXACT_COST_LIMIT, category_vector, draw_distribution, estimate_exact_cost, exact_spot_counts,
+    flush_suits, kept_key_of, rank_avail_of, suit_bits_of,
+)
+from evaluator import HAND_CATEGORIES_27SD, NUM_CARDS
+from vectorized import simulate_spot_counts
+
+# 全列挙する選択肢の内部ループ回数の合計の上限 (超える分はサンプリング)
+EXACT_BUDGET = 4 * EXACT_COST_LIMIT
+# サンプリングする選択肢の最初のラウンドの試行数
+INITIAL_TRIALS = 2048
+
+
+def keep_options(hand_ids):
+    """5 枚の手札の残し方 32 通り (保持カードの昇順タプル) を残す枚数の多い順に返す"""
+    hand = sorted(hand_ids)
+    options = []
+    for mask in range(1 << len(hand)):
+        options.append(tuple(cid for i, cid in enumerate(hand) if mask >> i & 1))
+    options.sort(key=lambda keep: (-len(keep), keep))
+    return options
+
+
+class _Option:
+    """1 つの残し方の集計"""
+
+    def __init__(self, keep, hand):
+        self.keep = keep
+        self.discard = tuple(cid for cid in hand if cid not in keep)
+        self.method = None
+        self.wins = self.losses = self.ties = 0
+        self.pruned = False
+        self.rng = None
+
+    @property
+    def trials(self):
+        return self.wins + self.losses + self.ties
+
+    @property
+    def equity(self):
+        return (self.wins + self.ties / 2) / self.trials if self.trials else 0.0
+
+    def interval(self):
+        if self.method == 'exact':
+            return self.equity, self.equity
+        return equity_interval(self.wins, self.ties, self.trials)
+
+
+def solve_draw(hand_ids, opponent_ids, max_trials=20000, seed=None, progress=None):
+    """
+    hand_ids (5 枚) の残し方 32 通りを opponent_ids (相手の保持カード) に対するエクイティの高い順に並べて返す。
+    max_trials はサンプリングする選択肢 1 つあたりの試行数の上限。
+    progress を指定すると、計算の区切りごとに progress(進捗 0〜1) を呼ぶ。
+    戻り値は選択肢ごとの辞書のリスト (カードは整数 ID)。
+    """
+    hand = sorted(hand_ids)
+    opponent = sorted(opponent_ids)
+    dead = set(hand) | set(opponent)
+    deck_ids = [cid for cid in range(NUM_CARDS) if cid not in dead]
+    rank_avail = rank_avail_of(deck_ids)
+    suit_bits = suit_bits_of(deck_ids)
+    options = [_Option(keep, hand) for keep in keep_options(hand)]
+    seeds = np.random.SeedSequence(seed).spawn(len(options))
+
+    # 自分の残し方ごとのカテゴリ分布 (相手のドローに関係なく決まる)
+    category_probabilities = {}
+    for option in options:
+        dist = draw_distribution(kept_key_of(option.keep), flush_suits(option.keep),
+                                 rank_avail, suit_bits, 5 - len(option.keep))
+        counts = category_vector(dist)
+        total = sum(counts)
+        category_probabilities[option.keep] = {cat: counts[i] / total for i, cat in enumerate(HAND_CATEGORIES_27SD)}
+
+    # 軽い選択肢から予算内で全列挙 (相手の分布のメモは全選択肢で共有)
+    memos = {}
+    budget = EXACT_BUDGET
+    costs = {option.keep: estimate_exact_cost(option.keep, opponent, option.discard) for option in options}
+    for option in sorted(options, key=lambda o: costs[o.keep]):
+        if costs[option.keep] > budget:
+            break
+        budget -= costs[option.keep]
+        option.wins, option.losses, option.ties, _, _ = exact_spot_counts(option.keep, opponent, option.discard, memos)
+        option.method = 'exact'
+    exact_done = sum(1 for o in options if o.method == 'exact')
+    if progress:
+        progress(exact_done / len(options) / 2)
+
+    # 残りはラウンドごとに試行を増やしながらサンプリングし、明らかに劣る選択肢を打ち切る
+    active = []
+    for option, seed_seq in zip(options, seeds):
+        if option.method is None:
+            option.method = 'sampling'
+            option.rng = np.random.default_rng(seed_seq)
+            active.append(option)
+    batch = INITIAL_TRIALS
+    while active:
+        for option in active:
+            n = min(batch, max_trials - option.trials)
+            wins, losses, ties = simulate_spot_counts(option.keep, opponent, n, option.rng, option.discard)[:3]
+            option.wins += wins
+            option.losses += losses
+            option.ties += ties
+        best_lower = max(option.interval()[0] for option in options if not option.pruned)
+        for option in active:
+            if option.interval()[1] < best_lower:
+                option.pruned = True
+        active = [o for o in active if not o.pruned and o.trials < max_trials]
+        # 打ち切られていない選択肢が 1 つだけになれば順位は確定
+        if sum(1 for o in options if not o.pruned) <= 1:
+            break
+        batch = min(o.trials for o in active) if active else batch
+        if progress and active:
+            progress(0.5 + 0.5 * min(o.trials for o in active) / max_trials)
+
+    results = []
+    for option in sorted(options, key=lambda o: -o.equity):
+        low, high = option.interval()
+        trials = option.trials
+        results.append({
+            'keep': list(option.keep),
+            'discard': list(option.discard),
+            'equity': option.equity,
+            'equity_interval': [low, high],
+            'player1_wins': option.wins / trials,
+            'player2_wins': option.losses / trials,
+            'ties': option.ties / trials,
+            'method': option.method,
+            'trials': trials,
+            'pruned': option.pruned,
+            'probabilities': category_probabilities[option.keep],
+        })
+    return results
@@ -104,12 +104,25 @@ function renderCardSelectors() {
     });
 }
 
-// 勝率計算APIを呼び出す関数
+let currentJob = null; // 実行中の計算ジョブ ({ id, events })
+
+// 実行中のジョブの購読をやめてキャンセルする
+function cancelCurrentJob() {
+    if (!currentJob) return;
+    currentJob.events.close();
+    fetch(`/api/jobs/${currentJob.id}`, { method: 'DELETE' }).catch(() => {});
+    currentJob = null;
+}
+
+// 勝率計算APIを呼び出す関数 (ジョブとして登録し、SSE で途中経過を受け取る)
 async function calculateWinRate() {
     const resultDisplay = document.getElementById('result-display');
     const errorMessageEl = document.getElementById('error-message');
     const calcErrorEl = document.getElementById('calc-error');
 
+    // 前回の計算が残っていればキャンセル
+    cancelCurrentJob();
+
     // 結果表示をリセット & 非表示
     resultDisplay.style.display = 'none';
     errorMessageEl.style.display = 'none';
@@ -124,8 +137,7 @@ async function calculateWinRate() {
     }
 
     try {
-        // バックエンドAPIのパスを修正 (例: /api/calculate)
-        const response = await fetch('/api/calculate', {
+        const response = await fetch('/api/jobs', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -136,17 +148,50 @@ async function calculateWinRate() {
             })
         });
 
-        const data = await response.json();
+        const job = await response.json();
 
-        if (!response.ok || data.error) {
-            errorMessageEl.textContent = `エラー: ${data.error || response.statusText}`;
+        if (!response.ok || job.error) {
+            errorMessageEl.textContent = `エラー: ${job.error || response.statusText}`;
             errorMessageEl.style.display = 'block';
-        } else {
-            // 結果を表示
-            displayResults(data);
-            resultDisplay.style.display = 'block';
+            return;
         }
 
+        const events = new EventSource(job.events_url);
+        currentJob = { id: job.job_id, events: events };
+
+        // 途中経過: 勝率をその時点の推定値で更新していく
+        events.addEventListener('progress', (e) => {
+            const state = JSON.parse(e.data);
+            if (state.partial && state.partial.win_rates) {
+                displayWinRates(state.partial.win_rates, state.progress);
+                resultDisplay.style.display = 'block';
+            }
+        });
+
+        events.addEventListener('done', (e) => {
+            const state = JSON.parse(e.data);
+            events.close();
+            currentJob = null;
+            const data = state.result;
+            if (data.error) {
+                errorMessageEl.textContent = `エラー: ${data.error}`;
+                errorMessageEl.style.display = 'block';
+            } else {
+                // 結果を表示
+                displayResults(data);
+                resultDisplay.style.display = 'block';
+            }
+        });
+
+        events.addEventListener('error', (e) => {
+            events.close();
+            currentJob = null;
+            // サーバーからの 'error' イベント (計算失敗) には data がある。接続エラーの場合はない
+            const message = e.data ? JSON.parse(e.data).error : '進捗の受信に失敗しました';
+            errorMessageEl.textContent = `エラー: ${message}`;
+            errorMessageEl.style.display = 'block';
+        });
+
     } catch (error) {
         errorMessageEl.textContent = `通信エラー: ${error.message}`;
         errorMessageEl.style.display = 'block';
@@ -206,14 +251,21 @@ function displayResults(data) {
         document.getElementById('calc-error').textContent = `勝率計算エラー: ${data.win_rate_error}`;
         document.getElementById('calc-error').style.display = 'block';
     } else if (data.win_rates) {
-        document.getElementById('p1-win-rate').textContent = (data.win_rates.player1_wins * 100).toFixed(2);
-        document.getElementById('tie-rate').textContent = (data.win_rates.ties * 100).toFixed(2);
-        // P2の勝率は100 - P1勝率 - 引き分け率 で計算も可能だが、APIから直接受け取る方が確実
-        document.getElementById('p2-win-rate').textContent = (data.win_rates.player2_wins * 100).toFixed(2);
-        document.getElementById('simulations').textContent = data.win_rates.simulations || '-';
+        displayWinRates(data.win_rates);
     }
 }
 
+// 勝率を表示 (progress を渡した場合は計算途中の推定値として進捗も表示)
+function displayWinRates(winRates, progress) {
+    document.getElementById('p1-win-rate').textContent = (winRates.player1_wins * 100).toFixed(2);
+    document.getElementById('tie-rate').textContent = (winRates.ties * 100).toFixed(2);
+    // P2の勝率は100 - P1勝率 - 引き分け率 で計算も可能だが、APIから直接受け取る方が確実
+    document.getElementById('p2-win-rate').textContent = (winRates.player2_wins * 100).toFixed(2);
+    const simulations = winRates.simulations || '-';
+    document.getElementById('simulations').textContent =
+        progress === undefined ? simulations : `${simulations} (計算中 ${Math.round(progress * 100)}%)`;
+}
+
 
 // ページ読み込み完了時にカードセレクターを描画
 window.addEventListener('DOMContentLoaded', renderCardSelectors);
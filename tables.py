@@ -0,0 +1,176 @@
+"""
+参照テーブルの層
+
+- カード・ランク・役カテゴリの定数 (FULL_DECK, RANK_MAP, HAND_CATEGORY_ORDER など)
+- 事前ビルドしたテーブルの保存先 (TABLES_DIR の .npy ファイル群)。
+  読み込みは読み込み専用の mmap なので、同じファイルを開いた全ワーカーがページキャッシュを共有し、
+  ワーカー数を増やしても 1 ワーカーあたりのメモリはほぼ増えない。ファイルがなければ従来どおり import 時に構築する
+- 初回使用時に構築するテーブル (lazy_table) と、それらをまとめて構築する warm / 準備完了の状態
+
+ビルド:  python tables.py build
+gunicorn で preload_app を使う場合 (gunicorn.conf.py)、マスターで warm まで済ませてから fork するので、
+ワーカーは構築済みのテーブルをコピーオンライトで共有し、起動時に何も構築しない。
+
+evaluator などがここから定数とテーブルを読むので、モジュールの先頭ではこのパッケージの他のモジュールを import しない
+(build だけは構築関数を使うため、呼び出し時に evaluator と vectorized を import する)。
+"""
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- 定数 ---
+RANKS = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
+SUITS = ['H', 'D', 'S', 'C']
+FULL_DECK = frozenset([r + s for r in RANKS for s in SUITS])
+RANK_MAP = {'2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, '10': 10, 'J': 11, 'Q': 12, 'K': 13, 'A': 14}
+RANK_MAP_REV = {v: k for k, v in RANK_MAP.items()}
+
+# 2-7SD ハンドカテゴリ (確率計算用)
+# 注意: Bad Hand は Straight/Flush を含むため、個別のカテゴリより上に配置
+HAND_CATEGORIES_27SD = [
+    "7-High", "8-High", "9-High", "10-High", "J-High", "Q-High", "K-High", "A-High", # No Pair
+    "One Pair", "Two Pair", "Three of a Kind",
+    "Bad Hand (Straight/Flush)", # ストレートとフラッシュ
+    "Full House", "Four of a Kind"
+]
+# 確率表示順序のためのマップ (カテゴリ名 -> ソート順)
+HAND_CATEGORY_ORDER = {name: i for i, name in enumerate(HAND_CATEGORIES_27SD)}
+
+
+# --- 事前ビルドしたテーブル ---
+TABLES_DIR = os.environ.get('POKER_TABLES_DIR',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tables'))
+# 評価器の判定やテーブルの形式を変えたら上げる (古いファイルは読まずに import 時に構築する)
+TABLES_VERSION = 1
+_MANIFEST = 'manifest.json'
+
+_sources = {} # テーブル名 -> 'mmap' (ファイルから) / 'built' (プロセス内で構築)
+
+def _manifest_version(directory):
+    try:
+        with open(os.path.join(directory, _MANIFEST)) as f:
+            return json.load(f).get('version')
+    except (OSError, ValueError):
+        return None
+
+def load_arrays(names, directory=None):
+    """
+    事前ビルドしたテーブル names を読み込み専用で mmap し、名前 -> 配列 の辞書を返す。
+    ファイルがない・バージョンが違う・一部が欠けている場合は None を返す (呼び出し元で構築する)。
+    """
+    directory = directory or TABLES_DIR
+    if _manifest_version(directory) != TABLES_VERSION:
+        return None
+    arrays = {}
+    try:
+        for name in names:
+            arrays[name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r', allow_pickle=False)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not load table %s from %s: %s", name, directory, e)
+        return None
+    for name in names:
+        _sources[name] = 'mmap'
+    return arrays
+
+def mark_built(*names):
+    """load_arrays で読めずにプロセス内で構築したテーブルを記録する (readiness の表示用)"""
+    for name in names:
+        _sources.setdefault(name, 'built')
+
+def save_arrays(arrays, directory=None):
+    """名前 -> 配列 の辞書を .npy で保存し、最後に manifest を書く (書き込み中は古い manifest を消しておく)"""
+    directory = directory or TABLES_DIR
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, _MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    for name, array in arrays.items():
+        path = os.path.join(directory, name + '.npy')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+        os.replace(tmp_path, path)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'version': TABLES_VERSION, 'tables': sorted(arrays)}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+# --- 初回使用時に構築するテーブル ---
+_lazy_tables = []
+
+def lazy_table(build):
+    """
+    引数なしの構築関数を、初回の呼び出しで 1 度だけ構築して以後は同じ値を返す関数に包む (デコレータ)。
+    包んだ関数は warm の対象になる。
+    """
+    name = build.__name__.lstrip('_')
+
+    @functools.lru_cache(maxsize=None)
+    def cached():
+        _sources.setdefault(name, 'built')
+        return build()
+    _lazy_tables.append(cached)
+    return cached
+
+
+# --- 準備完了 (readiness) ---
+_ready = threading.Event()
+_warm_seconds = None
+
+def warm():
+    """lazy_table で登録した全テーブルを構築し、準備完了にする (2 回目以降は何もしない)"""
+    global _warm_seconds
+    if _ready.is_set():
+        return
+    start = time.perf_counter()
+    for build in _lazy_tables:
+        build()
+    _warm_seconds = time.perf_counter() - start
+    _ready.set()
+
+def is_ready():
+    return _ready.is_set()
+
+def status():
+    """準備完了かどうかと、各テーブルの読み込み元 (mmap / built)"""
+    return {
+        'ready': _ready.is_set(),
+        'warm_seconds': _warm_seconds,
+        'tables_dir': TABLES_DIR,
+        'tables': dict(sorted(_sources.items())),
+    }
+
+
+# --- ビルド ---
+def build(directory=None):
+    """評価器・バッチ評価のテーブルを構築して directory (省略時 TABLES_DIR) に保存する"""
+    # 既存のファイルを読まずに構築するため、構築関数を直接呼ぶ
+    from evaluator import _build_tables
+    from vectorized import _build_dense_tables
+    rank_table, flush_table = _build_tables()
+    rank_dense, flush_dense = _build_dense_tables(rank_table, flush_table)
+    arrays = {
+        'rank_keys': np.fromiter(rank_table.keys(), dtype=np.int64, count=len(rank_table)),
+        'rank_strengths': np.fromiter(rank_table.values(), dtype=np.int32, count=len(rank_table)),
+        'flush_keys': np.fromiter(flush_table.keys(), dtype=np.int64, count=len(flush_table)),
+        'flush_strengths': np.fromiter(flush_table.values(), dtype=np.int32, count=len(flush_table)),
+        'rank_dense': rank_dense,
+        'flush_dense': flush_dense,
+    }
+    save_arrays(arrays, directory)
+    return directory or TABLES_DIR
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'build':
+        print("usage: python tables.py build [output directory]")
+        sys.exit(1)
+    print(f"Wrote {build(sys.argv[2] if len(sys.argv) > 2 else None)}")
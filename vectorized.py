@@ -0,0 +1,156 @@
+"""
+NumPy によるバッチ評価とベクトル化モンテカルロ
+
+evaluate_batch は (N, 5) のカード ID 配列をまとめて評価し、
+evaluator と同じ strength (小さいほど強い) とカテゴリ番号を返す。
+ドローは N 試行分の部分 Fisher–Yates シャッフルを列ごとにまとめて行い、
+配列として生成する (乱数キーの argsort と同じ分布で、必要枚数分の手数しかかからない)。
+"""
+from itertools import combinations_with_replacement
+
+import numpy as np
+
+from evaluator import CARD_PRIME, CATEGORY_SHIFT, FLUSH_TABLE, NUM_CARDS, NUM_CATEGORIES, RANK_TABLE
+from tables import load_arrays, mark_built
+
+# 1 チャンクあたりの試行数 (作業配列のメモリを抑える)
+CHUNK_SIZE = 1 << 16
+
+# 昇順ランク (r0 <= ... <= r4) -> r0 + 13*r1 + 169*r2 + ... の密なテーブル
+_RANK_WEIGHTS = [1, 13, 169, 2197, 28561]
+
+# 5 要素のソーティングネットワーク (比較交換 9 回)
+_SORT_NETWORK = [(0, 1), (3, 4), (2, 4), (2, 3), (0, 3), (0, 2), (1, 4), (1, 3), (1, 2)]
+
+
+def _build_dense_tables(rank_table, flush_table):
+    rank_dense = np.zeros(13 ** 5, dtype=np.int32)
+    flush_dense = np.zeros(13 ** 5, dtype=np.int32)
+    for multiset in combinations_with_replacement(range(13), 5):
+        key = 1
+        for r in multiset:
+            key *= CARD_PRIME[r * 4]
+        if key not in rank_table: # 同じランク 5 枚はありえない
+            continue
+        index = sum(r * w for r, w in zip(multiset, _RANK_WEIGHTS))
+        rank_dense[index] = rank_table[key]
+        flush_dense[index] = flush_table.get(key, rank_table[key])
+    return rank_dense, flush_dense
+
+def _load_dense_tables():
+    # 事前ビルドしたファイルがあれば読み込み専用で mmap する (全ワーカーで物理メモリを共有)
+    arrays = load_arrays(('rank_dense', 'flush_dense'))
+    if arrays is None:
+        mark_built('rank_dense', 'flush_dense')
+        return _build_dense_tables(RANK_TABLE, FLUSH_TABLE)
+    return np.asarray(arrays['rank_dense']), np.asarray(arrays['flush_dense'])
+
+RANK_DENSE, FLUSH_DENSE = _load_dense_tables()
+
+
+# --- バッチ評価 ---
+def evaluate_batch(hands):
+    """
+    (N, 5) のカード ID 配列を評価し、(strength, カテゴリ番号) の配列を返す。
+    strength は evaluator.evaluate_ids と同じ値 (小さいほど強い)。
+    """
+    hands = np.asarray(hands)
+    # 列ごとにソーティングネットワークでランクを昇順に並べる (np.sort(axis=1) より速い)
+    ranks = [(hands[:, i] >> 2).astype(np.int32) for i in range(5)]
+    for i, j in _SORT_NETWORK:
+        ranks[i], ranks[j] = np.minimum(ranks[i], ranks[j]), np.maximum(ranks[i], ranks[j])
+    index = ranks[0] + 13 * ranks[1] + 169 * ranks[2] + 2197 * ranks[3] + 28561 * ranks[4]
+    suits = hands & 3
+    is_flush = (suits == suits[:, :1]).all(axis=1)
+    strengths = np.where(is_flush, FLUSH_DENSE[index], RANK_DENSE[index])
+    return strengths, strengths >> CATEGORY_SHIFT
+
+
+# --- ドロー生成 ---
+def draw_batch(deck, num_to_draw, num_trials, rng):
+    """
+    デッキ配列 deck から試行ごとに num_to_draw 枚を重複なしで引き、
+    (num_trials, num_to_draw) の配列で返す (列の順序もランダム)。
+    """
+    if num_to_draw == 0:
+        return np.empty((num_trials, 0), dtype=deck.dtype)
+    # 試行ごとのデッキ並びを作り、先頭 num_to_draw 列だけ Fisher–Yates で確定させる
+    perm = np.tile(np.arange(len(deck), dtype=np.int8), (num_trials, 1))
+    rows = np.arange(num_trials)
+    for j in range(num_to_draw):
+        swap = rng.integers(j, len(deck), size=num_trials)
+        head = perm[:, j].copy()
+        perm[:, j] = perm[rows, swap]
+        perm[rows, swap] = head
+    return deck[perm[:, :num_to_draw]]
+
+def _remaining_deck(*kept_groups):
+    excluded = set()
+    for kept in kept_groups:
+        excluded.update(kept)
+    return np.array([cid for cid in range(NUM_CARDS) if cid not in excluded], dtype=np.int8)
+
+def _chunks(num_trials, chunk_size=CHUNK_SIZE):
+    done = 0
+    while done < num_trials:
+        size = min(chunk_size, num_trials - done)
+        yield size
+        done += size
+
+
+# --- モンテカルロ ---
+def simulate_spot_counts(p1_ids, p2_ids, num_trials, rng, excluded_ids=()):
+    """
+    両プレイヤーのドローを num_trials 回シミュレートし、
+    (P1勝ち, P2勝ち, 引き分け, P1 のカテゴリ別回数, P2 のカテゴリ別回数, ハンド例) を返す。
+    カテゴリ別回数は長さ NUM_CATEGORIES の配列、ハンド例は最後の試行の (P1 の 5 枚, P2 の 5 枚) の ID リスト。
+    excluded_ids はデッキから除くカード (捨てたカードなど)。
+    """
+    p1 = np.array(sorted(p1_ids), dtype=np.int8)
+    p2 = np.array(sorted(p2_ids), dtype=np.int8)
+    deck = _remaining_deck(p1_ids, p2_ids, excluded_ids)
+    n1 = 5 - len(p1)
+    n2 = 5 - len(p2)
+    p1_wins = p2_wins = ties = 0
+    p1_categories = np.zeros(NUM_CATEGORIES, dtype=np.int64)
+    p2_categories = np.zeros(NUM_CATEGORIES, dtype=np.int64)
+    hands1 = hands2 = None
+    for size in _chunks(num_trials):
+        drawn = draw_batch(deck, n1 + n2, size, rng)
+        hands1 = np.concatenate([np.broadcast_to(p1, (size, len(p1))), drawn[:, :n1]], axis=1)
+        hands2 = np.concatenate([np.broadcast_to(p2, (size, len(p2))), drawn[:, n1:]], axis=1)
+        s1, c1 = evaluate_batch(hands1)
+        s2, c2 = evaluate_batch(hands2)
+        p1_wins += int(np.count_nonzero(s1 < s2))
+        p2_wins += int(np.count_nonzero(s2 < s1))
+        ties += int(np.count_nonzero(s1 == s2))
+        p1_categories += np.bincount(c1, minlength=NUM_CATEGORIES)
+        p2_categories += np.bincount(c2, minlength=NUM_CATEGORIES)
+    example = (hands1[-1].tolist(), hands2[-1].tolist()) if num_trials else None
+    return p1_wins, p2_wins, ties, p1_categories, p2_categories, example
+
+def simulate_multiway_counts(kept_id_lists, num_trials, rng):
+    """
+    複数プレイヤーのドローを num_trials 回シミュレートし、プレイヤーごとの
+    (単独勝ちの回数, 引き分けで分け合った回数, 獲得したポットの合計) の配列を返す。
+    """
+    kept_arrays = [np.array(sorted(kept), dtype=np.int8) for kept in kept_id_lists]
+    deck = _remaining_deck(*kept_id_lists)
+    draws = [5 - len(kept) for kept in kept_arrays]
+    offsets = np.cumsum([0] + draws)
+    num_players = len(kept_arrays)
+    wins = np.zeros(num_players, dtype=np.int64)
+    splits = np.zeros(num_players, dtype=np.int64)
+    shares = np.zeros(num_players, dtype=np.float64)
+    for size in _chunks(num_trials):
+        drawn = draw_batch(deck, int(offsets[-1]), size, rng)
+        strengths = np.empty((num_players, size), dtype=np.int32)
+        for i, kept in enumerate(kept_arrays):
+            hands = np.concatenate([np.broadcast_to(kept, (size, len(kept))), drawn[:, offsets[i]:offsets[i + 1]]], axis=1)
+            strengths[i], _ = evaluate_batch(hands)
+        is_best = strengths == strengths.min(axis=0)
+        best_count = is_best.sum(axis=0)
+        wins += (is_best & (best_count == 1)).sum(axis=1)
+        splits += (is_best & (best_count > 1)).sum(axis=1)
+        shares += (is_best / best_count).sum(axis=1)
+    return wins, splits, shares